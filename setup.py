@@ -51,6 +51,7 @@ setup(
         'tipfy.appengine.auth',
         'tipfy.appengine.db',
         'tipfy.auth',
+        'tipfy.benchmarks',
         'tipfy.debugger',
         'tipfyext',
         'tipfyext.appengine',
@@ -9,8 +9,12 @@ import sys
 import StringIO
 import unittest
 
+from werkzeug.test import EnvironBuilder
+
 import tipfy
-from tipfy import Request, RequestHandler, Response, Rule, Tipfy
+from tipfy import (Request, RequestHandler, Response, Rule, StreamingResponse,
+    Tipfy)
+from tipfy.handler import RequestHandlerMiddleware
 from tipfy.utils import json_encode
 from tipfy.local import local
 
@@ -428,6 +432,72 @@ class TestHandlerMiddleware(BaseTestCase):
         response = client.get('/')
         self.assertEqual(response.status_code, 500)
 
+    def test_app_middleware(self):
+        calls = []
+
+        class MyMiddleware(RequestHandlerMiddleware):
+            def __init__(self, name):
+                self.name = name
+
+            def before_dispatch(self, handler):
+                calls.append('before-' + self.name)
+
+            def after_dispatch(self, handler, response):
+                calls.append('after-' + self.name)
+                return response
+
+        class MyHandler(RequestHandler):
+            middleware = [MyMiddleware('handler')]
+
+            def get(self, **kwargs):
+                calls.append('get')
+                return Response('default')
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler=MyHandler),
+        ])
+        app.middleware = [MyMiddleware('app')]
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'default')
+        self.assertEqual(calls, ['before-app', 'before-handler', 'get',
+            'after-handler', 'after-app'])
+
+    def test_pipeline(self):
+        class MyMiddleware(RequestHandlerMiddleware):
+            def after_dispatch(self, handler, response):
+                response.data += '!'
+                return response
+
+        class MyHandler(RequestHandler):
+            middleware = [MyMiddleware(), MyMiddleware()]
+
+            def get(self, **kwargs):
+                return Response('default')
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler=MyHandler),
+        ])
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'default!!')
+
+        # Hooks not implemented by the middleware are skipped.
+        pipeline = MyHandler._middleware_pipeline[1]
+        self.assertEqual(pipeline.before_dispatch, ())
+        self.assertEqual(len(pipeline.after_dispatch), 2)
+        self.assertEqual(pipeline.handle_exception, ())
+
+        # The pipeline is compiled once.
+        response = client.get('/')
+        self.assertEqual(MyHandler._middleware_pipeline[1] is pipeline, True)
+
+        # And compiled again if the middleware list changes.
+        MyHandler.middleware.append(MyMiddleware())
+        response = client.get('/')
+        self.assertEqual(response.data, 'default!!!')
+        self.assertEqual(MyHandler._middleware_pipeline[1] is pipeline, False)
+
 
 class TestTipfy(BaseTestCase):
     def test_custom_error_handlers(self):
@@ -519,6 +589,201 @@ class TestTipfy(BaseTestCase):
         self.assertEqual(app.get_config('tipfy', 'foo'), 'bar')
 
 
+class TestEager(BaseTestCase):
+    def _get_app(self):
+        return Tipfy([
+            Rule('/', name='home', handler='resources.alternative_routing.HomeHandler'),
+            Rule('/foo', name='foo', handler='resources.alternative_routing.OtherHandler:foo'),
+            Rule('/bar', name='bar', handler='resources.alternative_routing.bar'),
+            Rule('/all', name='all', handler=AllMethodsHandler),
+        ], eager=True)
+
+    def test_handlers_imported(self):
+        from resources import alternative_routing
+
+        app = self._get_app()
+        plans = app.router.dispatch_plans
+        self.assertEqual(len(plans), 4)
+
+        rules = dict((rule.name, rule) for rule in app.router.map.iter_rules())
+        plan = plans[id(rules['home'])]
+        self.assertEqual(plan.handler, alternative_routing.HomeHandler)
+        self.assertEqual(plan.method_names, {'GET': 'get'})
+        self.assertEqual(plan.valid_methods, ['GET'])
+
+        plan = plans[id(rules['foo'])]
+        self.assertEqual(plan.handler, alternative_routing.OtherHandler)
+        self.assertEqual(sorted(plan.method_names), sorted(app.allowed_methods))
+        self.assertEqual(set(plan.method_names.values()), set(['foo']))
+        self.assertEqual(plan.valid_methods, [])
+
+        plan = plans[id(rules['bar'])]
+        self.assertEqual(plan.handler, alternative_routing.bar)
+        self.assertEqual(plan.method_names, None)
+
+    def test_import_error(self):
+        self.assertRaises(ImportError, Tipfy, [
+            Rule('/', name='home', handler='non.existent.handler'),
+        ], eager=True)
+
+    def test_dispatch(self):
+        app = self._get_app()
+        client = app.get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.data, 'home-get')
+
+        response = client.post('/')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.headers.get('Allow'), 'GET')
+
+        response = client.put('/foo')
+        self.assertEqual(response.data, 'other-foo')
+
+        response = client.get('/bar')
+        self.assertEqual(response.data, 'bar')
+
+        for method in app.allowed_methods:
+            response = client.open('/all', method=method)
+            self.assertEqual(response.status_code, 200, method)
+
+    def test_add_rule(self):
+        app = self._get_app()
+        app.router.add(Rule('/other', name='other',
+            handler='resources.alternative_routing.OtherHandler:bar'))
+        self.assertEqual(len(app.router.dispatch_plans), 5)
+
+        client = app.get_test_client()
+        response = client.get('/other')
+        self.assertEqual(response.data, 'other-bar')
+
+    def test_custom_valid_methods(self):
+        class MyHandler(RequestHandler):
+            def get_valid_methods(self):
+                return ['GET', 'POST']
+
+            def get(self, **kwargs):
+                return Response('get')
+
+        app = Tipfy([Rule('/', name='home', handler=MyHandler)], eager=True)
+        plan = app.router.dispatch_plans.values()[0]
+        self.assertEqual(plan.valid_methods, None)
+
+        client = app.get_test_client()
+        response = client.put('/')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.headers.get('Allow'), 'GET, POST')
+
+
+class TestStreaming(BaseTestCase):
+    def _get_app(self, handler, **kwargs):
+        return Tipfy(rules=[Rule('/', name='home', handler=handler)],
+            **kwargs)
+
+    def _call(self, app, method='GET'):
+        environ = EnvironBuilder('/', method=method).get_environ()
+        status = []
+        app_iter = app(environ, lambda s, h: status.append(s))
+        return status[0], app_iter
+
+    def test_generator(self):
+        chunks = []
+        closed = []
+
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                def generate():
+                    try:
+                        for i in range(3):
+                            chunks.append(i)
+                            yield 'chunk-%d;' % i
+                    finally:
+                        closed.append(True)
+
+                return generate()
+
+        status, app_iter = self._call(self._get_app(MyHandler))
+        self.assertEqual(status, '200 OK')
+        # Nothing was produced before the server iterates the body.
+        self.assertEqual(chunks, [])
+
+        self.assertEqual(app_iter.next(), 'chunk-0;')
+        self.assertEqual(chunks, [0])
+        app_iter.close()
+        self.assertEqual(closed, [True])
+
+    def test_context_kept(self):
+        from tipfy.local import get_request
+
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                def generate():
+                    yield get_request().path
+
+                return generate()
+
+        status, app_iter = self._call(self._get_app(MyHandler))
+        self.assertEqual(list(app_iter), ['/'])
+        self.assertEqual(getattr(local, 'request', None) is not None, True)
+        app_iter.close()
+        self.assertEqual(getattr(local, 'request', None), None)
+
+    def test_head_closes_iterable(self):
+        closed = []
+
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                def generate():
+                    yield 'foo'
+
+                response = StreamingResponse(generate())
+                response.call_on_close(lambda: closed.append(True))
+                return response
+
+            head = get
+
+        status, app_iter = self._call(self._get_app(MyHandler), 'HEAD')
+        self.assertEqual(list(app_iter), [])
+        self.assertEqual(closed, [True])
+
+    def test_streaming_response(self):
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                return StreamingResponse(iter(['a,b\n', u'c,d\n']),
+                    mimetype='text/csv')
+
+        client = self._get_app(MyHandler).get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'a,b\nc,d\n')
+        self.assertEqual(response.headers['Content-Type'],
+            'text/csv; charset=utf-8')
+        self.assertEqual('Content-Length' in response.headers, False)
+
+        response = StreamingResponse(iter(['foo']))
+        self.assertEqual(response.is_streamed, True)
+        self.assertRaises(RuntimeError, getattr, response, 'data')
+
+    def test_etag_middleware(self):
+        from tipfy.middleware import ETagMiddleware
+
+        class MyHandler(RequestHandler):
+            middleware = [ETagMiddleware()]
+
+            def get(self, **kwargs):
+                if self.request.args.get('stream'):
+                    return iter(['foo'])
+
+                return Response('foo')
+
+        client = self._get_app(MyHandler).get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.headers.get('ETag') is not None, True)
+
+        response = client.get('/?stream=1')
+        self.assertEqual(response.data, 'foo')
+        self.assertEqual(response.headers.get('ETag'), None)
+
+
 class TestRequest(BaseTestCase):
     def test_json(self):
         class JsonHandler(RequestHandler):
@@ -1,5 +1,6 @@
 from __future__ import with_statement
 
+import datetime
 import os
 import unittest
 
@@ -7,17 +8,28 @@ from tipfy import Request, RequestHandler, Response, Rule, Tipfy
 from tipfy.app import local
 
 import tipfy.auth
+import tipfy.appengine.auth.model
 from tipfy.auth import (AdminRequiredMiddleware, LoginRequiredMiddleware,
     UserRequiredMiddleware, UserRequiredIfAuthenticatedMiddleware,
     admin_required, login_required, user_required,
     user_required_if_authenticated, check_password_hash, generate_password_hash,
     create_session_id, MultiAuthStore)
 from tipfy.appengine.auth import AuthStore, MixedAuthStore
-from tipfy.appengine.auth.model import User
+from tipfy.appengine.auth.model import User, UserAuthId, _put_session
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import db
 
 import test_utils
 
 
+class BaseTestCase(test_utils.BaseTestCase):
+    def tearDown(self):
+        User._get_local_cache().clear()
+        LegacyUser._get_local_cache().clear()
+        test_utils.BaseTestCase.tearDown(self)
+
+
 class LoginHandler(RequestHandler):
     def get(self, **kwargs):
         return Response('login')
@@ -47,7 +59,7 @@ def get_app():
     return app
 
 
-class TestAuthStore(test_utils.BaseTestCase):
+class TestAuthStore(BaseTestCase):
     def test_user_model(self):
         app = get_app()
         app.router.add(Rule('/', name='home', handler=HomeHandler))
@@ -92,7 +104,7 @@ class TestAuthStore(test_utils.BaseTestCase):
             self.assertEqual(store.signup_url(), request.app.router.url_for(request, 'auth/signup', dict(redirect='/')))
 
 
-class TestMiddleware(test_utils.BaseTestCase):
+class TestMiddleware(BaseTestCase):
     def tearDown(self):
         os.environ.pop('USER_EMAIL', None)
         os.environ.pop('USER_ID', None)
@@ -496,7 +508,7 @@ class TestMiddleware(test_utils.BaseTestCase):
         self.assertEqual(response.data, 'home sweet home')
 
 
-class TestUserModel(test_utils.BaseTestCase):
+class TestUserModel(BaseTestCase):
     def test_create(self):
         user = User.create('my_username', 'my_id')
         self.assertEqual(isinstance(user, User), True)
@@ -567,6 +579,90 @@ class TestUserModel(test_utils.BaseTestCase):
         self.assertEqual(isinstance(user_1, User), True)
         self.assertEqual(str(user.key()), str(user_1.key()))
 
+    def test_get_by_auth_id_index(self):
+        user = User.create('my_username', 'my_id')
+        index = UserAuthId.get_by_key_name('my_id')
+        self.assertEqual(index.username, 'my_username')
+
+        # Users created before the index existed are found using a query.
+        index.delete()
+        User._get_local_cache().clear()
+        self.memcache_stub.MakeSyncCall('memcache', 'FlushAll',
+            memcache.MemcacheFlushRequest(), memcache.MemcacheFlushResponse())
+        user_1 = User.get_by_auth_id('my_id')
+        self.assertEqual(str(user.key()), str(user_1.key()))
+        self.assertEqual(UserAuthId.get_by_key_name('my_id').username,
+            'my_username')
+
+    def test_get_cached(self):
+        User.create('my_username', 'my_id')
+        # Remove the datastore entities: cached users are still found.
+        db.delete([db.Key.from_path('User', 'my_username'),
+            db.Key.from_path('UserAuthId', 'my_id')])
+
+        user = User.get_by_username('my_username')
+        self.assertEqual(user.auth_id, 'my_id')
+        user = User.get_by_auth_id('my_id')
+        self.assertEqual(user.username, 'my_username')
+
+        # Also when the process cache is skipped.
+        user = User.get_by_auth_id('my_id', local_cache=False)
+        self.assertEqual(user.username, 'my_username')
+
+    def test_put_updates_cache(self):
+        user = User.create('my_username', 'my_id')
+        user.email = 'calvin@example.com'
+        user.put()
+
+        user = User.get_by_auth_id('my_id')
+        self.assertEqual(user.email, 'calvin@example.com')
+
+    def test_delete_clears_cache(self):
+        user = User.create('my_username', 'my_id')
+        user.delete()
+
+        self.assertEqual(User.get_by_username('my_username'), None)
+        self.assertEqual(User.get_by_auth_id('my_id'), None)
+
+    def test_outdated_index(self):
+        User.create('my_username', 'my_id')
+        user = User.create('my_username_2', 'my_id_2')
+        UserAuthId(key_name='my_id_2', username='my_username').put()
+        User._get_local_cache().clear()
+        self.memcache_stub.MakeSyncCall('memcache', 'FlushAll',
+            memcache.MemcacheFlushRequest(), memcache.MemcacheFlushResponse())
+
+        user_1 = User.get_by_auth_id('my_id_2')
+        self.assertEqual(user_1.username, 'my_username_2')
+        # The index was fixed.
+        self.assertEqual(UserAuthId.get_by_key_name('my_id_2').username,
+            'my_username_2')
+
+    def test_put_changed_auth_id(self):
+        user = User.create('my_username', 'my_id')
+        user.auth_id = 'my_new_id'
+        user.put()
+
+        self.assertEqual(UserAuthId.get_by_key_name('my_id'), None)
+        self.assertEqual(UserAuthId.get_by_key_name('my_new_id').username,
+            'my_username')
+        self.assertEqual(User.get_by_auth_id('my_id'), None)
+        self.assertEqual(User.get_by_auth_id('my_new_id').username,
+            'my_username')
+
+    def test_delete_removes_index(self):
+        user = User.create('my_username', 'my_id')
+        user.delete()
+        self.assertEqual(UserAuthId.get_by_key_name('my_id'), None)
+
+    def test_outdated_index_deleted_user(self):
+        user = User.create('my_username', 'my_id')
+        db.delete(user.key())
+        user.delete_cache()
+
+        self.assertEqual(User.get_by_auth_id('my_id'), None)
+        self.assertEqual(UserAuthId.get_by_key_name('my_id'), None)
+
     def test_unicode(self):
         user_1 = User(username='Calvin', auth_id='test', session_id='test')
         self.assertEqual(unicode(user_1), u'Calvin')
@@ -601,13 +697,94 @@ class TestUserModel(test_utils.BaseTestCase):
         user = User.create('my_username', 'my_id')
         user.renew_session(force=True, max_age=86400)
 
+    def test_check_session_grace_period(self):
+        user = User.create('my_username', 'my_id')
+        user.session_updated -= datetime.timedelta(days=2)
+        session_id = user.session_id
+        user.renew_session(max_age=86400)
+
+        self.assertEqual(user.check_session(user.session_id), True)
+        self.assertEqual(user.check_session(session_id), True)
+
+        user.session_updated -= datetime.timedelta(
+            seconds=User.session_grace_period + 1)
+        self.assertEqual(user.check_session(user.session_id), True)
+        self.assertEqual(user.check_session(session_id), False)
+
+    def test_renew_session_force_revokes_previous(self):
+        user = User.create('my_username', 'my_id')
+        session_id = user.session_id
+        user.renew_session(force=True)
+
+        self.assertEqual(user.check_session(user.session_id), True)
+        self.assertEqual(user.check_session(session_id), False)
+        self.assertEqual(User.get_by_key_name('my_username').check_session(
+            session_id), False)
 
-class TestMiscelaneous(test_utils.BaseTestCase):
+    def test_renew_session_defer_error(self):
+        def defer(*args, **kwargs):
+            raise taskqueue.TransientError()
+
+        user = User.create('my_username', 'my_id')
+        user.session_updated -= datetime.timedelta(days=2)
+        user.put()
+        session_id = user.session_id
+
+        old_defer = tipfy.appengine.auth.model.defer
+        tipfy.appengine.auth.model.defer = defer
+        try:
+            user.renew_session(max_age=86400)
+        finally:
+            tipfy.appengine.auth.model.defer = old_defer
+
+        # Saved immediately instead.
+        user_1 = User.get_by_key_name('my_username')
+        self.assertNotEqual(user_1.session_id, session_id)
+        self.assertEqual(user_1.session_id, user.session_id)
+        self.assertEqual(user_1.previous_session_id, session_id)
+
+    def test_renew_session_deferred(self):
+        user = User.create('my_username', 'my_id')
+        user.session_updated -= datetime.timedelta(days=2)
+        user.put()
+        session_id = user.session_id
+
+        user.renew_session(max_age=86400)
+        self.assertNotEqual(user.session_id, session_id)
+        self.assertEqual(user.previous_session_id, session_id)
+
+        # Cached immediately, saved later.
+        self.assertEqual(User.get_by_username('my_username').session_id,
+            user.session_id)
+        self.assertEqual(User.get_by_key_name('my_username').session_id,
+            session_id)
+        self.assertEqual(len(self.taskqueue_stub.GetTasks('default')), 1)
+
+        # Other requests don't renew it again.
+        user_2 = User.get_by_key_name('my_username')
+        user_2.renew_session(max_age=86400)
+        self.assertEqual(user_2.session_id, session_id)
+        self.assertEqual(len(self.taskqueue_stub.GetTasks('default')), 1)
+
+        _put_session(User, user.key(), user.session_id,
+            user.previous_session_id, user.session_updated)
+        user_3 = User.get_by_key_name('my_username')
+        self.assertEqual(user_3.session_id, user.session_id)
+        self.assertEqual(user_3.previous_session_id, session_id)
+
+
+class LegacyUser(User):
+    @classmethod
+    def get_by_auth_id(cls, auth_id):
+        return cls.all().filter('auth_id =', auth_id).get()
+
+
+class TestMiscelaneous(BaseTestCase):
     def test_create_session_id(self):
         self.assertEqual(len(create_session_id()), 32)
 
 
-class TestMultiAuthStore(test_utils.BaseTestCase):
+class TestMultiAuthStore(BaseTestCase):
     def get_app(self):
         app = Tipfy(config={'tipfy.sessions': {
             'secret_key': 'secret',
@@ -699,6 +876,48 @@ class TestMultiAuthStore(test_utils.BaseTestCase):
             self.assertEqual(store.session['id'], 'foo_id')
             self.assertEqual(store.user, None)
 
+    def test_get_user_entity_per_request(self):
+        User.create('foo', 'foo_id')
+        with self.get_app().get_test_context() as request:
+            store = MultiAuthStore(request)
+            user = store.get_user_entity(auth_id='foo_id')
+            self.assertEqual(store.get_user_entity(auth_id='foo_id') is user,
+                True)
+
+    def test_real_login_outdated_cache(self):
+        user = User.create('foo', 'foo_id')
+        cache = User._get_local_cache()
+        key = User._get_cache_key('username', 'foo')
+        outdated = cache[key]
+
+        # The session is renewed by another instance.
+        user.renew_session(force=True)
+        with self.get_app().get_test_context() as request:
+            store = MultiAuthStore(request)
+            store.login_with_auth_id('foo_id', remember=False)
+
+            response = Response()
+            request.session_store.save(response)
+
+        cache[key] = outdated
+        with self.get_app().get_test_context('/', headers={
+            'Cookie': '\n'.join(response.headers.getlist('Set-Cookie')),
+        }) as request:
+            store = MultiAuthStore(request)
+            self.assertNotEqual(store.user, None)
+            self.assertEqual(store.user.session_id, user.session_id)
+
+    def test_reload_user_entity_custom_model(self):
+        LegacyUser.create('foo', 'foo_id')
+        app = Tipfy(config={
+            'tipfy.auth': {'user_model': 'auth_test.LegacyUser'},
+            'tipfy.sessions': {'secret_key': 'secret'},
+        })
+        with app.get_test_context() as request:
+            store = MultiAuthStore(request)
+            user = store.reload_user_entity('foo_id')
+            self.assertEqual(user.username, 'foo')
+
     def test_real_login_invalid(self):
         with self.get_app().get_test_context() as request:
             store = MultiAuthStore(request)
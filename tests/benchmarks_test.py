@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.benchmarks
+"""
+import os
+import tempfile
+
+from tipfy.benchmarks import suite
+
+import test_utils
+
+
+class TestSuite(test_utils.BaseTestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(suite.percentile(values, 50), 50)
+        self.assertEqual(suite.percentile(values, 99), 99)
+        self.assertEqual(suite.percentile(values, 100), 100)
+        self.assertEqual(suite.percentile([1], 99), 1)
+
+    def test_run(self):
+        benchmark = suite.get_middleware_benchmarks(depths=[2])[0]
+        self.assertEqual(benchmark.name, 'middleware.2')
+
+        rv = benchmark.run(requests=10, warmup=1)
+        self.assertEqual(rv['requests'], 10)
+        self.assertEqual(rv['rps'] > 0, True)
+        self.assertEqual(rv['p50'] <= rv['p99'], True)
+
+    def test_run_error(self):
+        benchmark = suite.get_middleware_benchmarks(depths=[0])[0]
+        benchmark.environs = [suite.make_environ('/not-found')]
+        self.assertRaises(RuntimeError, benchmark.run, 10)
+
+    def test_compare(self):
+        baseline = {
+            'a': {'rps': 1000.0},
+            'b': {'rps': 1000.0},
+        }
+        results = {
+            'a': {'rps': 900.0},
+            'b': {'rps': 700.0},
+            'c': {'rps': 10.0},
+        }
+        self.assertEqual(suite.compare(results, baseline, 0.25), [
+            ('b', 1000.0, 700.0)])
+        self.assertEqual(suite.compare(results, baseline, 0.05), [
+            ('a', 1000.0, 900.0), ('b', 1000.0, 700.0)])
+
+    def test_baseline(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(filename)
+        try:
+            self.assertEqual(suite.load_baseline(filename), {})
+
+            results = {'a': {'rps': 1000.0, 'p50': 1.0}}
+            suite.save_baseline(filename, results)
+            self.assertEqual(suite.load_baseline(filename), results)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+if __name__ == '__main__':
+    test_utils.main()
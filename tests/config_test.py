@@ -358,6 +358,86 @@ class TestLoadConfigGetItem(test_utils.BaseTestCase):
         self.assertRaises(KeyError, config['tipfy'].__getitem__, 'foo')
 
 
+class TestFreeze(test_utils.BaseTestCase):
+    def test_freeze(self):
+        config = Config({
+            'resources.i18n': {
+                'locale': 'pt_BR',
+            },
+        })
+        self.assertEqual(config.freeze(), config)
+        self.assertEqual(config.frozen, True)
+
+        # Default values were loaded.
+        self.assertEqual('resources.i18n' in config.loaded, True)
+        self.assertEqual(dict.__getitem__(config, 'resources.i18n')['timezone'],
+            'America/Chicago')
+        self.assertEqual(config['resources.i18n']['locale'], 'pt_BR')
+        self.assertRaises(KeyError, config['resources.i18n'].__getitem__,
+            'foo')
+        self.assertRaises(KeyError, config['resources.i18n'].__getitem__,
+            'required')
+
+    def test_freeze_modules(self):
+        config = Config().freeze(['resources.template'])
+        self.assertEqual(dict.get(config, 'resources.template') is not None,
+            True)
+
+    def test_load_after_freeze(self):
+        config = Config().freeze()
+        self.assertEqual(config.get_config('resources.i18n', 'locale'), 'en_US')
+        self.assertRaises(TypeError, config['resources.i18n'].__setitem__,
+            'locale', 'pt_BR')
+        self.assertRaises(KeyError, config.__getitem__, 'i_dont_exist')
+
+    def test_read_only(self):
+        config = Config({'foo': {'bar': 'baz'}}).freeze()
+        module_config = config['foo']
+        self.assertRaises(TypeError, module_config.__setitem__, 'bar', 'ding')
+        self.assertRaises(TypeError, module_config.__delitem__, 'bar')
+        self.assertRaises(TypeError, module_config.update, {'bar': 'ding'})
+        self.assertRaises(TypeError, module_config.setdefault, 'ding', 'dong')
+        self.assertRaises(TypeError, module_config.pop, 'bar')
+        self.assertRaises(TypeError, module_config.clear)
+        self.assertRaises(TypeError, config.update, 'foo', {'bar': 'ding'})
+        self.assertRaises(TypeError, config.setdefault, 'ding', {})
+        self.assertRaises(TypeError, config.__setitem__, 'ding', {})
+        self.assertEqual(config['foo'], {'bar': 'baz'})
+
+    def test_app(self):
+        app = Tipfy(config={'tipfy': {'server_name': 'foo.com'}})
+        app.config.freeze()
+        self.assertEqual(app.config['tipfy']['server_name'], 'foo.com')
+        self.assertEqual(app.config['tipfy']['enable_timing'], False)
+
+    def test_cache(self):
+        config = Config({'foo': {'bar': 'baz'}})
+        self.assertEqual(config.cache['foo'], {'bar': 'baz'})
+        # Not kept before the configuration is frozen.
+        self.assertEqual('foo' in config.cache, False)
+        config['foo'] = {'bar': 'ding'}
+        self.assertEqual(config.cache['foo'], {'bar': 'ding'})
+
+        config.freeze()
+        module_config = config.cache['foo']
+        self.assertEqual(module_config is config['foo'], True)
+        self.assertEqual(dict.get(config.cache, 'foo') is module_config, True)
+
+        # Modules loaded after the freeze are kept too.
+        self.assertEqual(config.cache['resources.i18n']['locale'], 'en_US')
+        self.assertEqual('resources.i18n' in config.cache, True)
+        self.assertRaises(KeyError, config.cache.__getitem__, 'i_dont_exist')
+
+    def test_app_freeze_config(self):
+        app = Tipfy(config={'tipfy': {'freeze_config': True}})
+        self.assertEqual(app.config.frozen, True)
+        self.assertRaises(TypeError, app.config['tipfy'].__setitem__,
+            'server_name', 'foo.com')
+
+        app = Tipfy()
+        self.assertEqual(app.config.frozen, False)
+
+
 class TestGetConfig(test_utils.BaseTestCase):
     '''
     def test_get_config(self):
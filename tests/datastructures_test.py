@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.datastructures
+"""
+import unittest
+
+from tipfy.datastructures import LRUCache
+
+import test_utils
+
+
+class TestLRUCache(test_utils.BaseTestCase):
+    def test_get_set(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('foo', 'baz'), 'baz')
+
+        cache['foo'] = 'bar'
+        self.assertEqual(cache.get('foo'), 'bar')
+        self.assertEqual(cache['foo'], 'bar')
+        self.assertEqual('foo' in cache, True)
+        self.assertEqual(len(cache), 1)
+
+        cache.set('foo', 'baz')
+        self.assertEqual(cache['foo'], 'baz')
+        self.assertEqual(len(cache), 1)
+
+    def test_missing_key(self):
+        cache = LRUCache(10)
+        self.assertRaises(KeyError, cache.__getitem__, 'foo')
+        self.assertRaises(KeyError, cache.__delitem__, 'foo')
+
+    def test_pop(self):
+        cache = LRUCache(10)
+        cache['foo'] = 'bar'
+        self.assertEqual(cache.pop('foo'), 'bar')
+        self.assertEqual(cache.pop('foo'), None)
+        self.assertEqual('foo' in cache, False)
+
+        cache['foo'] = 'bar'
+        del cache['foo']
+        self.assertEqual('foo' in cache, False)
+
+    def test_eviction(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+
+        # Mark 'a' as recently used.
+        self.assertEqual(cache['a'], 1)
+
+        cache['d'] = 4
+        self.assertEqual(len(cache), 3)
+        self.assertEqual('b' in cache, False)
+        self.assertEqual('a' in cache, True)
+        self.assertEqual('c' in cache, True)
+        self.assertEqual('d' in cache, True)
+
+    def test_clear(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+        cache['c'] = 3
+        self.assertEqual(cache['c'], 3)
+
+    def test_oldest(self):
+        cache = LRUCache(3)
+        self.assertEqual(cache.oldest(), None)
+
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.oldest(), ('a', 1))
+
+        # Doesn't mark it as used.
+        self.assertEqual(cache.oldest(), ('a', 1))
+        cache.get('a')
+        self.assertEqual(cache.oldest(), ('b', 2))
+
+
+if __name__ == '__main__':
+    test_utils.main()
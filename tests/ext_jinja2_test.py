@@ -2,6 +2,7 @@
 """
     Tests for tipfyext.jinja2
 """
+import datetime
 import os
 import sys
 import unittest
@@ -10,7 +11,7 @@ from jinja2 import FileSystemLoader, Environment
 
 from tipfy import RequestHandler, Request, Response, Tipfy
 from tipfy.app import local
-from tipfyext.jinja2 import Jinja2, Jinja2Mixin
+from tipfyext.jinja2 import Jinja2, Jinja2Mixin, warmup
 
 import test_utils
 
@@ -220,6 +221,40 @@ class TestJinja2(test_utils.BaseTestCase):
         template = jinja2.environment.from_string("""{{ _('foo = %(bar)s', bar='foo') }}""")
         self.assertEqual(template.render(), 'foo = foo')
 
+    def test_format_list_filters(self):
+        app = Tipfy(config={
+            'tipfyext.jinja2': {
+                'environment_args': {
+                    'extensions': ['jinja2.ext.i18n',],
+                },
+            },
+            'tipfy.sessions': {
+                'secret_key': 'foo',
+            },
+            'tipfy.i18n': {
+                'timezone': 'UTC',
+            },
+        })
+        local.request = Request.from_values()
+        local.request.app = app
+        handler = RequestHandler(local.request)
+        jinja2 = Jinja2(app)
+
+        template = jinja2.environment.from_string(
+            """{{ values|format_date_list('yyyy-MM-dd')|join(',') }}""")
+        self.assertEqual(template.render(values=[
+            datetime.datetime(2009, 11, 10), None]), '2009-11-10,')
+
+        template = jinja2.environment.from_string(
+            """{{ values|format_number_list|join(';') }}""")
+        self.assertEqual(template.render(values=[1099, 2]), '1,099;2')
+
+    def test_warmup(self):
+        app = Tipfy(config={'tipfyext.jinja2': {'templates_dir': templates_dir}})
+        warmup(app)
+        jinja2 = Jinja2.factory(app, 'jinja2')
+        self.assertEqual(len(jinja2.environment.cache) > 0, True)
+
 
 if __name__ == '__main__':
     test_utils.main()
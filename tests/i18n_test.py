@@ -7,8 +7,12 @@ from __future__ import with_statement
 import datetime
 import gettext as gettext_stdlib
 import os
+import shutil
+import tempfile
 import unittest
 
+from babel.messages.catalog import Catalog
+from babel.messages.mofile import write_mo
 from babel.numbers import NumberFormatError
 
 from pytz.gae import pytz
@@ -487,5 +491,275 @@ class BaseTestCase(test_utils.BaseTestCase):
         os.chdir(cwd)
 
 
+    def test_lazy_store(self):
+        app = App(config={
+            'tipfy.i18n': {
+                'locale_request_lookup': [('args', 'lang'), ('session', '_locale')],
+            },
+        })
+        request = Request.from_values('/?lang=pt_BR')
+        request.app = app
+
+        # The session is not used until the locale or timezone is needed.
+        store = i18n.I18nStore(request)
+        self.assertEqual(store._locale, None)
+        self.assertEqual(store._timezone, None)
+        self.assertEqual(store.gettext('foo'), u'foo')
+        self.assertEqual(store.locale, 'pt_BR')
+        self.assertEqual(store.babel_locale.territory, 'BR')
+        self.assertEqual(store._timezone, None)
+
+        store.locale = 'en_US'
+        self.assertEqual(store.babel_locale.territory, 'US')
+        store.timezone = 'UTC'
+        self.assertEqual(store.tzinfo, pytz.UTC)
+
+    def test_get_format_pattern(self):
+        locale = i18n.get_babel_locale('en_US')
+        pattern = i18n.get_format_pattern(locale, 'date', 'yyyy.MM.dd')
+        self.assertEqual(i18n.get_format_pattern(locale, 'date',
+            'yyyy.MM.dd') is pattern, True)
+        self.assertEqual(i18n.get_format_pattern(locale, 'date', 'short'),
+            locale.date_formats['short'])
+        self.assertEqual(i18n.get_format_pattern(locale, 'datetime', 'short'),
+            'short')
+        self.assertEqual(i18n.get_format_pattern(locale, 'decimal', None),
+            None)
+
+        value = datetime.datetime(2009, 11, 10, 16, 36, 05)
+        self.assertEqual(i18n.format_date(value, format='yyyy.MM.dd'),
+            u'2009.11.10')
+        self.assertEqual(i18n.format_datetime(value, format="yyyy.MM.dd HH:mm"),
+            u'2009.11.10 16:36')
+        self.assertEqual(i18n.format_decimal(1234.5, format=u'#,##0.00'),
+            u'1,234.50')
+        self.assertEqual(i18n.format_percent(0.25, format=u'#,##0.0%'),
+            u'25.0%')
+
+    def test_to_local_timezone_many(self):
+        i18n.set_timezone('America/Sao_Paulo')
+        values = [
+            # DST ends in 2010-02-21 at 02:00 UTC.
+            datetime.datetime(2010, 2, 21, 1, 30),
+            datetime.datetime(2010, 2, 21, 1, 59),
+            datetime.datetime(2010, 2, 21, 2, 0),
+            datetime.datetime(2010, 2, 21, 2, 0, tzinfo=pytz.UTC),
+            None,
+            datetime.datetime(2010, 2, 21, 1, 0),
+        ]
+        expected = [i18n.to_local_timezone(v) for v in values if v]
+        expected.insert(4, None)
+        result = i18n.to_local_timezone_many(values)
+        self.assertEqual(result, expected)
+        self.assertEqual([v and v.utcoffset() for v in result],
+            [v and v.utcoffset() for v in expected])
+        self.assertEqual(result[1].hour, 23)
+        self.assertEqual(result[2].hour, 23)
+
+    def test_format_many(self):
+        i18n.set_timezone('America/Chicago')
+        values = [
+            datetime.datetime(2009, 11, 10, 16, 36, 05),
+            None,
+            datetime.datetime(2009, 7, 10, 16, 36, 05),
+        ]
+        for format in ('short', 'full', 'iso', "yyyy.MM.dd HH:mm"):
+            self.assertEqual(i18n.format_datetimes(values, format), [
+                i18n.format_datetime(values[0], format), u'',
+                i18n.format_datetime(values[2], format)])
+
+        for format in ('short', 'full', 'iso', "yyyy.MM.dd"):
+            self.assertEqual(i18n.format_dates(values, format), [
+                i18n.format_date(values[0], format), u'',
+                i18n.format_date(values[2], format)])
+
+        self.assertEqual(i18n.format_times(values[:1], 'short'),
+            [u'10:36 AM'])
+        # time objects are formatted using the current timezone as well.
+        times = [datetime.time(10, 0), None, datetime.time(23, 30)]
+        for format in ('short', 'full', 'HH:mm zzzz'):
+            self.assertEqual(i18n.format_times(times, format), [
+                i18n.format_time(times[0], format), u'',
+                i18n.format_time(times[2], format)])
+
+        self.assertEqual(i18n.format_numbers([1099, None, 12345.5]),
+            [u'1,099', u'', u'12,345.5'])
+        self.assertEqual(i18n.format_decimals([1.2345], format=u'#.00'),
+            [u'1.23'])
+
+    def test_cached_objects(self):
+        self.assertEqual(i18n.get_tzinfo('America/Chicago') is
+            i18n.get_tzinfo('America/Chicago'), True)
+        self.assertEqual(i18n.get_babel_locale('pt_BR') is
+            i18n.get_babel_locale('pt_BR'), True)
+
+
+class TestTranslationCatalogs(test_utils.BaseTestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.write_catalog('pt_BR', {'foo': u'foo pt_BR'})
+        self.write_catalog('pt', {'foo': u'foo pt', 'bar': u'bar pt'})
+        self.write_catalog('en_US', {'foo': u'foo en_US', 'bar': u'bar en_US',
+            'baz': u'baz en_US'})
+        test_utils.BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+        test_utils.BaseTestCase.tearDown(self)
+
+    def write_catalog(self, locale, messages):
+        catalog = Catalog(locale=locale)
+        for msgid, string in messages.iteritems():
+            catalog.add(msgid, string)
+
+        path = os.path.join(self.dirname, locale, 'LC_MESSAGES')
+        os.makedirs(path)
+        fp = open(os.path.join(path, 'messages.mo'), 'wb')
+        try:
+            write_mo(fp, catalog)
+        finally:
+            fp.close()
+
+    def test_negotiate(self):
+        catalogs = i18n.TranslationCatalogs('en_US', self.dirname)
+        self.assertEqual(catalogs.available_locales, ['en_US', 'pt', 'pt_BR'])
+        self.assertEqual(catalogs.negotiate('pt-br,pt;q=0.8,en;q=0.5'), 'pt_BR')
+        self.assertEqual(catalogs.negotiate('pt-PT,en;q=0.5'), 'pt')
+        self.assertEqual(catalogs.negotiate('de-DE,en;q=0.5'), 'en_US')
+        self.assertEqual(catalogs.negotiate('de-DE'), None)
+        self.assertEqual(catalogs.negotiate(''), None)
+        self.assertEqual(catalogs.negotiate('pt-BR;q=0'), None)
+        self.assertEqual(catalogs.negotiate('pt-BR;q=0,en;q=0.5'), 'en_US')
+
+        # Cached per header.
+        catalogs._negotiated['de-DE'] = 'pt_BR'
+        self.assertEqual(catalogs.negotiate('de-DE'), 'pt_BR')
+
+    def test_accept_language_lookup(self):
+        app = App(config={
+            'tipfy.sessions': {'secret_key': 'secret'},
+            'tipfy.i18n': {
+                'locale_request_lookup': [('args', 'lang'),
+                    ('accept_language', None)],
+            },
+        })
+        i18n.get_translation_catalogs(app).dirname = self.dirname
+        request = Request.from_values('/', headers={
+            'Accept-Language': 'pt-BR,pt;q=0.8'})
+        request.app = app
+        self.assertEqual(i18n.I18nStore(request).locale, 'pt_BR')
+
+        request = Request.from_values('/?lang=en_US', headers={
+            'Accept-Language': 'pt-BR,pt;q=0.8'})
+        request.app = app
+        self.assertEqual(i18n.I18nStore(request).locale, 'en_US')
+
+        request = Request.from_values('/', headers={
+            'Accept-Language': 'de-DE'})
+        request.app = app
+        self.assertEqual(i18n.I18nStore(request).locale, 'en_US')
+
+    def test_load_translations_hook(self):
+        calls = []
+        class Store(i18n.I18nStore):
+            def load_translations(self, locales, dirname=None, domain=None):
+                calls.append(locales)
+                return i18n.I18nStore.load_translations(self, locales,
+                    self.request.app.config['tipfy.i18n']['dirname'])
+
+        app = App(config={
+            'tipfy.sessions': {'secret_key': 'secret'},
+            'tipfy.i18n': {'dirname': self.dirname},
+        })
+        request = Request.from_values('/')
+        request.app = app
+        store = Store(request)
+        store.locale = 'pt_BR'
+        self.assertEqual(store.gettext('bar'), u'bar pt')
+        self.assertEqual(calls, [['pt_BR', 'pt', 'en_US', 'en']])
+
+        # Loaded once per process.
+        store = Store(request)
+        store.locale = 'pt_BR'
+        self.assertEqual(store.gettext('foo'), u'foo pt_BR')
+        self.assertEqual(len(calls), 1)
+
+    def test_lazy_string(self):
+        app = App(config={
+            'tipfy.sessions': {'secret_key': 'secret'},
+        })
+        catalogs = i18n.get_translation_catalogs(app)
+        catalogs.dirname = self.dirname
+        local.request = request = Request.from_values('/')
+        request.app = app
+
+        calls = []
+        def gettext(string):
+            calls.append(string)
+            return i18n.gettext(string)
+
+        lazy = i18n.LazyString(gettext, 'foo')
+        self.assertEqual(unicode(lazy), u'foo en_US')
+        self.assertEqual(unicode(lazy), u'foo en_US')
+        self.assertEqual(len(calls), 1)
+
+        i18n.set_locale('pt_BR')
+        self.assertEqual(unicode(lazy), u'foo pt_BR')
+        i18n.set_locale('en_US')
+        self.assertEqual(unicode(lazy), u'foo en_US')
+        self.assertEqual(len(calls), 2)
+
+        # Reloading translations invalidates cached values.
+        shutil.rmtree(os.path.join(self.dirname, 'en_US'))
+        self.write_catalog('en_US', {'foo': u'foo reloaded'})
+        catalogs.reload()
+        self.assertEqual(unicode(lazy), u'foo reloaded')
+        self.assertEqual(len(calls), 3)
+
+        self.assertEqual(isinstance(i18n.lazy_gettext('foo'),
+            i18n.LazyString), True)
+        self.assertEqual(i18n.lazy_ngettext('foo', 'foos', 2), u'foos')
+
+    def test_get_fallbacks(self):
+        catalogs = i18n.TranslationCatalogs('en_US', self.dirname)
+        self.assertEqual(catalogs.get_fallbacks('pt_BR'),
+            ['pt_BR', 'pt', 'en_US', 'en'])
+        self.assertEqual(catalogs.get_fallbacks('en_US'), ['en_US', 'en'])
+
+    def test_merged(self):
+        catalogs = i18n.TranslationCatalogs('en_US', self.dirname)
+        translations = catalogs.get('pt_BR')
+        self.assertEqual(translations.ugettext('foo'), u'foo pt_BR')
+        self.assertEqual(translations.ugettext('bar'), u'bar pt')
+        self.assertEqual(translations.ugettext('baz'), u'baz en_US')
+        self.assertEqual(translations.ugettext('ding'), u'ding')
+        self.assertEqual(catalogs.get('pt_BR') is translations, True)
+
+    def test_missing(self):
+        catalogs = i18n.TranslationCatalogs('de_DE', self.dirname)
+        self.assertEqual(catalogs.get('fr_FR').ugettext('foo'), u'foo')
+
+    def test_preload(self):
+        catalogs = i18n.TranslationCatalogs('en_US', self.dirname)
+        catalogs.preload()
+        self.assertEqual(sorted(catalogs.catalogs.keys()),
+            ['en_US', 'pt', 'pt_BR'])
+
+    def test_store(self):
+        app = App(config={
+            'tipfy.sessions': {'secret_key': 'secret'},
+            'tipfy.i18n': {'locale': 'en_US'},
+        })
+        catalogs = i18n.get_translation_catalogs(app)
+        self.assertEqual(i18n.get_translation_catalogs(app) is catalogs, True)
+
+        catalogs.dirname = self.dirname
+        request = Request.from_values('/')
+        request.app = app
+        store = i18n.I18nStore(request)
+        store.set_locale('pt_BR')
+        self.assertEqual(store.gettext('bar'), u'bar pt')
+
+
 if __name__ == '__main__':
     test_utils.main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.sessions local backends
+"""
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import time
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.sessions import (MemorySession, MemorySessionStorage,
+    SessionMiddleware, SQLiteSession, SQLiteSessionStorage)
+
+import test_utils
+
+
+class SessionHandler(RequestHandler):
+    middleware = [SessionMiddleware()]
+
+    def get(self, **kwargs):
+        backend = self.request.rule_args['backend']
+        session = self.session_store.get_session(backend=backend)
+        res = session.get('test')
+        if not res:
+            res = 'undefined'
+            session['test'] = 'a %s session value' % backend
+
+        return Response(res)
+
+
+class StorageTestMixin(object):
+    def test_get_set(self):
+        storage = self.get_storage()
+        self.assertEqual(storage.get('foo'), None)
+
+        storage.set('foo', {'bar': ['baz']})
+        self.assertEqual(storage.get('foo'), {'bar': ['baz']})
+
+        # Values are copied.
+        storage.get('foo')['bar'].append('ding')
+        self.assertEqual(storage.get('foo'), {'bar': ['baz']})
+
+        storage.delete('foo')
+        self.assertEqual(storage.get('foo'), None)
+
+    def test_get_many(self):
+        storage = self.get_storage()
+        storage.set('a', {'a': 1})
+        storage.set('b', {'b': 2})
+        self.assertEqual(storage.get_many(['a', 'b', 'c']), {
+            'a': {'a': 1},
+            'b': {'b': 2},
+        })
+
+    def test_expired(self):
+        storage = self.get_storage(max_age=-1)
+        storage.set('foo', {'bar': 'baz'})
+        self.assertEqual(storage.get('foo'), None)
+        self.assertEqual(storage.get_many(['foo']), {})
+
+    def test_sweep(self):
+        storage = self.get_storage(max_age=-1)
+        storage.set('a', {'a': 1})
+        storage.set('b', {'b': 2})
+        storage.max_age = 60
+        storage.set('c', {'c': 3})
+        self.assertEqual(storage.sweep(), 2)
+        self.assertEqual(storage.get('c'), {'c': 3})
+        self.assertEqual(storage.sweep(), 0)
+
+
+class TestMemorySessionStorage(StorageTestMixin, test_utils.BaseTestCase):
+    def get_storage(self, max_age=60):
+        return MemorySessionStorage(max_age=max_age)
+
+    def test_capacity(self):
+        storage = MemorySessionStorage(capacity=2)
+        storage.set('a', {'a': 1})
+        storage.set('b', {'b': 2})
+        storage.get('a')
+        storage.set('c', {'c': 3})
+        self.assertEqual(storage.get('b'), None)
+        self.assertEqual(storage.get('a'), {'a': 1})
+
+
+class TestSQLiteSessionStorage(StorageTestMixin, test_utils.BaseTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        test_utils.BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        test_utils.BaseTestCase.tearDown(self)
+
+    def get_storage(self, max_age=60):
+        return SQLiteSessionStorage(os.path.join(self.tmpdir, 'test.sqlite'),
+            max_age=max_age)
+
+    def test_shared(self):
+        self.get_storage().set('foo', {'bar': 'baz'})
+        self.assertEqual(self.get_storage().get('foo'), {'bar': 'baz'})
+
+    def test_touch(self):
+        storage = self.get_storage()
+        storage.set('foo', {'bar': 'baz'})
+        storage.connection.execute('UPDATE sessions SET expires = ?',
+            (time.time() + 10,))
+        storage.get('foo')
+        expires = storage.connection.execute('SELECT expires FROM sessions '
+            'WHERE sid = ?', ('foo',)).fetchone()[0]
+        self.assertEqual(expires > time.time() + 50, True)
+
+
+class TestLocalSessions(test_utils.BaseTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        test_utils.BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        test_utils.BaseTestCase.tearDown(self)
+
+    def _get_app(self):
+        app = Tipfy([
+            Rule('/<backend>', name='session', handler=SessionHandler),
+        ], config={
+            'tipfy.sessions': {
+                'secret_key': 'secret',
+                'sqlite_filename': os.path.join(self.tmpdir, 'test.sqlite'),
+            },
+        })
+        store_class = app.session_store_class
+        backends = dict(store_class.default_backends)
+        backends.update({'memory': MemorySession, 'sqlite': SQLiteSession})
+        app.session_store_class = type(store_class.__name__, (store_class,),
+            {'default_backends': backends})
+        return app
+
+    def _test_backend(self, backend):
+        client = self._get_app().get_test_client()
+
+        response = client.get('/' + backend)
+        self.assertEqual(response.data, 'undefined')
+
+        response = client.get('/' + backend, headers={
+            'Cookie': '\n'.join(response.headers.getlist('Set-Cookie')),
+        })
+        self.assertEqual(response.data, 'a %s session value' % backend)
+
+    def test_memory_session(self):
+        self._test_backend('memory')
+
+    def test_sqlite_session(self):
+        self._test_backend('sqlite')
+
+    def test_invalid_sid(self):
+        app = self._get_app()
+        with app.get_test_context() as request:
+            response = Response()
+            request.session_store.set_secure_cookie(response, 'session',
+                {'_sid': '../foo'})
+
+        response = app.get_test_client().get('/memory', headers={
+            'Cookie': '\n'.join(response.headers.getlist('Set-Cookie')),
+        })
+        self.assertEqual(response.data, 'undefined')
+
+
+if __name__ == '__main__':
+    test_utils.main()
@@ -1,7 +1,11 @@
 from __future__ import with_statement
 
+from werkzeug import exceptions
+from werkzeug.routing import BuildError, RequestRedirect
+
 from tipfy import Tipfy, RequestHandler, Response
-from tipfy.routing import HandlerPrefix, NamePrefix, Router, Rule
+from tipfy.routing import (HandlerPrefix, NamePrefix, Router, Rule,
+    Subdomain)
 from tipfy.utils import url_for
 
 import test_utils
@@ -23,6 +27,283 @@ class TestRouter(test_utils.BaseTestCase):
         self.assertEqual(len(list(router.map.iter_rules())), 3)
 
 
+class TestAdapterCache(test_utils.BaseTestCase):
+    def _get_app(self, **config):
+        return Tipfy([
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+            Rule('/about', name='about', handler='resources.handlers.HomeHandler'),
+            Subdomain('<subdomain>', [
+                Rule('/', name='subdomain-home', handler='resources.handlers.HomeHandler'),
+            ]),
+        ], config={'tipfy': config})
+
+    def test_reuse(self):
+        app = self._get_app()
+        router = app.router
+
+        request = app.request_class.from_values('/')
+        adapter1 = router.get_adapter(request)
+        self.assertEqual(len(router.adapters), 1)
+
+        request = app.request_class.from_values('/about', method='POST')
+        adapter2 = router.get_adapter(request)
+        self.assertEqual(len(router.adapters), 1)
+
+        self.assertEqual(adapter1 is adapter2, False)
+        self.assertEqual(adapter1.path_info, '/')
+        self.assertEqual(adapter1.default_method, 'GET')
+        self.assertEqual(adapter2.path_info, '/about')
+        self.assertEqual(adapter2.default_method, 'POST')
+
+        rule, rule_args = router.match(request)
+        self.assertEqual(rule.name, 'about')
+        self.assertEqual(request.rule_adapter.build('home'), '/')
+
+    def test_subdomains(self):
+        app = self._get_app(server_name='example.com')
+        router = app.router
+
+        request = app.request_class.from_values('/',
+            base_url='http://foo.example.com')
+        rule, rule_args = router.match(request)
+        self.assertEqual(rule.name, 'subdomain-home')
+        self.assertEqual(rule_args, {'subdomain': 'foo'})
+
+        request = app.request_class.from_values('/',
+            base_url='http://bar.example.com')
+        rule, rule_args = router.match(request)
+        self.assertEqual(rule.name, 'subdomain-home')
+        self.assertEqual(rule_args, {'subdomain': 'bar'})
+        self.assertEqual(len(router.adapters), 2)
+
+        request = app.request_class.from_values('/',
+            base_url='http://example.com')
+        rule, rule_args = router.match(request)
+        self.assertEqual(rule.name, 'home')
+        self.assertEqual(request.rule_adapter.build('subdomain-home',
+            {'subdomain': 'baz'}), 'http://baz.example.com/')
+
+    def test_eviction(self):
+        app = self._get_app()
+        router = app.router
+        router.adapters.capacity = 2
+
+        for host in ('foo.com', 'bar.com', 'baz.com'):
+            request = app.request_class.from_values('/',
+                base_url='http://%s' % host)
+            router.get_adapter(request)
+
+        self.assertEqual(len(router.adapters), 2)
+
+
+class TestRuleIndex(test_utils.BaseTestCase):
+    def _get_router(self):
+        app = Tipfy([
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+            Rule('/about', name='about', handler='AboutHandler'),
+            Rule('/blog/', name='blog', handler='BlogHandler'),
+            Rule('/blog/<int:year>/<slug>', name='post', handler='PostHandler', methods=['GET']),
+            Rule('/blog/<int:year>/<slug>', name='post-edit', handler='PostHandler', methods=['PUT']),
+            Rule('/all/', name='pages', handler='PagesHandler', defaults={'page': 1}),
+            Rule('/all/page/<int:page>', name='pages', handler='PagesHandler'),
+            Rule('/files/<path:path>', name='files', handler='FilesHandler'),
+            Rule('/old/<slug>', redirect_to='blog/2010/<slug>'),
+            Subdomain('api', [
+                Rule('/', name='api-home', handler='ApiHandler'),
+            ]),
+        ])
+        return app.router
+
+    def _match(self, router, path, method='GET', subdomain=''):
+        adapter = router.map.bind('localhost', subdomain=subdomain)
+        return router.get_rule_index().match(adapter, path, method)
+
+    def test_static(self):
+        router = self._get_router()
+        rule, rule_args = self._match(router, '/about')
+        self.assertEqual(rule.name, 'about')
+        self.assertEqual(rule_args, {})
+
+        rule, rule_args = self._match(router, '/blog/')
+        self.assertEqual(rule.name, 'blog')
+
+    def test_variables(self):
+        router = self._get_router()
+        rule, rule_args = self._match(router, '/blog/2010/foo')
+        self.assertEqual(rule.name, 'post')
+        self.assertEqual(rule_args, {'year': 2010, 'slug': 'foo'})
+
+        rule, rule_args = self._match(router, '/blog/2010/foo', 'PUT')
+        self.assertEqual(rule.name, 'post-edit')
+
+    def test_fallback(self):
+        router = self._get_router()
+        rule, rule_args = self._match(router, '/files/foo/bar/baz')
+        self.assertEqual(rule.name, 'files')
+        self.assertEqual(rule_args, {'path': 'foo/bar/baz'})
+
+    def test_subdomain(self):
+        router = self._get_router()
+        rule, rule_args = self._match(router, '/', subdomain='api')
+        self.assertEqual(rule.name, 'api-home')
+
+        rule, rule_args = self._match(router, '/')
+        self.assertEqual(rule.name, 'home')
+
+    def test_not_found(self):
+        router = self._get_router()
+        self.assertRaises(exceptions.NotFound, self._match, router, '/foo')
+        self.assertRaises(exceptions.NotFound, self._match, router,
+            '/blog/foo/bar')
+
+    def test_method_not_allowed(self):
+        router = self._get_router()
+        router.add(Rule('/contact', name='contact', handler='ContactHandler',
+            methods=['POST']))
+
+        try:
+            self._match(router, '/contact')
+            self.fail('MethodNotAllowed was not raised.')
+        except exceptions.MethodNotAllowed, e:
+            self.assertEqual(e.valid_methods, ['POST'])
+
+    def test_redirects(self):
+        router = self._get_router()
+        # Missing trailing slash.
+        try:
+            self._match(router, '/blog')
+            self.fail('RequestRedirect was not raised.')
+        except RequestRedirect, e:
+            self.assertEqual(e.new_url, 'http://localhost/blog/')
+
+        # Rule defaults.
+        try:
+            self._match(router, '/all/page/1')
+            self.fail('RequestRedirect was not raised.')
+        except RequestRedirect, e:
+            self.assertEqual(e.new_url, 'http://localhost/all/')
+
+        # Rule redirect_to.
+        try:
+            self._match(router, '/old/foo')
+            self.fail('RequestRedirect was not raised.')
+        except RequestRedirect, e:
+            self.assertEqual(e.new_url, 'http://localhost/blog/2010/foo')
+
+    def test_same_as_werkzeug(self):
+        router = self._get_router()
+        adapter = router.map.bind('localhost')
+        index = router.get_rule_index()
+
+        def match(func, *args):
+            try:
+                rule, rule_args = func(*args)
+                return rule, rule_args
+            except exceptions.HTTPException, e:
+                return e.__class__, getattr(e, 'new_url', None)
+
+        for path in ('/', '/about', '/about/', '/blog', '/blog/', '/blog/1',
+            '/blog/1/foo', '/blog/1/foo/', '/all/', '/all/page/2', '/files',
+            '/files/a/b', '/old/foo', '/foo'):
+            for method in ('GET', 'POST', 'PUT'):
+                self.assertEqual(match(index.match, adapter, path, method),
+                    match(adapter.match, path, method, True))
+
+    def test_rebuild_after_add(self):
+        router = self._get_router()
+        index = router.get_rule_index()
+        self.assertEqual(router.get_rule_index() is index, True)
+
+        router.add(Rule('/contact', name='contact', handler='ContactHandler'))
+        self.assertEqual(router.get_rule_index() is index, False)
+        rule, rule_args = self._match(router, '/contact')
+        self.assertEqual(rule.name, 'contact')
+
+    def test_disabled(self):
+        class MyRouter(Router):
+            rule_index_class = None
+
+        class MyApp(Tipfy):
+            router_class = MyRouter
+
+        app = MyApp([
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+        ])
+        self.assertEqual(app.router.get_rule_index(), None)
+
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'Hello, World!')
+
+    def test_build(self):
+        router = self._get_router()
+        adapter = router.map.bind('localhost', script_name='/app')
+        index = router.get_rule_index()
+
+        self.assertEqual(index.build(adapter, 'home'), '/app/')
+        self.assertEqual(index.build(adapter, 'post', {'year': 2010,
+            'slug': 'foo'}), '/app/blog/2010/foo')
+        self.assertEqual(index.build(adapter, 'post', {'year': 2010,
+            'slug': 'foo', 'page': 2}), '/app/blog/2010/foo?page=2')
+        self.assertEqual(index.build(adapter, 'pages'), '/app/all/')
+        self.assertEqual(index.build(adapter, 'pages', {'page': 2}),
+            '/app/all/page/2')
+        self.assertEqual(index.build(adapter, 'post-edit', {'year': 2010,
+            'slug': 'foo'}, method='PUT'), '/app/blog/2010/foo')
+        self.assertEqual(index.build(adapter, 'home', force_external=True),
+            'http://localhost/app/')
+        self.assertEqual(index.build(adapter, 'api-home'),
+            'http://api.localhost/app/')
+        self.assertRaises(BuildError, index.build, adapter, 'post',
+            {'year': 2010})
+        self.assertRaises(BuildError, index.build, adapter, 'foo')
+
+    def test_build_same_as_werkzeug(self):
+        router = self._get_router()
+        adapter = router.map.bind('localhost', script_name='/app')
+        index = router.get_rule_index()
+
+        def build(func, *args):
+            try:
+                return func(*args)
+            except BuildError, e:
+                return BuildError
+
+        for endpoint, values in (
+            ('home', {}),
+            ('home', {'foo': 'bar', 'baz': [1, 2]}),
+            ('about', {'q': u'a\xe7\xe3o'}),
+            ('post', {'year': 2010, 'slug': 'foo bar'}),
+            ('post', {'year': 2010}),
+            ('pages', {}),
+            ('pages', {'page': 1}),
+            ('pages', {'page': 3, 'sort': 'name'}),
+            ('files', {'path': 'a/b c/d'}),
+            ('api-home', {'key': 'value'}),
+        ):
+            for method in (None, 'GET', 'PUT'):
+                for external in (False, True):
+                    # Call twice to check the cached builders too.
+                    for i in range(2):
+                        self.assertEqual(build(index.build, adapter,
+                            endpoint, values, method, external),
+                            build(adapter.build, endpoint, values, method,
+                            external))
+
+    def test_url_for(self):
+        app = self._get_router().app
+
+        with app.get_test_handler('/') as handler:
+            self.assertEqual(url_for('post', year=2010, slug='foo'),
+                '/blog/2010/foo')
+            self.assertEqual(url_for('post', year=2010, slug='foo',
+                _full=True, _anchor='top'),
+                'http://localhost/blog/2010/foo#top')
+            self.assertEqual(url_for('post-edit', year=2010, slug='foo',
+                _method='PUT', _scheme='https', _netloc='example.com'),
+                'https://example.com/blog/2010/foo')
+
+
 class TestRouting(test_utils.BaseTestCase):
     #==========================================================================
     # HandlerPrefix
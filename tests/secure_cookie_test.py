@@ -1,3 +1,6 @@
+from __future__ import with_statement
+
+import logging
 import time
 import unittest
 
@@ -50,6 +53,125 @@ class TestSecureCookie(test_utils.BaseTestCase):
         request = Request.from_values('/', headers=[('Cookie', 'session="eyJmb28iOiJiYXIifQ==|1284849476|847b472f2fabbf1efef55748a394b6f182acd8be"; Path=/')])
         self.assertEqual(store.get_cookie(request, 'session'), {'foo': 'bar'})
 
+    def test_get_cookie_invalid_hex_signature(self):
+        store = SecureCookieStore('secret')
+        request = Request.from_values('/', headers=[('Cookie', 'session="eyJmb28iOiJiYXIifQ==|1284849476|847b472f2fabbf1efef55748a394b6f182acd8b"; Path=/')])
+        self.assertEqual(store.get_cookie(request, 'session'), None)
+
+    def test_get_cookie_non_ascii_signature(self):
+        store = SecureCookieStore('secret')
+        request = Request.from_values('/', headers=[('Cookie', 'session="abc|123|\xc3\xa9\xc3\xa9"; Path=/')])
+        self.assertEqual(store.get_cookie(request, 'session'), None)
+        self.assertEqual(store._decode('session', u'abc|123|\xe9\xe9'), None)
+
+    def test_get_cookie_cached(self):
+        store = SecureCookieStore('secret')
+        value = store.get_signed_value('session', {'foo': ['bar']})
+        request = Request.from_values('/', headers=[('Cookie', 'session="%s"; Path=/' % value)])
+        cookie = store.get_cookie(request, 'session')
+        self.assertEqual(cookie, {'foo': ['bar']})
+        self.assertEqual(len(store._cache), 1)
+
+        # Cached values are not changed by the caller.
+        cookie['foo'].append('baz')
+        self.assertEqual(store.get_cookie(request, 'session'), {'foo': ['bar']})
+        self.assertEqual(len(store._cache), 1)
+
+        # Expiration is still checked for cached values.
+        self.assertEqual(store.get_cookie(request, 'session', max_age=-10), None)
+
+        # The signature is bound to the cookie name.
+        request = Request.from_values('/', headers=[('Cookie', 'other="%s"; Path=/' % value)])
+        self.assertEqual(store.get_cookie(request, 'other'), None)
+        self.assertEqual(len(store._cache), 1)
+
+    def _get_cookie(self, store, value):
+        value = store.get_signed_value('session', value)
+        request = Request.from_values('/', headers=[('Cookie', 'session="%s"; Path=/' % value)])
+        return value, store.get_cookie(request, 'session')
+
+    def test_serializers(self):
+        data = {'foo': 'bar', 'baz': [1, 2.5, None, True], 'ding': {'a': u'\xe7'}}
+        for serializer in ('json', 'marshal'):
+            for threshold in (None, 10, 100000):
+                store = SecureCookieStore('secret', serializer=serializer,
+                    compress_threshold=threshold)
+                value, cookie = self._get_cookie(store, data)
+                self.assertEqual(cookie, data)
+
+    def test_compressed(self):
+        data = {'foo': ['bar'] * 100}
+        store = SecureCookieStore('secret', compress_threshold=100)
+        compressed, cookie = self._get_cookie(store, data)
+        self.assertEqual(compressed.startswith('jz.'), True)
+        self.assertEqual(cookie, data)
+
+        store = SecureCookieStore('secret')
+        value, cookie = self._get_cookie(store, data)
+        self.assertEqual(len(compressed) < len(value), True)
+
+        store = SecureCookieStore('secret', serializer='marshal',
+            compress_threshold=100)
+        value, cookie = self._get_cookie(store, data)
+        self.assertEqual(value.startswith('mz.'), True)
+        self.assertEqual(cookie, data)
+
+    def test_old_format(self):
+        # JSON cookies are not tagged, like in previous versions.
+        store = SecureCookieStore('secret')
+        value, cookie = self._get_cookie(store, {'foo': 'bar'})
+        self.assertEqual(value.split('|')[0], 'eyJmb28iOiJiYXIifQ==')
+
+        # Any serializer can read the previous format.
+        store = SecureCookieStore('secret', serializer='marshal',
+            compress_threshold=1)
+        request = Request.from_values('/', headers=[('Cookie', 'session="eyJmb28iOiJiYXIifQ==|1284849476|847b472f2fabbf1efef55748a394b6f182acd8be"; Path=/')])
+        self.assertEqual(store.get_cookie(request, 'session'), {'foo': 'bar'})
+
+    def test_size_warning(self):
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        logger = logging.getLogger()
+        handler = Handler()
+        logger.addHandler(handler)
+        try:
+            store = SecureCookieStore('secret')
+            store.set_cookie(Response(), 'session', {'foo': 'bar'})
+            self.assertEqual(records, [])
+
+            store.set_cookie(Response(), 'session', {'foo': 'b' * 4000})
+            self.assertEqual(len(records), 1)
+            self.assertEqual('may be rejected' in records[0], True)
+        finally:
+            logger.removeHandler(handler)
+
+    def test_invalid_serializer(self):
+        self.assertRaises(KeyError, SecureCookieStore, 'secret', 'foo')
+
+    def test_session_store_config(self):
+        app = Tipfy(config={
+            'tipfy.sessions': {
+                'secret_key': 'something very secret',
+                'serializer': 'marshal',
+                'compress_threshold': 1024,
+            }
+        })
+        with app.get_test_context() as request:
+            store = request.session_store.secure_cookie_store
+            self.assertEqual(store.serializer, 'marshal')
+            self.assertEqual(store.compress_threshold, 1024)
+
+    def test_store_is_shared(self):
+        app = self._get_app()
+        with app.get_test_context() as request:
+            store = request.session_store.secure_cookie_store
+
+        with app.get_test_context() as request:
+            self.assertEqual(request.session_store.secure_cookie_store is store, True)
+
 
 if __name__ == '__main__':
     test_utils.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.server
+"""
+import os
+import signal
+import time
+import urllib2
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.server import PreforkServer, get_cpu_count
+
+import test_utils
+
+
+class PidHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response(str(os.getpid()))
+
+
+warmed_up = []
+
+def warmup(app):
+    warmed_up.append(app)
+
+
+class TestPreforkServer(test_utils.BaseTestCase):
+    def _get_app(self):
+        return Tipfy([
+            Rule('/', name='home', handler=PidHandler),
+        ])
+
+    def test_config(self):
+        app = self._get_app()
+        server = PreforkServer(app)
+        self.assertEqual(server.config['port'], 8080)
+        self.assertEqual(server.config['workers'], get_cpu_count())
+
+        server = PreforkServer(app, port=9000, workers=2)
+        self.assertEqual(server.config['port'], 9000)
+        self.assertEqual(server.config['workers'], 2)
+
+    def test_warmup(self):
+        app = self._get_app()
+        server = PreforkServer(app, warmup=[warmup,
+            'server_test.warmup'])
+        server.warmup()
+        self.assertEqual(warmed_up, [app, app])
+        self.assertEqual(len(app.router.dispatch_plans), 1)
+        self.assertEqual(app.config.frozen, True)
+        del warmed_up[:]
+
+    def test_run(self):
+        app = self._get_app()
+        server = PreforkServer(app, port=0, workers=2, max_requests=2,
+            graceful_timeout=5)
+        server.bind()
+        port = server.socket.getsockname()[1]
+
+        pid = os.fork()
+        if not pid:
+            try:
+                server.run()
+            finally:
+                os._exit(0)
+
+        server.socket.close()
+        try:
+            pids = set()
+            for i in range(8):
+                url = 'http://127.0.0.1:%d/' % port
+                pids.add(int(urllib2.urlopen(url, timeout=10).read()))
+
+            # Workers were replaced after serving two requests each.
+            self.assertEqual(len(pids) >= 4, True)
+            self.assertEqual(pid in pids, False)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            for i in range(100):
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    break
+
+                time.sleep(0.1)
+            else:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                self.fail('Server did not stop.')
+
+
+if __name__ == '__main__':
+    test_utils.main()
@@ -1,8 +1,15 @@
 from __future__ import with_statement
 
+import base64
+import datetime
 import os
+import pickle
+import time
 import unittest
 
+from google.appengine.api import memcache
+from google.appengine.ext import db, deferred
+
 from werkzeug import cached_property
 
 from tipfy.app import App, Request, Response
@@ -13,7 +20,7 @@ from tipfy.routing import Rule
 from tipfy.sessions import (SecureCookieSession, SecureCookieStore,
     SessionMiddleware, SessionStore)
 from tipfy.appengine.sessions import (DatastoreSession, MemcacheSession,
-    SessionModel)
+    SessionGC, SessionModel, TieredSession, _put_cached)
 
 import test_utils
 
@@ -129,6 +136,7 @@ class TestSessionStore(test_utils.BaseTestCase):
             'datastore':    DatastoreSession,
             'memcache':     MemcacheSession,
             'securecookie': SecureCookieSession,
+            'tiered':       TieredSession,
         })
         test_utils.BaseTestCase.setUp(self)
 
@@ -243,6 +251,102 @@ class TestSessionStore(test_utils.BaseTestCase):
         })
         self.assertEqual(response.data, 'a datastore session value')
 
+    def test_datastore_session_write_behind(self):
+        class MyHandler(BaseHandler):
+            def get(self):
+                session = self.session_store.get_session(backend='datastore')
+                res = session.get('test')
+                if not res:
+                    res = 'undefined'
+                    session['test'] = 'a datastore session value'
+
+                return Response(res)
+
+        rules = [Rule('/', name='test', handler=MyHandler)]
+
+        app = self._get_app('/')
+        app.config['tipfy.appengine.sessions']['write_behind'] = True
+        app.router.add(rules)
+        client = app.get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.data, 'undefined')
+        self.assertEqual(SessionModel.all().count(), 0)
+
+        # Read from memcache before the deferred write.
+        response = client.get('/', headers={
+            'Cookie': '\n'.join(response.headers.getlist('Set-Cookie')),
+        })
+        self.assertEqual(response.data, 'a datastore session value')
+
+        tasks = self.taskqueue_stub.GetTasks('default')
+        self.assertEqual(len(tasks), 1)
+
+    def test_get_tiered_session(self):
+        class MyHandler(BaseHandler):
+            def get(self):
+                session = self.session_store.get_session(backend='tiered')
+                res = session.get('test')
+                if not res:
+                    res = 'undefined'
+                    session['test'] = 'a tiered session value'
+
+                return Response(res)
+
+        rules = [Rule('/', name='test', handler=MyHandler)]
+
+        app = self._get_app('/')
+        app.router.add(rules)
+        client = app.get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.data, 'undefined')
+        cookie = '\n'.join(response.headers.getlist('Set-Cookie'))
+
+        # Read from the process cache, without memcache or datastore.
+        memcache.flush_all()
+        db.delete(SessionModel.all(keys_only=True).fetch(10))
+        response = client.get('/', headers={'Cookie': cookie})
+        self.assertEqual(response.data, 'a tiered session value')
+
+    def test_tiered_session_version(self):
+        app = self._get_app()
+        sid = TieredSession._get_new_sid()
+        SessionModel.create(sid, {'foo': 'bar'}).put()
+        TieredSession.get_cache(app)[sid] = ('1', time.time() + 60,
+            pickle.dumps({'foo': 'cached'}), None)
+
+        session = TieredSession._get_by_version(app, sid, '1')
+        self.assertEqual(session['foo'], 'cached')
+
+        # A different version is read again.
+        session = TieredSession._get_by_version(app, sid, '2')
+        self.assertEqual(session['foo'], 'bar')
+        self.assertEqual(TieredSession.get_cache(app)[sid][0], '2')
+
+    def test_datastore_session_unchanged(self):
+        sid = DatastoreSession._get_new_sid()
+        SessionModel.create(sid, {'foo': 'bar'}).put()
+
+        session = DatastoreSession._get_by_sid(sid)
+        self.assertEqual(session._is_changed(), False)
+
+        session['foo'] = 'bar'
+        self.assertEqual(session.modified, True)
+        self.assertEqual(session._is_changed(), False)
+
+        session['foo'] = 'baz'
+        self.assertEqual(session._is_changed(), True)
+
+    def test_datastore_session_stale(self):
+        sid = DatastoreSession._get_new_sid()
+        SessionModel.create(sid, {'foo': 'bar'}).put()
+
+        session = DatastoreSession._get_by_sid(sid)
+        self.assertEqual(session._is_stale(None), False)
+        self.assertEqual(session._is_stale(60), False)
+        self.assertEqual(session._is_stale(-1), True)
+
     def test_set_delete_cookie(self):
         class MyHandler(BaseHandler):
             def get(self):
@@ -412,6 +516,75 @@ class TestSessionStore(test_utils.BaseTestCase):
         self.assertEqual(response.data, 'a flash message value|a normal message value')
 
 
+class TestSessionGC(test_utils.BaseTestCase):
+    #: Number of synthetic expired sessions. Raise it to test with larger
+    #: volumes; the datastore stub gets slow with hundreds of thousands.
+    expired_count = 2000
+
+    def setUp(self):
+        test_utils.BaseTestCase.setUp(self)
+        self.app = App()
+        self.cutoff = self._create_sessions(self.expired_count)
+        self._create_sessions(100)
+
+    def _create_sessions(self, count):
+        for i in xrange(0, count, 500):
+            entities = [SessionModel.create(DatastoreSession._get_new_sid(),
+                {'foo': 'bar'}) for j in xrange(min(500, count - i))]
+            db.put(entities)
+            for entity in entities[:10]:
+                entity.set_cache()
+
+        return datetime.datetime.now()
+
+    def _run_tasks(self):
+        runs = 0
+        while True:
+            tasks = self.taskqueue_stub.GetTasks('default')
+            if not tasks:
+                return runs
+
+            self.taskqueue_stub.FlushQueue('default')
+            for task in tasks:
+                deferred.run(base64.b64decode(task['body']))
+                runs += 1
+
+    def test_gc(self):
+        mapper = SessionGC(rate=100000)
+        mapper._continue(None, self.cutoff)
+        self.assertEqual(mapper.deleted, self.expired_count)
+        self.assertEqual(SessionModel.all(keys_only=True).count(), 100)
+        self.assertEqual(self._run_tasks(), 0)
+
+    def test_gc_resume(self):
+        mapper = SessionGC(batch_size=200, rate=500)
+        mapper._continue(None, self.cutoff)
+        self.assertEqual(mapper.deleted, 500)
+        self.assertEqual(SessionModel.all(keys_only=True).count(),
+            self.expired_count - 500 + 100)
+
+        # Remaining sessions are deleted by tasks resuming from the cursor.
+        self.assertEqual(self._run_tasks(), self.expired_count / 500)
+        self.assertEqual(SessionModel.all(keys_only=True).count(), 100)
+
+    def test_gc_memcache(self):
+        sids = [key.name() for key in SessionModel.all(keys_only=True).filter(
+            'updated <', self.cutoff).fetch(10)]
+        self.assertEqual(len(memcache.get_multi(sids)), 10)
+
+        SessionGC(rate=100000)._continue(None, self.cutoff)
+        self.assertEqual(memcache.get_multi(sids), {})
+
+    def test_handler(self):
+        app = App(rules=[
+            Rule('/gc', name='gc',
+                handler='tipfy.appengine.sessions.SessionGCHandler'),
+        ])
+        response = app.get_test_client().get('/gc')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.taskqueue_stub.GetTasks('default')), 1)
+
+
 class TestSessionModel(test_utils.BaseTestCase):
     def setUp(self):
         self.app = App()
@@ -445,6 +618,24 @@ class TestSessionModel(test_utils.BaseTestCase):
         entity = SessionModel.get_by_sid(sid)
         self.assertEqual(entity, None)
 
+    def test_put_behind(self):
+        sid = 'test'
+        entity = SessionModel.create(sid, {'foo': 'bar'})
+        entity.put_behind()
+        entity = SessionModel.create(sid, {'foo': 'baz'})
+        entity.put_behind()
+
+        # Cached, but not saved yet.
+        self.assertEqual(SessionModel.get_cache(sid).data, {'foo': 'baz'})
+        self.assertEqual(SessionModel.get_by_key_name(sid), None)
+
+        # Writes are coalesced.
+        tasks = self.taskqueue_stub.GetTasks('default')
+        self.assertEqual(len(tasks), 1)
+
+        _put_cached(SessionModel, sid)
+        self.assertEqual(SessionModel.get_by_key_name(sid).data, {'foo': 'baz'})
+
 
 if __name__ == '__main__':
     test_utils.main()
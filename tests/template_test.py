@@ -16,6 +16,20 @@ class TestTemplate(test_utils.BaseTestCase):
         t = template.Template('<html>{{ myvalue }}</html>')
         self.assertEqual(t.generate(myvalue='XXX'), '<html>XXX</html>')
 
+    def test_generate_many(self):
+        t = template.Template('{% if defined %}{{ value }}{% end %}'
+            '{% apply squeeze %}{{ escape(value) }}  x{% end %}')
+        self.assertEqual(t.generate(defined=True, value='<a>'),
+            '<a>&lt;a&gt; x')
+        self.assertEqual(t.generate(defined=False, value='b'), 'b x')
+        # Variables from previous renders are not kept.
+        self.assertRaises(NameError, t.generate, defined=True)
+
+    def test_generate_override_namespace(self):
+        t = template.Template('{{ escape(value) }}')
+        self.assertEqual(t.generate(value='<a>', escape=lambda v: v), '<a>')
+        self.assertEqual(t.generate(value='<a>'), '&lt;a&gt;')
+
     def test_loader(self):
         loader = template.Loader(TEMPLATES_DIR)
         t = loader.load('template_tornado1.html')
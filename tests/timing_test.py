@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.timing
+"""
+import logging
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.sessions import SessionMiddleware
+from tipfy.timing import RequestTimer, request_timed
+
+import test_utils
+
+
+class HomeHandler(RequestHandler):
+    middleware = [SessionMiddleware()]
+
+    def get(self, **kwargs):
+        self.session['foo'] = 'bar'
+        return Response('Hello, World!')
+
+
+class TestRequestTimer(test_utils.BaseTestCase):
+    def test_get_timings(self):
+        timer = RequestTimer()
+        timer.phases = [
+            ('match', 1.0, 1.001),
+            ('render', 1.002, 1.004),
+            ('render', 1.005, 1.006),
+        ]
+        timings = timer.get_timings()
+        self.assertEqual([name for name, duration in timings],
+            ['match', 'render', 'total'])
+        self.assertAlmostEqual(timings[0][1], 1.0)
+        self.assertAlmostEqual(timings[1][1], 3.0)
+
+
+class TestTiming(test_utils.BaseTestCase):
+    def tearDown(self):
+        for receiver in list(request_timed.receivers_for(None)):
+            request_timed.disconnect(receiver)
+
+        test_utils.BaseTestCase.tearDown(self)
+
+    def _get_app(self, **config):
+        config['enable_timing'] = config.get('enable_timing', True)
+        return Tipfy([
+            Rule('/', name='home', handler=HomeHandler),
+        ], config={
+            'tipfy': config,
+            'tipfy.sessions': {'secret_key': 'secret'},
+        })
+
+    def test_disabled(self):
+        calls = []
+        def receiver(app, **kwargs):
+            calls.append(kwargs)
+
+        request_timed.connect(receiver)
+        app = self._get_app(enable_timing=False, timing_header=True)
+        response = app.get_test_client().get('/')
+        self.assertEqual(response.data, 'Hello, World!')
+        self.assertEqual(response.headers.get('Server-Timing'), None)
+        self.assertEqual(calls, [])
+
+    def test_signal(self):
+        calls = []
+        def receiver(app, request=None, response=None, timings=None):
+            calls.append((app, request.path, response.status_code, timings))
+
+        request_timed.connect(receiver)
+        app = self._get_app()
+        response = app.get_test_client().get('/')
+        self.assertEqual(response.data, 'Hello, World!')
+        self.assertEqual(response.headers.get('Server-Timing'), None)
+        self.assertEqual(len(calls), 1)
+
+        sender, path, status, timings = calls[0]
+        self.assertEqual(sender, app)
+        self.assertEqual(path, '/')
+        self.assertEqual(status, 200)
+        self.assertEqual([name for name, duration in timings], ['match',
+            'import', 'before_dispatch', 'method', 'session_save',
+            'after_dispatch', 'handler', 'total'])
+
+    def test_header(self):
+        app = self._get_app(timing_header=True)
+        response = app.get_test_client().get('/')
+        header = response.headers.get('Server-Timing')
+        names = [value.split(';')[0] for value in header.split(', ')]
+        self.assertEqual(names[0], 'match')
+        self.assertEqual(names[-1], 'total')
+
+        # Also for errors.
+        response = app.get_test_client().get('/not-found')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.headers.get('Server-Timing').startswith(
+            'total;dur='), True)
+
+    def test_log(self):
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        logger = logging.getLogger('tipfy.timing')
+        handler = Handler()
+        logger.addHandler(handler)
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            app = self._get_app(timing_log=True)
+            app.get_test_client().get('/')
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].startswith('GET / 200 match='), True)
+        self.assertEqual(' total=' in records[0], True)
+
+
+if __name__ == '__main__':
+    test_utils.main()
@@ -36,6 +36,24 @@ __version_info__ = (1, 0)
 #: enable_debugger
 #:     True to enable the interactive debugger when in debug mode, False
 #:     otherwise. Default is True.
+#:
+#: enable_timing
+#:     True to record the time spent in each phase of a request. See
+#:     :mod:`tipfy.timing`. Default is False.
+#:
+#: timing_header
+#:     True to add a `Server-Timing` header with the recorded timings to
+#:     responses, if timing is enabled. Default is False.
+#:
+#: timing_log
+#:     True to log the recorded timings of each request, if timing is
+#:     enabled. Default is False.
+#:
+#: freeze_config
+#:     True to freeze the configuration when the app is initialized, making
+#:     it read-only and faster to look up on each request. See
+#:     :meth:`tipfy.config.Config.freeze`. All configuration must then be
+#:     passed to the app constructor. Default is False.
 default_config = {
     'auth_store_class':    'tipfy.appengine.auth.AuthStore',
     'i18n_store_class':    'tipfy.i18n.I18nStore',
@@ -43,10 +61,14 @@ default_config = {
     'server_name':         None,
     'default_subdomain':   '',
     'enable_debugger':     True,
+    'enable_timing':       False,
+    'timing_header':       False,
+    'timing_log':          False,
+    'freeze_config':       False,
 }
 
-from tipfy.app import (HTTPException, Request, Response, Tipfy, abort,
-    current_app, current_handler)
+from tipfy.app import (HTTPException, Request, Response, StreamingResponse,
+    Tipfy, abort, current_app, current_handler)
 from tipfy.handler import RequestHandler
 from tipfy.appengine import (APPENGINE, APPLICATION_ID, CURRENT_VERSION_ID,
     DEV_APPSERVER)
@@ -22,11 +22,13 @@ import werkzeug.exceptions
 import werkzeug.urls
 import werkzeug.utils
 import werkzeug.wrappers
+import werkzeug.wsgi
 
 from . import default_config
 from .config import Config, REQUIRED_VALUE
 from .local import current_app, current_handler, get_request, local
 from .routing import Router
+from .timing import RequestTimer
 
 #: Public interface.
 HTTPException = werkzeug.exceptions.HTTPException
@@ -51,6 +53,12 @@ class Request(werkzeug.wrappers.Request):
     rule = None
     #: Keyword arguments from the matched rule.
     rule_args = None
+    #: :class:`tipfy.routing.DispatchPlan` for the matched rule, if the
+    #: router was prepared.
+    dispatch_plan = None
+    #: :class:`tipfy.timing.RequestTimer` recording the request phases, if
+    #: timing is enabled.
+    timer = None
     #: A dictionary for request variables.
     registry = None
 
@@ -130,6 +138,49 @@ class Response(werkzeug.wrappers.Response):
     """A response object with default mimetype set to ``text/html``."""
     default_mimetype = 'text/html'
 
+    def get_app_iter(self, environ):
+        """Returns the application iterator for the given environ. If the
+        body must not be sent (e.g., for ``HEAD`` requests), the response
+        is closed immediately, so that streamed iterables are always closed.
+
+        :param environ:
+            A WSGI environment.
+        :returns:
+            A response iterable.
+        """
+        if environ['REQUEST_METHOD'] == 'HEAD' or \
+            100 <= self.status_code < 200 or self.status_code in (204, 304):
+            self.close()
+            return ()
+
+        return super(Response, self).get_app_iter(environ)
+
+
+class StreamingResponse(Response):
+    """A response that sends the chunks from an iterable to the WSGI server
+    as they are produced, without buffering the body in memory. For
+    example::
+
+        class ExportHandler(RequestHandler):
+            def get(self, **kwargs):
+                def generate():
+                    yield 'id,name\n'
+                    for entity in MyModel.all():
+                        yield '%d,%s\n' % (entity.key().id(), entity.name)
+
+                return StreamingResponse(generate(), mimetype='text/csv')
+
+    Handlers can also return a generator or iterator directly, and it is
+    streamed using :attr:`App.response_class`.
+
+    The iterable is closed when the WSGI server finishes sending the
+    response, and the request context locals are kept until then. As the
+    body is produced after the handler returns, exceptions raised by the
+    iterable can't be handled by the app. Accessing :attr:`data` raises a
+    ``RuntimeError`` instead of buffering the body.
+    """
+    implicit_sequence_conversion = False
+
 
 class RequestContext(object):
     """Sets and releases the context locals used during a request.
@@ -147,6 +198,7 @@ class RequestContext(object):
         """
         self.app = app
         self.environ = environ
+        self.deferred = False
 
     def __enter__(self):
         """Enters the request context.
@@ -163,10 +215,28 @@ class RequestContext(object):
 
         This will release the context locals except if an exception is caught
         in debug mode. In this case the locals are kept to be inspected.
+        If :meth:`defer_release` was called, the locals are released when the
+        response iterable is closed.
         """
+        if self.deferred:
+            return
+
         if exc_type is None or not self.app.debug:
             local.__release_local__()
 
+    def defer_release(self, app_iter):
+        """Keeps the context locals until a response iterable is closed.
+        This is used for streamed responses, which produce the body after
+        the request is dispatched.
+
+        :param app_iter:
+            A response iterable.
+        :returns:
+            A response iterable that releases the context locals when closed.
+        """
+        self.deferred = True
+        return werkzeug.wsgi.ClosingIterator(app_iter, local.__release_local__)
+
 
 class App(object):
     """The WSGI application."""
@@ -183,8 +253,14 @@ class App(object):
     router_class = Router
     #: Context class used when a request comes in.
     request_context_class = RequestContext
-
-    def __init__(self, rules=None, config=None, debug=False):
+    #: Class used to record the request phases, if timing is enabled.
+    timer_class = RequestTimer
+    #: A list of middleware instances used by all
+    #: :class:`tipfy.RequestHandler` classes, executed before the
+    #: middleware defined in each handler.
+    middleware = None
+
+    def __init__(self, rules=None, config=None, debug=False, eager=False):
         """Initializes the application.
 
         :param rules:
@@ -193,6 +269,11 @@ class App(object):
             Dictionary with configuration for the application modules.
         :param debug:
             True if this is debug mode, False otherwise.
+        :param eager:
+            If True, imports all handlers and resolves the handler methods
+            for each rule when the app is initialized, instead of doing it
+            lazily when requests come in. See
+            :meth:`tipfy.routing.Router.prepare`.
         """
         local.current_app = self
         self.debug = debug
@@ -201,12 +282,18 @@ class App(object):
         self.config = self.config_class(config, {'tipfy': default_config})
         self.router = self.router_class(self, rules)
 
+        if eager:
+            self.router.prepare()
+
+        if self.config['tipfy']['freeze_config']:
+            self.config.freeze()
+
         if debug:
             logging.getLogger().setLevel(logging.DEBUG)
 
     def __call__(self, environ, start_response):
         """Called when a request comes in."""
-        if self.debug and self.config['tipfy']['enable_debugger']:
+        if self.debug and self.config.cache['tipfy']['enable_debugger']:
             return self._debugged_wsgi_app(environ, start_response)
 
         return self.dispatch(environ, start_response)
@@ -233,7 +320,11 @@ class App(object):
             A callable accepting a status code, a list of headers and an
             optional exception context to start the response.
         """
-        with self.request_context_class(self, environ) as request:
+        context = self.request_context_class(self, environ)
+        with context as request:
+            if self.config.cache['tipfy']['enable_timing']:
+                request.timer = self.timer_class()
+
             try:
                 if request.method not in self.allowed_methods:
                     abort(501)
@@ -254,7 +345,15 @@ class App(object):
                     rv = werkzeug.exceptions.InternalServerError()
                     response = self.make_response(request, rv)
 
-            return response(environ, start_response)
+            if request.timer is not None:
+                request.timer.finish(self, request, response)
+
+            app_iter = response(environ, start_response)
+            if response.is_streamed and app_iter:
+                # The body is produced while the server iterates it.
+                app_iter = context.defer_release(app_iter)
+
+            return app_iter
 
     def handle_exception(self, request, exception):
         """Handles an exception. To set app-wide error handlers, define them
@@ -326,6 +425,9 @@ class App(object):
                 encoded to utf-8 as body.
               - a WSGI function: the function is called as WSGI application
                 and buffered as response object.
+              - a generator or iterator: a response is created with the
+                iterator as body, and the chunks are streamed to the WSGI
+                server. See :class:`StreamingResponse`.
               - None: a ValueError exception is raised.
 
             - If multiple arguments are passed, a response is created using
@@ -349,6 +451,9 @@ class App(object):
             if rv is None:
                 raise ValueError('RequestHandler did not return a response.')
 
+            if hasattr(rv, 'next') and not hasattr(rv, '__call__'):
+                return self.response_class(rv)
+
             return self.response_class.force_type(rv, request.environ)
 
         return self.response_class(*rv)
@@ -420,6 +525,17 @@ class App(object):
         """
         wsgiref.handlers.CGIHandler().run(self)
 
+    def serve(self, **kwargs):
+        """Runs the app outside App Engine using a preforking server with
+        multiple worker processes. See :class:`tipfy.server.PreforkServer`.
+
+        :param kwargs:
+            Options that override the ones configured for the
+            ``tipfy.server`` module, e.g., ``port`` or ``workers``.
+        """
+        from tipfy.server import PreforkServer
+        PreforkServer(self, **kwargs).run()
+
     @werkzeug.utils.cached_property
     def _debugged_wsgi_app(self):
         """Returns the WSGI app wrapped by an interactive debugger."""
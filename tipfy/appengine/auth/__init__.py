@@ -85,10 +85,14 @@ class MixedAuthStore(SessionAuthStore):
             # Bad auth id or token, no fallback: must log in again.
             return self.logout()
 
-        current_token = user.session_id
         if not user.check_session(session_token):
-            # Token didn't match.
-            return self.logout()
+            # The cached user may be outdated: check again.
+            user = self.reload_user_entity(auth_id)
+            if user is None or not user.check_session(session_token):
+                # Token didn't match.
+                return self.logout()
+
+        current_token = user.session_id
 
         # Successful login. Check if session id needs renewal.
         user.renew_session(max_age=self.config['session_max_age'])
@@ -11,12 +11,28 @@
 from __future__ import absolute_import
 
 import datetime
+import logging
+import time
 
+from google.appengine.api import memcache, taskqueue
 from google.appengine.ext import db
+from google.appengine.ext.deferred import defer
 
 from werkzeug import check_password_hash, generate_password_hash
 
 from tipfy.auth import create_session_id
+from tipfy.datastructures import LRUCache
+from tipfy.appengine.db import (get_protobuf_from_entity,
+    get_entity_from_protobuf)
+
+
+class UserAuthId(db.Model):
+    """Maps an auth_id, used as key name, to the username of a
+    :class:`User`. This allows users to be loaded by auth_id using key
+    lookups instead of queries.
+    """
+    #: Username of the user with this auth_id.
+    username = db.StringProperty(required=True, indexed=False)
 
 
 class User(db.Model):
@@ -48,14 +64,201 @@ class User(db.Model):
     session_id = db.StringProperty(required=True)
     # Auth token last renewal date.
     session_updated = db.DateTimeProperty(auto_now_add=True)
+    # Auth token replaced by the last renewal, still valid during the grace
+    # period.
+    previous_session_id = db.StringProperty(indexed=False)
+
+    #: Maximum number of users kept in the process cache, shared by all
+    #: requests served by an instance.
+    local_cache_size = 1000
+    #: Seconds to keep a user in the process cache. Changes saved by other
+    #: instances are seen after this time; changes saved by this instance
+    #: are seen immediately.
+    local_cache_ttl = 60
+    #: Prefix for cache keys.
+    cache_prefix = 'tipfy.auth.user'
+    #: Seconds after a session renewal in which the previous auth token is
+    #: still accepted, so that concurrent requests using it don't fail.
+    #: This is also the minimum interval between renewals of a user.
+    session_grace_period = 300
+
+    def __init__(self, *args, **kwargs):
+        super(User, self).__init__(*args, **kwargs)
+        # The auth_id stored in the UserAuthId index, updated by put() if
+        # it changes.
+        self._indexed_auth_id = self.auth_id
 
     @classmethod
-    def get_by_username(cls, username):
-        return cls.get_by_key_name(username)
+    def get_by_username(cls, username, local_cache=True):
+        """Returns a user given its username. Users are looked up in the
+        process cache, then memcache and finally datastore.
+
+        :param username:
+            Unique username.
+        :param local_cache:
+            False to skip the process cache.
+        :returns:
+            A user entity, or None.
+        """
+        user = cls.get_cache(username, local_cache)
+        if user is None:
+            user = cls.get_by_key_name(username)
+            if user is not None:
+                user.set_cache()
+
+        return user
 
     @classmethod
-    def get_by_auth_id(cls, auth_id):
-        return cls.all().filter('auth_id =', auth_id).get()
+    def get_by_auth_id(cls, auth_id, local_cache=True):
+        """Returns a user given its auth_id. The auth_id is mapped to a
+        username using a :class:`UserAuthId` entity, which is cached like
+        the user.
+
+        :param auth_id:
+            Authentication id.
+        :param local_cache:
+            False to skip the process cache.
+        :returns:
+            A user entity, or None.
+        """
+        key = cls._get_cache_key('auth_id', auth_id)
+        local = cls._get_local_cache()
+        username = None
+        if local_cache:
+            cached = local.get(key)
+            if cached is not None and cached[0] > time.time():
+                username = cached[1]
+
+        if username is None:
+            username = memcache.get(key)
+            if username is None:
+                index = UserAuthId.get_by_key_name(auth_id)
+                if index is not None:
+                    username = index.username
+                else:
+                    # Users created before the index existed.
+                    user = cls.all().filter('auth_id =', auth_id).get()
+                    if user is None:
+                        return None
+
+                    username = user.username
+                    cls._put_auth_id_index(auth_id, username)
+
+                memcache.set(key, username)
+
+            local[key] = (time.time() + cls.local_cache_ttl, username)
+
+        user = cls.get_by_username(username, local_cache)
+        if user is None or user.auth_id != auth_id:
+            # The index is outdated: fix it, so that this is only done once.
+            user = cls.all().filter('auth_id =', auth_id).get()
+            if user is None:
+                cls._delete_auth_id_index(auth_id)
+            else:
+                cls._put_auth_id_index(auth_id, user.username)
+
+        return user
+
+    @classmethod
+    def get_cache(cls, username, local_cache=True):
+        """Returns a user from the process cache or memcache.
+
+        :param username:
+            Unique username.
+        :param local_cache:
+            False to skip the process cache.
+        :returns:
+            A user entity, or None if it is not cached.
+        """
+        key = cls._get_cache_key('username', username)
+        local = cls._get_local_cache()
+        if local_cache:
+            cached = local.get(key)
+            if cached is not None and cached[0] > time.time():
+                return get_entity_from_protobuf(cached[1])
+
+        data = memcache.get(key)
+        if data is not None:
+            local[key] = (time.time() + cls.local_cache_ttl, data)
+            return get_entity_from_protobuf(data)
+
+    def set_cache(self):
+        """Saves this entity in the process cache and memcache."""
+        key = self._get_cache_key('username', self.username)
+        data = get_protobuf_from_entity(self)
+        memcache.set(key, data)
+        self._get_local_cache()[key] = (time.time() + self.local_cache_ttl,
+            data)
+
+    def delete_cache(self):
+        """Removes this entity from the process cache and memcache."""
+        key = self._get_cache_key('username', self.username)
+        memcache.delete(key)
+        self._get_local_cache().pop(key, None)
+
+    def put(self, **kwargs):
+        """Saves this entity and updates the cached copies. If the auth_id
+        changed, the :class:`UserAuthId` index is updated.
+
+        :returns:
+            The entity key.
+        """
+        key = super(User, self).put(**kwargs)
+        if self.auth_id != self._indexed_auth_id:
+            if self._indexed_auth_id:
+                self._delete_auth_id_index(self._indexed_auth_id,
+                    self.username)
+
+            self._put_auth_id_index(self.auth_id, self.username)
+            self._indexed_auth_id = self.auth_id
+
+        self.set_cache()
+        return key
+
+    def delete(self, **kwargs):
+        """Deletes this entity, its :class:`UserAuthId` index and the cached
+        copies.
+        """
+        super(User, self).delete(**kwargs)
+        for auth_id in set([self._indexed_auth_id, self.auth_id]):
+            if auth_id:
+                self._delete_auth_id_index(auth_id, self.username)
+
+        self.delete_cache()
+
+    @classmethod
+    def _put_auth_id_index(cls, auth_id, username):
+        UserAuthId(key_name=auth_id, username=username).put()
+        key = cls._get_cache_key('auth_id', auth_id)
+        memcache.set(key, username)
+        cls._get_local_cache().pop(key, None)
+
+    @classmethod
+    def _delete_auth_id_index(cls, auth_id, username=None):
+        if username is None:
+            db.delete(db.Key.from_path(UserAuthId.kind(), auth_id))
+        else:
+            # Keep it if the auth_id was assigned to another user meanwhile.
+            index = UserAuthId.get_by_key_name(auth_id)
+            if index is not None and index.username == username:
+                index.delete()
+
+        key = cls._get_cache_key('auth_id', auth_id)
+        memcache.delete(key)
+        cls._get_local_cache().pop(key, None)
+
+    @classmethod
+    def _get_cache_key(cls, name, value):
+        return '%s.%s:%s' % (cls.cache_prefix, name, value)
+
+    @classmethod
+    def _get_local_cache(cls):
+        # Created on first use, so that subclasses can set their own size.
+        cache = cls.__dict__.get('_local_cache')
+        if cache is None:
+            cache = cls._local_cache = LRUCache(cls.local_cache_size)
+
+        return cache
 
     @classmethod
     def create(cls, username, auth_id, **kwargs):
@@ -85,15 +288,21 @@ class User(db.Model):
             kwargs['password'] = generate_password_hash(kwargs['password'])
 
         def txn():
-            if cls.get_by_username(username) is not None:
+            if cls.get_by_key_name(username) is not None:
                 # Username already exists.
                 return None
 
             user = cls(**kwargs)
-            user.put()
+            # Cached after the transaction succeeds.
+            db.put(user)
             return user
 
-        return db.run_in_transaction(txn)
+        user = db.run_in_transaction(txn)
+        if user is not None:
+            cls._put_auth_id_index(auth_id, username)
+            user.set_cache()
+
+        return user
 
     def set_password(self, new_password):
         """Sets a new, plain password.
@@ -119,7 +328,8 @@ class User(db.Model):
         return False
 
     def check_session(self, session_id):
-        """Checks if an auth token is valid.
+        """Checks if an auth token is valid. The previous token is also
+        accepted during the grace period after a renewal.
 
         :param session_id:
             Token to be checked.
@@ -129,26 +339,58 @@ class User(db.Model):
         if self.session_id == session_id:
             return True
 
+        if session_id and self.previous_session_id == session_id:
+            grace = datetime.timedelta(seconds=self.session_grace_period)
+            return self.session_updated + grace > datetime.datetime.now()
+
         return False
 
     def renew_session(self, force=False, max_age=None):
         """Renews the session id if its expiration time has passed.
 
+        When not forced, the new session id is cached immediately and saved
+        to datastore in a deferred task. Only one renewal per user happens
+        during :attr:`session_grace_period`; concurrent requests keep the
+        current session id.
+
+        A forced renewal revokes the current session id immediately: the
+        previous one is not accepted during the grace period.
+
         :param force:
-            True to force the session id to be renewed, False to check
-            if the expiration time has passed.
+            True to force the session id to be renewed and saved
+            immediately, False to check if the expiration time has passed.
         :returns:
             None.
         """
-        if not force:
-            # Only renew the session id if it is too old.
-            expires = datetime.timedelta(seconds=max_age)
-            force = (self.session_updated + expires < datetime.datetime.now())
-
         if force:
-            self.session_id = create_session_id()
-            self.session_updated = datetime.datetime.now()
+            self._rotate_session()
+            self.previous_session_id = None
             self.put()
+            return
+
+        # Only renew the session id if it is too old.
+        expires = datetime.timedelta(seconds=max_age)
+        if self.session_updated + expires >= datetime.datetime.now():
+            return
+
+        key = self._get_cache_key('renew', self.username)
+        if not memcache.add(key, 1, time=self.session_grace_period):
+            # Already being renewed by another request.
+            return
+
+        self._rotate_session()
+        self.set_cache()
+        try:
+            defer(_put_session, self.__class__, self.key(), self.session_id,
+                self.previous_session_id, self.session_updated)
+        except taskqueue.Error:
+            logging.exception('Failed to defer session id renewal.')
+            self.put()
+
+    def _rotate_session(self):
+        self.previous_session_id = self.session_id
+        self.session_id = create_session_id()
+        self.session_updated = datetime.datetime.now()
 
     def __unicode__(self):
         """Returns this entity's username.
@@ -184,3 +426,35 @@ class User(db.Model):
             True if both entities don't have same key, False otherwise.
         """
         return not self.__eq__(obj)
+
+
+def _put_session(model, key, session_id, previous_session_id,
+    session_updated):
+    """Saves a renewed session id. Used by :meth:`User.renew_session`.
+
+    :param model:
+        The user model class.
+    :param key:
+        The user key.
+    :param session_id:
+        The new session id.
+    :param previous_session_id:
+        The replaced session id.
+    :param session_updated:
+        The renewal date.
+    """
+    def txn():
+        user = model.get(key)
+        if user is None or user.session_updated >= session_updated:
+            # Deleted or renewed again meanwhile.
+            return None
+
+        user.session_id = session_id
+        user.previous_session_id = previous_session_id
+        user.session_updated = session_updated
+        db.put(user)
+        return user
+
+    user = db.run_in_transaction(txn)
+    if user is not None:
+        user.set_cache()
@@ -8,17 +8,89 @@
     :copyright: 2011 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
+import datetime
+import logging
 import re
+import time
 import uuid
 
-from google.appengine.api import memcache
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from google.appengine.api import memcache, taskqueue
 from google.appengine.ext import db
+from google.appengine.ext.deferred import defer
+from google.appengine.runtime import DeadlineExceededError
 
+from tipfy import RequestHandler
+from tipfy.datastructures import LRUCache
 from tipfy.sessions import BaseSession
+from tipfy.appengine.taskqueue import Mapper
 
 from tipfy.appengine.db import (PickleProperty, get_protobuf_from_entity,
     get_entity_from_protobuf)
 
+#: Default configuration values for this module. Keys are:
+#:
+#: write_behind
+#:     If True, :class:`DatastoreSession` saves sessions to memcache
+#:     immediately and defers the datastore write to a task. Sessions saved
+#:     again before the task runs are written only once. Writes are lost if
+#:     the memcache entry is evicted before the task runs. Default is False.
+#:
+#: write_behind_delay
+#:     Seconds to wait before writing a session to the datastore, when
+#:     `write_behind` is enabled. Default is `10`.
+#:
+#: write_behind_queue
+#:     Name of the task queue used for deferred writes. Default is
+#:     `default`.
+#:
+#: touch_interval
+#:     If set, :class:`DatastoreSession` saves a session that was not
+#:     modified when it was last saved more than this number of seconds ago,
+#:     to keep its modification date (and cookie) fresh. If None, unmodified
+#:     sessions are never saved. Default is None.
+#:
+#: cache_size
+#:     Maximum number of sessions kept in the process cache by
+#:     :class:`TieredSession`. Default is `1000`.
+#:
+#: cache_ttl
+#:     Seconds a session is kept in the process cache by
+#:     :class:`TieredSession` before it is read again from memcache. Default
+#:     is `60`.
+#:
+#: gc_max_age
+#:     Sessions not saved for this number of seconds are deleted by
+#:     :class:`SessionGC`. Default is `604800` (one week).
+#:
+#: gc_batch_size
+#:     Number of sessions deleted at once by :class:`SessionGC`. Default is
+#:     `500`, the maximum for a datastore batch delete.
+#:
+#: gc_rate
+#:     Maximum number of sessions deleted per second by :class:`SessionGC`.
+#:     Default is `1000`.
+#:
+#: gc_queue
+#:     Name of the task queue used by :class:`SessionGC`. Default is
+#:     `default`.
+default_config = {
+    'write_behind':       False,
+    'write_behind_delay': 10,
+    'write_behind_queue': 'default',
+    'touch_interval':     None,
+    'cache_size':         1000,
+    'cache_ttl':          60,
+    'gc_max_age':         604800,
+    'gc_batch_size':      500,
+    'gc_rate':            1000,
+    'gc_queue':           'default',
+}
+
 # Validate session keys.
 _UUID_RE = re.compile(r'^[a-f0-9]{32}$')
 
@@ -95,6 +167,34 @@ class SessionModel(db.Model):
         self.set_cache()
         db.put(self)
 
+    def put_behind(self, delay=10, queue_name='default'):
+        """Updates the memcache entry and defers saving the session to the
+        datastore. If the session is saved again before the deferred write
+        runs, the last cached version is written once.
+
+        :param delay:
+            Seconds to wait before writing to the datastore.
+        :param queue_name:
+            Name of the task queue used for the deferred write.
+        """
+        # Set the modification date that the datastore write will set.
+        self.updated = datetime.datetime.now()
+        self.set_cache()
+
+        # Only one write is pending for a session. The marker expires in
+        # case the task never runs.
+        pending_key = _get_pending_key(self.sid)
+        if not memcache.add(pending_key, 1, time=delay * 2 + 60):
+            return
+
+        try:
+            defer(_put_cached, self.__class__, self.sid, _countdown=delay,
+                _queue=queue_name)
+        except taskqueue.Error:
+            logging.exception('Failed to defer session write.')
+            memcache.delete(pending_key)
+            db.put(self)
+
     def delete(self):
         """Deletes the session and the memcache entry."""
         self.delete_cache()
@@ -102,10 +202,14 @@ class SessionModel(db.Model):
 
 
 class AppEngineBaseSession(BaseSession):
-    __slots__ = BaseSession.__slots__ + ('sid',)
+    __slots__ = BaseSession.__slots__ + ('sid', 'loaded_data', 'updated')
 
     def __init__(self, data=None, sid=None, new=False):
         BaseSession.__init__(self, data, new)
+        # Serialized data when the session was loaded.
+        self.loaded_data = None
+        # Modification date when the session was loaded.
+        self.updated = None
         if new:
             self.sid = self.__class__._get_new_sid()
         elif sid is None:
@@ -130,6 +234,26 @@ class AppEngineBaseSession(BaseSession):
 
         return cls(new=True)
 
+    @classmethod
+    def _from_data(cls, data, sid, updated=None, loaded_data=None):
+        """Returns an existing session, keeping a copy of its data to check
+        if it changed when it is saved.
+        """
+        session = cls(data, sid)
+        session.loaded_data = loaded_data or _serialize(data)
+        session.updated = updated
+        return session
+
+    def _is_changed(self):
+        """Checks if the session data changed since it was loaded."""
+        if not self.modified:
+            return False
+
+        if self.loaded_data is None:
+            return True
+
+        return _serialize(dict(self)) != self.loaded_data
+
 
 class DatastoreSession(AppEngineBaseSession):
     """A session that stores data serialized in the datastore."""
@@ -140,17 +264,115 @@ class DatastoreSession(AppEngineBaseSession):
         """Returns a session given a session id."""
         entity = cls.model_class.get_by_sid(sid)
         if entity is not None:
-            return cls(entity.data, sid)
+            return cls._from_data(entity.data, sid, entity.updated)
 
         return cls(new=True)
 
     def save_session(self, response, store, name, **kwargs):
-        if not self.modified:
+        config = store.request.app.config.cache[__name__]
+        if not self._is_changed() and not self._is_stale(
+            config['touch_interval']):
             return
 
-        self.model_class.create(self.sid, dict(self)).put()
+        self._put(config)
         store.set_secure_cookie(response, name, {'_sid': self.sid}, **kwargs)
 
+    def _put(self, config):
+        """Saves the session entity, deferring the datastore write if
+        configured.
+        """
+        entity = self.model_class.create(self.sid, dict(self))
+        if config['write_behind']:
+            entity.put_behind(config['write_behind_delay'],
+                config['write_behind_queue'])
+        else:
+            entity.put()
+
+    def _is_stale(self, interval):
+        """Checks if an existing session was last saved more than `interval`
+        seconds ago.
+        """
+        if interval is None or self.updated is None:
+            return False
+
+        return self.updated < (datetime.datetime.now() -
+            datetime.timedelta(seconds=interval))
+
+
+class TieredSession(DatastoreSession):
+    """A datastore session also cached in a per-process cache, in front of
+    memcache. Each save stamps the session with a new version, stored in
+    the session cookie. A cached session is used only if its version matches
+    the one from the cookie, so sessions changed by other instances are
+    detected without a memcache call.
+    """
+    #: Session version, from the session cookie.
+    version = None
+
+    @classmethod
+    def get_session(cls, store, name=None, **kwargs):
+        if name:
+            cookie = store.get_secure_cookie(name)
+            if cookie is not None:
+                sid = cookie.get('_sid')
+                if sid and _is_valid_key(sid):
+                    return cls._get_by_version(store.request.app, sid,
+                        cookie.get('_v'))
+
+        return cls(new=True)
+
+    @classmethod
+    def _get_by_version(cls, app, sid, version):
+        """Returns a session given a session id and version, from the
+        process cache if possible.
+        """
+        cache = cls.get_cache(app)
+        cached = cache.get(sid)
+        if (cached is not None and version is not None and
+            cached[0] == version and cached[1] > time.time()):
+            session = cls._from_data(pickle.loads(cached[2]), sid,
+                cached[3], cached[2])
+        else:
+            session = cls._get_by_sid(sid)
+            if not session.new and version is not None:
+                cache[sid] = (version, time.time() +
+                    app.config.cache[__name__]['cache_ttl'],
+                    session.loaded_data, session.updated)
+
+        session.version = version
+        return session
+
+    @classmethod
+    def get_cache(cls, app):
+        """Returns the process cache for sessions of an app.
+
+        :param app:
+            A :class:`tipfy.app.App` instance.
+        :returns:
+            A :class:`tipfy.datastructures.LRUCache` mapping session ids to
+            tuples ``(version, expires, data, updated)``.
+        """
+        cache = app.registry.get('appengine.sessions.cache')
+        if cache is None:
+            cache = LRUCache(app.config[__name__]['cache_size'])
+            app.registry['appengine.sessions.cache'] = cache
+
+        return cache
+
+    def save_session(self, response, store, name, **kwargs):
+        config = store.request.app.config.cache[__name__]
+        if not self._is_changed() and not self._is_stale(
+            config['touch_interval']):
+            return
+
+        self._put(config)
+        self.version = uuid.uuid4().hex
+        self.get_cache(store.request.app)[self.sid] = (self.version,
+            time.time() + config['cache_ttl'], _serialize(dict(self)),
+            datetime.datetime.now())
+        store.set_secure_cookie(response, name, {'_sid': self.sid,
+            '_v': self.version}, **kwargs)
+
 
 class MemcacheSession(AppEngineBaseSession):
     """A session that stores data serialized in memcache."""
@@ -159,18 +381,188 @@ class MemcacheSession(AppEngineBaseSession):
         """Returns a session given a session id."""
         data = memcache.get(sid)
         if data is not None:
-            return cls(data, sid)
+            return cls._from_data(data, sid)
 
         return cls(new=True)
 
     def save_session(self, response, store, name, **kwargs):
-        if not self.modified:
+        if not self._is_changed():
             return
 
         memcache.set(self.sid, dict(self))
         store.set_secure_cookie(response, name, {'_sid': self.sid}, **kwargs)
 
 
+class SessionGC(Mapper):
+    """Deletes expired sessions from the datastore and memcache, using the
+    task queue. Sessions are queried by modification date using keys-only
+    queries and deleted in batches. Each task deletes up to `rate` sessions
+    and then adds a task to resume from the query cursor, delayed to not
+    exceed `rate` deletions per second.
+
+    Usually this is started by :class:`SessionGCHandler`, or manually::
+
+        from google.appengine.ext import deferred
+
+        deferred.defer(SessionGC(max_age=86400).run)
+    """
+    model = SessionModel
+
+    def __init__(self, max_age=604800, batch_size=500, rate=1000,
+        queue_name='default'):
+        """Initializes the mapper.
+
+        :param max_age:
+            Sessions not saved for this number of seconds are deleted.
+        :param batch_size:
+            Number of sessions deleted at once.
+        :param rate:
+            Maximum number of sessions deleted per second.
+        :param queue_name:
+            Name of the task queue used to continue the deletion.
+        """
+        Mapper.__init__(self)
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.rate = rate
+        self.queue_name = queue_name
+        #: Total number of deleted sessions.
+        self.deleted = 0
+
+    def map(self, key):
+        """Deletes a session.
+
+        :param key:
+            The session key.
+        """
+        return ([], [key])
+
+    def get_query(self, cutoff):
+        """Returns a keys-only query for sessions not saved since a given
+        date.
+
+        :param cutoff:
+            A ``datetime`` object.
+        """
+        q = self.model.all(keys_only=True)
+        q.filter('updated <', cutoff)
+        return q
+
+    def run(self, batch_size=None):
+        """Starts deleting expired sessions."""
+        if batch_size is not None:
+            self.batch_size = batch_size
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            seconds=self.max_age)
+        self._continue(None, cutoff)
+
+    def _batch_write(self):
+        """Deletes sessions from memcache and the datastore."""
+        if self.to_delete:
+            memcache.delete_multi([key.name() for key in self.to_delete])
+            self.deleted += len(self.to_delete)
+
+        Mapper._batch_write(self)
+
+    def _continue(self, cursor, cutoff):
+        """Deletes a number of expired sessions, starting from a query
+        cursor.
+        """
+        start = time.time()
+        count = 0
+        q = self.get_query(cutoff)
+        try:
+            while count < self.rate:
+                if cursor:
+                    q.with_cursor(cursor)
+
+                keys = q.fetch(min(self.batch_size, self.rate - count))
+                if not keys:
+                    self._batch_write()
+                    logging.info('Deleted %d expired sessions.' %
+                        self.deleted)
+                    self.finish()
+                    return
+
+                for key in keys:
+                    map_updates, map_deletes = self.map(key)
+                    self.to_put.extend(map_updates)
+                    self.to_delete.extend(map_deletes)
+
+                self._batch_write()
+                # Record where to resume only after the batch was deleted.
+                cursor = q.cursor()
+                count += len(keys)
+        except DeadlineExceededError:
+            # Keys not deleted are found again by the next task.
+            pass
+
+        # Wait so that no more than `rate` sessions are deleted per second.
+        countdown = max(0, float(count) / self.rate - (time.time() - start))
+        defer(self._continue, cursor, cutoff, _countdown=int(countdown + 0.5),
+            _queue=self.queue_name)
+
+
+class SessionGCHandler(RequestHandler):
+    """A handler that starts :class:`SessionGC` using the configured values.
+    Map it to a URL and call it from cron.
+
+    The setup for *cron.yaml* is:
+
+    .. code-block:: yaml
+
+       cron:
+       - description: delete expired sessions
+         url: /_tasks/sessions/gc
+         schedule: every 24 hours
+
+    The setup for *app.yaml* is:
+
+    .. code-block:: yaml
+
+       - url: /_tasks/.*
+         script: main.py
+         login: admin
+
+    The URL rule for urls.py is::
+
+        Rule('/_tasks/sessions/gc', name='tasks/sessions/gc',
+            handler='tipfy.appengine.sessions.SessionGCHandler')
+    """
+    #: The mapper class.
+    mapper_class = SessionGC
+
+    def get(self, **kwargs):
+        config = self.app.config[__name__]
+        mapper = self.mapper_class(max_age=config['gc_max_age'],
+            batch_size=config['gc_batch_size'], rate=config['gc_rate'],
+            queue_name=config['gc_queue'])
+        defer(mapper.run, _queue=config['gc_queue'])
+        return ''
+
+
+def _put_cached(model_class, sid):
+    """Saves the cached version of a session to the datastore. Called by
+    :meth:`SessionModel.put_behind` using a deferred task.
+    """
+    # Remove the marker first: saves after this schedule a new write.
+    memcache.delete(_get_pending_key(sid))
+    entity = model_class.get_cache(sid)
+    if entity is not None:
+        db.put(entity)
+
+
+def _get_pending_key(sid):
+    """Returns the memcache key that marks a pending session write."""
+    return sid + '.pending'
+
+
+def _serialize(data):
+    """Serializes session data to compare it with a previous version."""
+    return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+
 def _is_valid_key(key):
     """Check if a session key has the correct format."""
     return _UUID_RE.match(key.split('.')[-1]) is not None
@@ -10,6 +10,7 @@
 """
 from __future__ import absolute_import
 
+import inspect
 import uuid
 
 from werkzeug import abort
@@ -48,7 +49,9 @@ class BaseAuthStore(object):
     def __init__(self, request):
         self.request = request
         self.app = request.app
-        self.config = request.app.config[__name__]
+        self.config = request.app.config.cache[__name__]
+        # Users loaded during this request.
+        self._users = {}
 
     @cached_property
     def user_model(self):
@@ -110,14 +113,19 @@ class BaseAuthStore(object):
         :returns:
             The new entity if the username is available, None otherwise.
         """
-        return self.user_model.create(username, auth_id, **kwargs)
+        user = self.user_model.create(username, auth_id, **kwargs)
+        if user is not None:
+            self._users[('auth_id', auth_id)] = user
+            self._users[('username', username)] = user
+
+        return user
 
     def get_user_entity(self, username=None, auth_id=None):
         """Loads an user entity from datastore. Override this to implement
         a different loading method. This method will load the user depending
         on the way the user is being authenticated: for form authentication,
         username is used; for third party or App Engine authentication,
-        auth_id is used.
+        auth_id is used. Users are loaded once per request.
 
         :param username:
             Unique username.
@@ -127,9 +135,53 @@ class BaseAuthStore(object):
             A ``User`` model instance, or None.
         """
         if auth_id:
-            return self.user_model.get_by_auth_id(auth_id)
+            key = ('auth_id', auth_id)
         elif username:
-            return self.user_model.get_by_username(username)
+            key = ('username', username)
+        else:
+            return None
+
+        user = self._users.get(key)
+        if user is None:
+            if auth_id:
+                user = self.user_model.get_by_auth_id(auth_id)
+            else:
+                user = self.user_model.get_by_username(username)
+
+            if user is not None:
+                self._users[key] = user
+
+        return user
+
+    def reload_user_entity(self, auth_id):
+        """Loads an user entity again, skipping the process cache. This is
+        used when the session token doesn't match the loaded user, which
+        may be outdated if its session was renewed by another instance.
+
+        :param auth_id:
+            Unique authentication id.
+        :returns:
+            A ``User`` model instance, or None.
+        """
+        if self._user_model_has_local_cache:
+            user = self.user_model.get_by_auth_id(auth_id, local_cache=False)
+        else:
+            # Custom user models may not have a process cache.
+            user = self.user_model.get_by_auth_id(auth_id)
+
+        if user is None:
+            self._users.pop(('auth_id', auth_id), None)
+        else:
+            self._users[('auth_id', auth_id)] = user
+
+        return user
+
+    @cached_property
+    def _user_model_has_local_cache(self):
+        # True if the user model lookups accept the local_cache argument.
+        args, varargs, varkw, defaults = inspect.getargspec(
+            self.user_model.get_by_auth_id)
+        return varkw is not None or 'local_cache' in args
 
     @property
     def session(self):
@@ -281,10 +333,14 @@ class MultiAuthStore(SessionAuthStore):
             # Bad auth id or token, no fallback: must log in again.
             return
 
-        current_token = user.session_id
         if not user.check_session(session_token):
-            # Token didn't match.
-            return self.logout()
+            # The cached user may be outdated: check again.
+            user = self.reload_user_entity(auth_id)
+            if user is None or not user.check_session(session_token):
+                # Token didn't match.
+                return self.logout()
+
+        current_token = user.session_id
 
         # Successful login. Check if session id needs renewal.
         user.renew_session(max_age=self.config['session_max_age'])
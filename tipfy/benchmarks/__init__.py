@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.benchmarks
+    ~~~~~~~~~~~~~~~~
+
+    Benchmarks for tipfy internals. The request pipeline benchmarks are run
+    with::
+
+        $ python -m tipfy.benchmarks.suite --baseline=benchmarks.json
+
+    See :mod:`tipfy.benchmarks.suite` for the available options.
+
+    :copyright: 2011 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
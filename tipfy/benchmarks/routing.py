@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.benchmarks.routing
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the cost of matching URLs using :class:`tipfy.routing.RuleIndex`
+    and ``werkzeug.routing.MapAdapter.match()`` as the number of rules grows.
+    Run it with::
+
+        $ python -m tipfy.benchmarks.routing
+
+    :copyright: 2011 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import random
+import time
+
+from tipfy.routing import Map, Rule, RuleIndex
+
+#: Number of rules used in each run.
+RULE_COUNTS = (10, 100, 250, 500, 1000)
+
+
+def get_rules(count):
+    """Returns a list of rules, half of them static and half with variables.
+
+    :param count:
+        Number of rules to generate.
+    :returns:
+        A list of :class:`tipfy.routing.Rule` instances.
+    """
+    rules = []
+    for i in xrange(count):
+        if i % 2:
+            path = '/section%d/<int:id>/<slug>' % i
+        else:
+            path = '/section%d/page' % i
+
+        rules.append(Rule(path, name='rule-%d' % i, handler='Handler'))
+
+    return rules
+
+
+def get_paths(count, samples=200):
+    """Returns a list of paths matching random rules from :func:`get_rules`.
+
+    :param count:
+        Number of generated rules.
+    :param samples:
+        Number of paths to return.
+    :returns:
+        A list of paths.
+    """
+    paths = []
+    for i in xrange(samples):
+        i = random.randrange(count)
+        if i % 2:
+            paths.append('/section%d/%d/some-slug' % (i, i))
+        else:
+            paths.append('/section%d/page' % i)
+
+    return paths
+
+
+def time_match(match, adapter, paths, repeat=3):
+    """Returns the best average time, in microseconds, to match a path.
+
+    :param match:
+        A callable receiving ``(adapter, path)``.
+    :param adapter:
+        A bound ``werkzeug.routing.MapAdapter``.
+    :param paths:
+        A list of paths to be matched.
+    :param repeat:
+        Number of times the paths are matched. The best run is used.
+    :returns:
+        Time per match, in microseconds.
+    """
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for path in paths:
+            match(adapter, path)
+
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best / len(paths) * 1000000
+
+
+def run(rule_counts=RULE_COUNTS):
+    """Runs the benchmark.
+
+    :param rule_counts:
+        A list with the number of rules for each run.
+    :returns:
+        A list of tuples ``(rule_count, werkzeug_time, index_time)``, with
+        times in microseconds per match.
+    """
+    results = []
+    for count in rule_counts:
+        map = Map(get_rules(count))
+        adapter = map.bind('localhost')
+        index = RuleIndex(map)
+        paths = get_paths(count)
+
+        scan = time_match(lambda a, p: a.match(p, return_rule=True),
+            adapter, paths)
+        indexed = time_match(index.match, adapter, paths)
+        results.append((count, scan, indexed))
+
+    return results
+
+
+def main():
+    random.seed(0)
+    print '%8s %16s %16s' % ('rules', 'werkzeug (us)', 'indexed (us)')
+    for count, scan, indexed in run():
+        print '%8d %16.1f %16.1f' % (count, scan, indexed)
+
+
+if __name__ == '__main__':
+    main()
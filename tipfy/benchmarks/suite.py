@@ -0,0 +1,531 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.benchmarks.suite
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the overhead of the request pipeline. Each case builds an app
+    and drives :meth:`tipfy.app.App.dispatch` in-process with synthetic WSGI
+    environments, reporting requests per second and the median (p50) and
+    99th percentile (p99) latencies. Run it with::
+
+        $ python -m tipfy.benchmarks.suite --baseline=benchmarks.json
+
+    If a baseline file is given, results are compared with the previous run
+    and the command exits with an error if a case got slower than the
+    allowed tolerance. Otherwise the baseline is updated with the new
+    results. Cases that depend on libraries that are not installed (e.g.,
+    Jinja2 or Babel) are skipped.
+
+    :copyright: 2011 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+from __future__ import with_statement
+
+import datetime
+import logging
+import math
+import optparse
+import os
+import random
+import sys
+import timeit
+
+from werkzeug.test import EnvironBuilder
+
+from tipfy.app import App, Response
+from tipfy.handler import RequestHandler
+from tipfy.json import json_decode, json_encode
+from tipfy.routing import Rule, url_for
+from tipfy.benchmarks.routing import get_paths, get_rules
+
+#: Number of rules used in the routing cases.
+RULE_COUNTS = (10, 100, 250, 500, 1000)
+#: Number of middleware used in the middleware cases.
+MIDDLEWARE_DEPTHS = (0, 4, 8)
+#: Session backends measured in the session cases: ``{name: import_path}``.
+SESSION_BACKENDS = {
+    'securecookie': 'tipfy.sessions.SecureCookieSession',
+    'datastore':    'tipfy.appengine.sessions.DatastoreSession',
+    'memcache':     'tipfy.appengine.sessions.MemcacheSession',
+    'tiered':       'tipfy.appengine.sessions.TieredSession',
+    'memory':       'tipfy.sessions.MemorySession',
+    'sqlite':       'tipfy.sessions.SQLiteSession',
+}
+#: Default maximum slowdown, relative to the baseline.
+TOLERANCE = 0.25
+
+#: Config used by all benchmark apps.
+config = {
+    'tipfy.sessions': {
+        'secret_key': 'benchmark',
+        # Don't leave a database file behind.
+        'sqlite_filename': ':memory:',
+    },
+}
+
+#: Template used by the template cases, in tipfy.template syntax.
+TIPFY_TEMPLATE = """<html>
+<head><title>{{ title }}</title></head>
+<body>
+<ul>
+{% for item in items %}<li class="{{ item['class'] }}">{{ item['name'] }}</li>
+{% end %}</ul>
+</body>
+</html>"""
+
+#: Template used by the template cases, in Jinja2 syntax.
+JINJA2_TEMPLATE = """<html>
+<head><title>{{ title }}</title></head>
+<body>
+<ul>
+{% for item in items %}<li class="{{ item['class'] }}">{{ item['name'] }}</li>
+{% endfor %}</ul>
+</body>
+</html>"""
+
+
+class Benchmark(object):
+    """A benchmark case: an app and the WSGI environments used to call it."""
+    def __init__(self, name, app, environs):
+        """Initializes the benchmark.
+
+        :param name:
+            The case name, used as key in the baseline file.
+        :param app:
+            A :class:`tipfy.app.App` instance.
+        :param environs:
+            A list of WSGI environments, used in turns.
+        """
+        self.name = name
+        self.app = app
+        self.environs = environs
+
+    def call(self, environ):
+        """Calls the app and consumes the response body.
+
+        :param environ:
+            A WSGI environment.
+        :returns:
+            The response status.
+        """
+        status = []
+        def start_response(s, headers, exc_info=None):
+            status.append(s)
+
+        app_iter = self.app.dispatch(dict(environ), start_response)
+        try:
+            for chunk in app_iter:
+                pass
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+        return status[0]
+
+    def run(self, requests=1000, warmup=100):
+        """Runs the benchmark.
+
+        :param requests:
+            Number of measured requests.
+        :param warmup:
+            Number of requests made before measuring, to fill caches.
+        :returns:
+            A dictionary with the number of ``requests``, requests per second
+            (``rps``) and the ``p50`` and ``p99`` latencies in milliseconds.
+        """
+        environs = self.environs
+        for i in xrange(max(warmup, 1)):
+            status = self.call(environs[i % len(environs)])
+            if not status.startswith(('2', '3')):
+                raise RuntimeError('Benchmark %r returned %r.' % (self.name,
+                    status))
+
+        timer = timeit.default_timer
+        call = self.call
+        times = []
+        for i in xrange(requests):
+            environ = environs[i % len(environs)]
+            start = timer()
+            call(environ)
+            times.append(timer() - start)
+
+        times.sort()
+        return {
+            'requests': requests,
+            'rps':      requests / sum(times),
+            'p50':      percentile(times, 50) * 1000,
+            'p99':      percentile(times, 99) * 1000,
+        }
+
+
+class NoopMiddleware(object):
+    """A middleware that implements all hooks and does nothing."""
+    def before_dispatch(self, handler):
+        pass
+
+    def after_dispatch(self, handler, response):
+        return response
+
+    def handle_exception(self, handler, exception):
+        pass
+
+
+class HelloHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response('Hello, World!')
+
+
+def percentile(values, percent):
+    """Returns a percentile from a sorted list, using the nearest rank.
+
+    :param values:
+        A sorted list of values.
+    :param percent:
+        The percentile, from 0 to 100.
+    :returns:
+        The value at the percentile.
+    """
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def make_environ(path='/', method='GET', **kwargs):
+    """Returns a WSGI environment for a request.
+
+    :param path:
+        The request path.
+    :param method:
+        The request method.
+    :param kwargs:
+        Extra keyword arguments for ``werkzeug.test.EnvironBuilder``.
+    :returns:
+        A WSGI environment.
+    """
+    builder = EnvironBuilder(path, method=method, **kwargs)
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def make_app(rules, **kwargs):
+    """Returns an app using the benchmark config.
+
+    :param rules:
+        A list of :class:`tipfy.routing.Rule` instances.
+    :returns:
+        A :class:`tipfy.app.App` instance.
+    """
+    app_config = dict(config)
+    app_config.update(kwargs.pop('config', {}))
+    return App(rules, config=app_config, **kwargs)
+
+
+def get_routing_benchmarks(rule_counts=RULE_COUNTS):
+    """Returns benchmarks matching paths against a growing number of rules.
+
+    :param rule_counts:
+        A list with the number of rules for each case.
+    :returns:
+        A list of :class:`Benchmark` instances.
+    """
+    rv = []
+    for count in rule_counts:
+        rules = get_rules(count)
+        for rule in rules:
+            rule.handler = HelloHandler
+
+        environs = [make_environ(path) for path in get_paths(count)]
+        rv.append(Benchmark('routing.%d' % count, make_app(rules), environs))
+
+    return rv
+
+
+def get_middleware_benchmarks(depths=MIDDLEWARE_DEPTHS):
+    """Returns benchmarks for handlers with an increasing number of
+    middleware.
+
+    :param depths:
+        A list with the number of middleware for each case.
+    :returns:
+        A list of :class:`Benchmark` instances.
+    """
+    rv = []
+    for depth in depths:
+        handler = type('MiddlewareHandler%d' % depth, (HelloHandler,), {
+            'middleware': [NoopMiddleware() for i in xrange(depth)],
+        })
+        app = make_app([Rule('/', name='home', handler=handler)])
+        rv.append(Benchmark('middleware.%d' % depth, app, [make_environ()]))
+
+    return rv
+
+
+def get_session_benchmarks(backends=SESSION_BACKENDS):
+    """Returns benchmarks reading and saving a session for each backend.
+
+    :param backends:
+        A dictionary ``{name: import_path}`` of session backends. Backends
+        that can't be imported are skipped.
+    :returns:
+        A list of :class:`Benchmark` instances.
+    """
+    from werkzeug import import_string
+    from tipfy.sessions import SessionMiddleware
+
+    class SessionHandler(RequestHandler):
+        middleware = [SessionMiddleware()]
+
+        def get(self, **kwargs):
+            backend = self.request.rule_args['backend']
+            session = self.session_store.get_session(backend=backend)
+            session['count'] = session.get('count', 0) + 1
+            return Response('Hello, World!')
+
+    rv = []
+    for name in sorted(backends):
+        try:
+            backend = import_string(backends[name])
+        except ImportError, e:
+            logging.info('Skipping session backend %r: %s' % (name, e))
+            continue
+
+        app = make_app([
+            Rule('/<backend>', name='session', handler=SessionHandler),
+        ])
+        store_class = app.session_store_class
+        store_backends = dict(store_class.default_backends)
+        store_backends[name] = backend
+        app.session_store_class = type(store_class.__name__, (store_class,),
+            {'default_backends': store_backends})
+
+        # Make a first request to get a session cookie.
+        environ = make_environ('/%s' % name)
+        response = app.get_test_client().get('/%s' % name)
+        cookie = response.headers.get('Set-Cookie', '').split(';', 1)[0]
+        environ['HTTP_COOKIE'] = cookie
+        rv.append(Benchmark('sessions.%s' % name, app, [environ]))
+
+    return rv
+
+
+def get_template_benchmarks():
+    """Returns benchmarks rendering the same page using tipfy.template and
+    Jinja2, if it is installed.
+
+    :returns:
+        A list of :class:`Benchmark` instances.
+    """
+    from tipfy.template import Template
+
+    context = {
+        'title': 'Benchmark',
+        'items': [{'name': 'Item %d' % i, 'class': i % 2 and 'odd' or 'even'}
+            for i in xrange(100)],
+    }
+    template = Template(TIPFY_TEMPLATE)
+
+    class TipfyTemplateHandler(RequestHandler):
+        def get(self, **kwargs):
+            return Response(template.generate(**context))
+
+    rv = [Benchmark('templates.tipfy', make_app([
+        Rule('/', name='home', handler=TipfyTemplateHandler),
+    ]), [make_environ()])]
+
+    try:
+        from jinja2 import DictLoader
+        from tipfyext.jinja2 import Jinja2Mixin
+    except ImportError, e:
+        logging.info('Skipping Jinja2 templates: %s' % e)
+        return rv
+
+    class Jinja2TemplateHandler(RequestHandler, Jinja2Mixin):
+        def get(self, **kwargs):
+            return self.render_response('page.html', **context)
+
+    app = make_app([
+        Rule('/', name='home', handler=Jinja2TemplateHandler),
+    ], config={
+        'tipfyext.jinja2': {
+            'environment_args': {
+                'autoescape': True,
+                'loader': DictLoader({'page.html': JINJA2_TEMPLATE}),
+            },
+        },
+    })
+    rv.append(Benchmark('templates.jinja2', app, [make_environ()]))
+    return rv
+
+
+def get_i18n_benchmarks():
+    """Returns a benchmark formatting dates and numbers for the current
+    locale, if Babel and pytz are installed.
+
+    :returns:
+        A list of :class:`Benchmark` instances.
+    """
+    try:
+        import babel
+        import pytz
+    except ImportError, e:
+        logging.info('Skipping i18n: %s' % e)
+        return []
+
+    now = datetime.datetime(2011, 1, 1, 12, 30)
+
+    class I18nHandler(RequestHandler):
+        def get(self, **kwargs):
+            i18n = self.i18n
+            values = []
+            for i in xrange(20):
+                values.append(i18n.format_datetime(now))
+                values.append(i18n.format_date(now))
+                values.append(i18n.format_decimal(i * 1234.5))
+                values.append(i18n.format_currency(i * 10.5, 'USD'))
+
+            return Response(u'\n'.join(values))
+
+    app = make_app([Rule('/', name='home', handler=I18nHandler)], config={
+        'tipfy.i18n': {'locale': 'pt_BR', 'timezone': 'America/Sao_Paulo'},
+    })
+    return [Benchmark('i18n.format', app, [make_environ()])]
+
+
+def get_url_for_benchmarks(urls=100):
+    """Returns a benchmark for a page that builds many URLs.
+
+    :param urls:
+        Number of URLs built in each request.
+    :returns:
+        A list of :class:`Benchmark` instances.
+    """
+    class UrlForHandler(RequestHandler):
+        def get(self, **kwargs):
+            values = []
+            for i in xrange(urls):
+                if i % 2:
+                    values.append(url_for('rule-%d' % i, id=i, slug='slug'))
+                else:
+                    values.append(url_for('rule-%d' % i, page=i))
+
+            return Response('\n'.join(values))
+
+    rules = get_rules(urls)
+    rules.append(Rule('/', name='home', handler=UrlForHandler))
+    return [Benchmark('url_for.%d' % urls, make_app(rules), [make_environ()])]
+
+
+def get_benchmarks():
+    """Returns all benchmark cases.
+
+    :returns:
+        A list of :class:`Benchmark` instances.
+    """
+    return (get_routing_benchmarks() + get_middleware_benchmarks() +
+        get_session_benchmarks() + get_template_benchmarks() +
+        get_i18n_benchmarks() + get_url_for_benchmarks())
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Compares results with a baseline.
+
+    :param results:
+        A dictionary of results keyed by benchmark name.
+    :param baseline:
+        A dictionary of previous results keyed by benchmark name.
+    :param tolerance:
+        The maximum slowdown allowed, relative to the baseline. For example,
+        0.25 allows the requests per second to drop by 25%.
+    :returns:
+        A list of tuples ``(name, baseline_rps, rps)`` for the benchmarks
+        that got slower.
+    """
+    rv = []
+    for name in sorted(results):
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+
+        rps = results[name]['rps']
+        if rps < previous['rps'] * (1 - tolerance):
+            rv.append((name, previous['rps'], rps))
+
+    return rv
+
+
+def load_baseline(filename):
+    """Loads results saved by :func:`save_baseline`.
+
+    :param filename:
+        The baseline filename.
+    :returns:
+        A dictionary of results keyed by benchmark name, or an empty
+        dictionary if the file doesn't exist.
+    """
+    if not os.path.exists(filename):
+        return {}
+
+    with open(filename) as f:
+        return json_decode(f.read())
+
+
+def save_baseline(filename, results):
+    """Saves results to be used as baseline in the next run.
+
+    :param filename:
+        The baseline filename.
+    :param results:
+        A dictionary of results keyed by benchmark name.
+    """
+    with open(filename, 'w') as f:
+        f.write(json_encode(results, sort_keys=True, indent=2))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [name-prefix ...]')
+    parser.add_option('-b', '--baseline', metavar='FILE',
+        help='JSON file with the results of the previous run.')
+    parser.add_option('-t', '--tolerance', type='float', default=TOLERANCE,
+        help='Maximum slowdown allowed relative to the baseline '
+        '[default: %default].')
+    parser.add_option('-n', '--requests', type='int', default=1000,
+        help='Number of measured requests per case [default: %default].')
+    parser.add_option('-u', '--update', action='store_true', default=False,
+        help='Save results to the baseline even if there are regressions.')
+    options, prefixes = parser.parse_args(argv)
+
+    random.seed(0)
+    results = {}
+    print '%-24s %10s %10s %10s' % ('case', 'req/s', 'p50 (ms)', 'p99 (ms)')
+    for benchmark in get_benchmarks():
+        if prefixes and not benchmark.name.startswith(tuple(prefixes)):
+            continue
+
+        rv = results[benchmark.name] = benchmark.run(options.requests)
+        print '%-24s %10.0f %10.3f %10.3f' % (benchmark.name, rv['rps'],
+            rv['p50'], rv['p99'])
+
+    if not options.baseline:
+        return 0
+
+    baseline = load_baseline(options.baseline)
+    regressions = compare(results, baseline, options.tolerance)
+    if not regressions or options.update:
+        baseline.update(results)
+        save_baseline(options.baseline, baseline)
+
+    if regressions:
+        print
+        print 'REGRESSIONS (more than %d%% slower than %s):' % (
+            options.tolerance * 100, options.baseline)
+        for name, previous, rps in regressions:
+            print '    %-24s %10.0f -> %.0f req/s' % (name, previous, rps)
+
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -46,9 +46,21 @@ class Config(dict):
                 foo = self.get_config('my.module', 'foo')
 
                 # ...
+
+    After the app is set up, call :meth:`freeze` to resolve the default
+    configurations and make the configuration read-only, so that it can be
+    safely cached and looked up faster on each request. Code that reads a
+    module configuration on every request should use :attr:`cache`::
+
+        config = app.config.cache['my.module']
     """
-    #: Loaded module configurations.
+    #: Set of modules with loaded default configurations.
     loaded = None
+    #: True if the configuration was frozen by :meth:`freeze`.
+    frozen = False
+    #: A :class:`ConfigCache` to look up module configurations. After the
+    #: configuration is frozen, they are kept in a plain dictionary.
+    cache = None
 
     def __init__(self, values=None, defaults=None):
         """Initializes the configuration object.
@@ -59,7 +71,8 @@ class Config(dict):
             A dictionary of configuration dictionaries for initial default
             values. These modules are marked as loaded.
         """
-        self.loaded = []
+        self.loaded = set()
+        self.cache = ConfigCache(self)
         if values is not None:
             assert isinstance(values, dict)
             for module, config in values.iteritems():
@@ -69,7 +82,7 @@ class Config(dict):
             assert isinstance(defaults, dict)
             for module, config in defaults.iteritems():
                 self.setdefault(module, config)
-                self.loaded.append(module)
+                self.loaded.add(module)
 
     def __getitem__(self, module):
         """Returns the configuration for a module. If it is not already
@@ -86,13 +99,15 @@ class Config(dict):
         :returns:
             A configuration value.
         """
-        if module not in self.loaded:
-            # Load default configuration and update config.
-            values = import_string(module + '.default_config', silent=True)
-            if values:
-                self.setdefault(module, values)
+        if self.frozen:
+            # Modules are only set when they are loaded.
+            try:
+                return dict.__getitem__(self, module)
+            except KeyError:
+                pass
 
-            self.loaded.append(module)
+        if module not in self.loaded:
+            self._load(module)
 
         try:
             return dict.__getitem__(self, module)
@@ -108,6 +123,7 @@ class Config(dict):
             A dictionary of configurations for the module.
         """
         assert isinstance(values, dict), 'Module configuration must be a dict.'
+        self._check_frozen()
         dict.__setitem__(self, module, SubConfig(module, values))
 
     def get(self, module, default=DEFAULT_VALUE):
@@ -138,6 +154,7 @@ class Config(dict):
             The module configuration dictionary.
         """
         assert isinstance(values, dict), 'Module configuration must be a dict.'
+        self._check_frozen()
         if module not in self:
             module_dict = SubConfig(module)
             dict.__setitem__(self, module, module_dict)
@@ -158,6 +175,7 @@ class Config(dict):
             A dictionary of configurations for the module.
         """
         assert isinstance(values, dict), 'Module configuration must be a dict.'
+        self._check_frozen()
         if module not in self:
             module_dict = SubConfig(module)
             dict.__setitem__(self, module, module_dict)
@@ -166,6 +184,63 @@ class Config(dict):
 
         module_dict.update(values)
 
+    def freeze(self, modules=None):
+        """Makes the configuration read-only. The default configurations of
+        all configured modules (and optionally other modules) are loaded,
+        and module configurations become :class:`FrozenSubConfig`
+        instances. Modules accessed for the first time after this are still
+        loaded, and frozen as well.
+
+        This is intended to be called once when the app is set up. After
+        that, module configurations can't be changed, and looking them up
+        is a single dictionary access.
+
+        :param modules:
+            An optional list of module names to load, in addition to the
+            configured ones.
+        :returns:
+            This configuration object.
+        """
+        modules = set(self.iterkeys()).union(modules or ())
+        for module in modules:
+            if module not in self.loaded:
+                self._load(module)
+
+        for module, values in self.items():
+            if not isinstance(values, FrozenSubConfig):
+                dict.__setitem__(self, module, FrozenSubConfig(module,
+                    values))
+
+        self.frozen = True
+        return self
+
+    def _load(self, module):
+        """Loads the ``default_config`` variable from a module and sets the
+        missing values in the module configuration.
+
+        :param module:
+            The module name.
+        """
+        values = import_string(module + '.default_config', silent=True)
+        if values:
+            module_dict = dict.get(self, module)
+            if module_dict is None:
+                module_dict = SubConfig(module)
+
+            for key, value in values.iteritems():
+                dict.setdefault(module_dict, key, value)
+
+            if self.frozen:
+                module_dict = FrozenSubConfig(module, module_dict)
+
+            dict.__setitem__(self, module, module_dict)
+
+        self.loaded.add(module)
+
+    def _check_frozen(self):
+        if self.frozen:
+            raise TypeError('Configuration is frozen and can\'t be changed.')
+
     def get_config(self, module, key=None, default=REQUIRED_VALUE):
         """Returns a configuration value for a module and optionally a key.
         Will raise a KeyError if they the module is not configured or the key
@@ -188,17 +263,47 @@ class Config(dict):
         return module_dict.get(key, default)
 
 
+class ConfigCache(dict):
+    """Looks up module configurations in a :class:`Config`, keeping them
+    once the configuration is frozen. Looking up a kept module is a plain
+    dictionary access, without calling :meth:`Config.__getitem__`. Before
+    the configuration is frozen, modules are looked up in the configuration
+    every time, so changes are always seen.
+    """
+    def __init__(self, config):
+        """Initializes the cache.
+
+        :param config:
+            A :class:`Config` instance.
+        """
+        dict.__init__(self)
+        self.config = config
+
+    def __missing__(self, module):
+        values = self.config[module]
+        if self.config.frozen:
+            self[module] = values
+
+        return values
+
+
 class SubConfig(dict):
     def __init__(self, module, values=None):
         dict.__init__(self, values or ())
         self.module = module
 
     def __getitem__(self, key):
-        if key not in self:
+        try:
+            value = dict.__getitem__(self, key)
+        except KeyError:
             raise KeyError('Module %r does not have the config key %r' %
                 (self.module, key))
 
-        return self.get(key)
+        if value is REQUIRED_VALUE:
+            raise KeyError('Module %r requires the config key %r to be '
+                'set.' % (self.module, key))
+
+        return value
 
     def get(self, key, default=None):
         value = dict.get(self, key, default)
@@ -208,3 +313,13 @@ class SubConfig(dict):
                 'set.' % (self.module, key))
 
         return value
+
+
+class FrozenSubConfig(SubConfig):
+    """A read-only module configuration, set by :meth:`Config.freeze`."""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Module %r configuration is frozen and can\'t be '
+            'changed.' % self.module)
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.datastructures
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Data structures used internally by tipfy.
+
+    :copyright: 2011 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import threading
+
+# Positions of the values stored in a linked list entry.
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+# Marker for missing values.
+_missing = object()
+
+
+class LRUCache(object):
+    """A dictionary-like object with a maximum number of items. When the
+    capacity is exceeded, the least recently used items are discarded.
+
+    This is safe to be shared between threads.
+    """
+    def __init__(self, capacity):
+        """Initializes the cache.
+
+        :param capacity:
+            Maximum number of items to keep.
+        """
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._mapping = {}
+        # A circular doubly linked list; the root is the least recently
+        # used end and root[_PREV] the most recently used item.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __contains__(self, key):
+        return key in self._mapping
+
+    def __len__(self):
+        return len(self._mapping)
+
+    def __getitem__(self, key):
+        rv = self.get(key, _missing)
+        if rv is _missing:
+            raise KeyError(key)
+
+        return rv
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if self.pop(key, _missing) is _missing:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        """Returns a cached value and marks it as recently used.
+
+        :param key:
+            The cache key.
+        :param default:
+            Value returned if the key is not cached.
+        :returns:
+            The cached value, or the default value.
+        """
+        link = self._mapping.get(key)
+        if link is None:
+            return default
+
+        self._lock.acquire()
+        try:
+            if link[_PREV] is not None:
+                self._unlink(link)
+                self._append(link)
+        finally:
+            self._lock.release()
+
+        return link[_VALUE]
+
+    def set(self, key, value):
+        """Sets a value in the cache, discarding the least recently used item
+        if the capacity is exceeded.
+
+        :param key:
+            The cache key.
+        :param value:
+            The value to be cached.
+        """
+        self._lock.acquire()
+        try:
+            link = self._mapping.get(key)
+            if link is not None:
+                self._unlink(link)
+
+            link = [None, None, key, value]
+            self._mapping[key] = link
+            self._append(link)
+
+            while len(self._mapping) > self.capacity:
+                oldest = self._root[_NEXT]
+                self._unlink(oldest)
+                del self._mapping[oldest[_KEY]]
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        """Removes a value from the cache and returns it.
+
+        :param key:
+            The cache key.
+        :param default:
+            Value returned if the key is not cached.
+        :returns:
+            The cached value, or the default value.
+        """
+        self._lock.acquire()
+        try:
+            link = self._mapping.pop(key, None)
+            if link is None:
+                return default
+
+            self._unlink(link)
+            return link[_VALUE]
+        finally:
+            self._lock.release()
+
+    def oldest(self):
+        """Returns the least recently used item, without marking it as used.
+
+        :returns:
+            A tuple ``(key, value)``, or None if the cache is empty.
+        """
+        self._lock.acquire()
+        try:
+            link = self._root[_NEXT]
+            if link is self._root:
+                return None
+
+            return link[_KEY], link[_VALUE]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Removes all items from the cache."""
+        self._lock.acquire()
+        try:
+            self._mapping.clear()
+            root = self._root
+            root[:] = [root, root, None, None]
+        finally:
+            self._lock.release()
+
+    def _append(self, link):
+        root = self._root
+        last = root[_PREV]
+        link[_PREV] = last
+        link[_NEXT] = root
+        last[_NEXT] = root[_PREV] = link
+
+    def _unlink(self, link):
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+        link[_PREV] = link[_NEXT] = None
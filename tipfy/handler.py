@@ -71,6 +71,17 @@ class BaseRequestHandler(object):
     def dispatch(self):
         try:
             request = self.request
+            plan = request.dispatch_plan
+            if plan is not None and plan.handler is self.__class__:
+                # Use the method names resolved when the app was prepared.
+                method_name = plan.method_names.get(request.method)
+                if method_name is None:
+                    self.abort(405, valid_methods=plan.valid_methods or
+                        self.get_valid_methods())
+
+                return self.make_response(getattr(self, method_name)(
+                    **request.rule_args))
+
             method_name = request.rule and request.rule.handler_method
             if not method_name:
                 method_name = request.method.lower()
@@ -279,42 +290,75 @@ class RequestHandler(BaseRequestHandler):
     #: handle_exception(handler, exception)
     #:     Called if an exception occurs while executing the requested method.
     #:     These are executed in reverse order.
+    #:
+    #: Middleware set in :attr:`tipfy.app.App.middleware` are executed before
+    #: the ones defined here.
     middleware = None
 
     def __call__(self):
-        middleware = self.middleware or []
+        pipeline = self.get_middleware_pipeline()
+        timer = self.request.timer
+        start = timer and timer.clock()
 
         # Execute before_dispatch middleware.
-        for obj in middleware:
-            func = getattr(obj, 'before_dispatch', None)
-            if func:
-                response = func(self)
-                if response is not None:
-                    break
+        for func in pipeline.before_dispatch:
+            response = func(self)
+            if response is not None:
+                break
         else:
+            if timer:
+                timer.record('before_dispatch', start)
+                start = timer.clock()
+
             try:
                 response = self.dispatch()
             except Exception, e:
                 # Execute handle_exception middleware.
-                for obj in reversed(middleware):
-                    func = getattr(obj, 'handle_exception', None)
-                    if func:
-                        response = func(self, e)
-                        if response is not None:
-                            break
+                for func in pipeline.handle_exception:
+                    response = func(self, e)
+                    if response is not None:
+                        break
                 else:
                     # If a middleware didn't return a response, reraise.
                     raise
 
+            if timer:
+                timer.record('method', start)
+                start = timer.clock()
+
         # Execute after_dispatch middleware.
-        for obj in reversed(middleware):
-            func = getattr(obj, 'after_dispatch', None)
-            if func:
-                response = func(self, response)
+        for func in pipeline.after_dispatch:
+            response = func(self, response)
+
+        if timer:
+            timer.record('after_dispatch', start)
 
         # Done!
         return response
 
+    def get_middleware_pipeline(self):
+        """Returns the hooks from the app and handler middleware. The
+        pipeline is compiled once and cached in the handler class, and
+        compiled again if the middleware lists are replaced or resized.
+
+        :returns:
+            A :class:`MiddlewarePipeline` instance.
+        """
+        app_middleware = getattr(self.app, 'middleware', None) or ()
+        middleware = self.middleware or ()
+        key = (id(app_middleware), len(app_middleware), id(middleware),
+            len(middleware))
+
+        # The lists are kept in the cache so that their ids are not reused.
+        cache = self.__class__.__dict__.get('_middleware_pipeline')
+        if cache is None or cache[0] != key:
+            pipeline = MiddlewarePipeline(list(app_middleware) +
+                list(middleware))
+            cache = (key, pipeline, app_middleware, middleware)
+            self.__class__._middleware_pipeline = cache
+
+        return cache[1]
+
 
 class RequestHandlerMiddleware(object):
     """Base class for :class:`RequestHandler` middleware."""
@@ -355,3 +399,43 @@ class RequestHandlerMiddleware(object):
         :param exception:
             An exception.
         """
+
+
+class MiddlewarePipeline(object):
+    """The hooks defined by a list of :class:`RequestHandler` middleware,
+    compiled in the order they are called. Hooks inherited from
+    :class:`RequestHandlerMiddleware` do nothing and are skipped.
+    """
+    def __init__(self, middleware):
+        """Compiles the pipeline.
+
+        :param middleware:
+            A list of middleware instances.
+        """
+        #: Bound ``before_dispatch`` hooks.
+        self.before_dispatch = self.get_hooks(middleware, 'before_dispatch')
+        #: Bound ``after_dispatch`` hooks, in reverse order.
+        self.after_dispatch = self.get_hooks(reversed(middleware),
+            'after_dispatch')
+        #: Bound ``handle_exception`` hooks, in reverse order.
+        self.handle_exception = self.get_hooks(reversed(middleware),
+            'handle_exception')
+
+    def get_hooks(self, middleware, name):
+        """Returns the hooks with a given name defined by middleware.
+
+        :param middleware:
+            A list of middleware instances.
+        :param name:
+            The hook name.
+        :returns:
+            A tuple of bound hooks.
+        """
+        noop = getattr(RequestHandlerMiddleware, name).im_func
+        hooks = []
+        for obj in middleware:
+            func = getattr(obj, name, None)
+            if func and getattr(func, 'im_func', None) is not noop:
+                hooks.append(func)
+
+        return tuple(hooks)
@@ -20,11 +20,16 @@
     :copyright: 2011 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
+import bisect
 from datetime import datetime
+import gettext as gettext_stdlib
 import os
+import threading
 
 from babel import Locale, dates, numbers, support
 
+from werkzeug import LanguageAccept, parse_accept_header
+
 try:
     from pytz.gae import pytz
 except ImportError:
@@ -33,8 +38,15 @@ except ImportError:
     except ImportError:
         raise RuntimeError('gaepytz or pytz are required.')
 
+from tipfy.datastructures import LRUCache
 from tipfy.local import get_request
 
+# Caches for get_babel_locale(), get_tzinfo() and get_format_pattern().
+_babel_locales = {}
+_tzinfos = {}
+_patterns = LRUCache(1000)
+_named_formats = ('short', 'medium', 'long', 'full')
+
 #: Default configuration values for this module. Keys are:
 #:
 #: locale
@@ -61,6 +73,10 @@ from tipfy.local import get_request
 #:     - cookies: gets the locale code from a cookie.
 #:     - rule_args: gets the locale code from the keywords in the current
 #:       URL rule.
+#:     - accept_language: negotiates the locale from the ``Accept-Language``
+#:       header, among the default locale and the ones returned by
+#:       :func:`list_translations`. The key is not used, e.g.,
+#:       ``('accept_language', None)``. Only for `locale_request_lookup`.
 #:
 #:     If none of the methods find a locale code, uses the default locale.
 #:     Default is ``[('session', '_locale')]``: gets the locale from the
@@ -130,24 +146,298 @@ class I18nMiddleware(object):
         return response
 
 
+class TranslationCatalogs(object):
+    """Loads translations once per process and keeps them for all requests.
+
+    The translations for a locale are merged with the ones for its fallback
+    locales in a single catalog, so a missing message doesn't walk a chain
+    of fallbacks. For ``pt_BR``, messages are searched in ``pt_BR``, ``pt``
+    and the default locale, in this order.
+
+    When translations are preloaded before the process forks (see
+    :func:`warmup`), the catalogs are shared by the forked processes using
+    copy-on-write memory.
+    """
+    def __init__(self, default_locale, dirname='locale', domain='messages'):
+        """Initializes the catalogs.
+
+        :param default_locale:
+            The application default locale code.
+        :param dirname:
+            Path to the translations directory.
+        :param domain:
+            The message domain.
+        """
+        self.default_locale = default_locale
+        self.dirname = dirname
+        self.domain = domain
+        #: Loaded translations, keyed by locale code.
+        self.catalogs = {}
+        #: Incremented when the translations are reloaded. Used to
+        #: invalidate translations cached by :class:`LazyString` objects.
+        self.version = 0
+        self._lock = threading.Lock()
+        self._available_locales = None
+        # Negotiated locales, keyed by Accept-Language header.
+        self._negotiated = LRUCache(1000)
+
+    def get(self, locale, loader=None):
+        """Returns the translations for a locale, loading them if needed.
+
+        :param locale:
+            A locale code, e.g., ``pt_BR``.
+        :param loader:
+            A function called with the list of fallback locales to load the
+            translations. Default is :meth:`load`.
+        :returns:
+            A ``babel.support.Translations`` object, or a
+            ``gettext.NullTranslations`` object if no translations exist.
+        """
+        try:
+            return self.catalogs[locale]
+        except KeyError:
+            self._lock.acquire()
+            try:
+                if locale not in self.catalogs:
+                    self.catalogs[locale] = (loader or self.load)(
+                        self.get_fallbacks(locale))
+
+                return self.catalogs[locale]
+            finally:
+                self._lock.release()
+
+    def preload(self):
+        """Loads the translations for the default locale and all locales
+        returned by :func:`list_translations`.
+        """
+        for locale in self.available_locales:
+            self.get(locale)
+
+    def reload(self):
+        """Discards all loaded translations, so that they are loaded again
+        when used.
+        """
+        self._lock.acquire()
+        try:
+            self.catalogs.clear()
+            self._available_locales = None
+            self._negotiated.clear()
+            self.version += 1
+        finally:
+            self._lock.release()
+
+    @property
+    def available_locales(self):
+        """The default locale followed by the locales returned by
+        :func:`list_translations`.
+        """
+        if self._available_locales is None:
+            locales = [self.default_locale]
+            for locale in list_translations(self.dirname):
+                locale = str(locale)
+                if locale not in locales:
+                    locales.append(locale)
+
+            self._available_locales = locales
+
+        return self._available_locales
+
+    def negotiate(self, header):
+        """Returns the available locale that best matches an
+        ``Accept-Language`` header. Results are cached per header value.
+
+        :param header:
+            The ``Accept-Language`` header value.
+        :returns:
+            A locale code from :attr:`available_locales`, or None if none
+            matches.
+        """
+        if not header:
+            return None
+
+        rv = self._negotiated.get(header, False)
+        if rv is False:
+            rv = self._negotiated[header] = self._negotiate(header)
+
+        return rv
+
+    def _negotiate(self, header):
+        locales = {}
+        languages = {}
+        for locale in self.available_locales:
+            locales.setdefault(locale.lower(), locale)
+            languages.setdefault(locale.split('_', 1)[0].lower(), locale)
+
+        accept = parse_accept_header(header, LanguageAccept)
+        for value, quality in accept:
+            if quality <= 0:
+                # Explicitly refused.
+                continue
+
+            value = value.replace('-', '_').lower()
+            if value in locales:
+                return locales[value]
+
+            language = value.split('_', 1)[0]
+            if language in languages:
+                return languages[language]
+
+        return None
+
+    def get_fallbacks(self, locale):
+        """Returns the locales searched for messages of a locale, in order.
+
+        :param locale:
+            A locale code, e.g., ``pt_BR``.
+        :returns:
+            A list of locale codes, e.g., ``['pt_BR', 'pt', 'en_US', 'en']``.
+        """
+        rv = []
+        for code in (locale, self.default_locale):
+            for fallback in (code, code.split('_', 1)[0]):
+                if fallback not in rv:
+                    rv.append(fallback)
+
+        return rv
+
+    def load(self, locales, dirname=None, domain=None):
+        """Loads and merges the translations for a list of locales. Messages
+        from the first locales have precedence.
+
+        :param locales:
+            A list of locale codes.
+        :param dirname:
+            Path to the translations directory. Default is :attr:`dirname`.
+        :param domain:
+            The message domain. Default is :attr:`domain`.
+        :returns:
+            A ``babel.support.Translations`` object, or a
+            ``gettext.NullTranslations`` object if no translations exist.
+        """
+        dirname = dirname or self.dirname
+        domain = domain or self.domain
+        rv = None
+        for locale in locales:
+            filename = os.path.join(dirname, locale, 'LC_MESSAGES',
+                domain + '.mo')
+            if not os.path.isfile(filename):
+                continue
+
+            fp = open(filename, 'rb')
+            try:
+                translations = support.Translations(fp, domain)
+            finally:
+                fp.close()
+
+            if rv is None:
+                rv = translations
+            else:
+                catalog = rv._catalog
+                for key, value in translations._catalog.iteritems():
+                    if key not in catalog:
+                        catalog[key] = value
+
+        if rv is None:
+            rv = gettext_stdlib.NullTranslations()
+
+        return rv
+
+
+class LazyString(support.LazyProxy):
+    """A ``babel.support.LazyProxy`` that translates a string when accessed
+    and caches the result per locale. Cached values are discarded when the
+    translations are reloaded (see :meth:`TranslationCatalogs.reload`).
+    Used by :func:`lazy_gettext` and :func:`lazy_ngettext`.
+    """
+    __slots__ = ['_version', '_cache']
+
+    def __init__(self, func, *args, **kwargs):
+        support.LazyProxy.__init__(self, func, *args, **kwargs)
+        object.__setattr__(self, '_version', None)
+        object.__setattr__(self, '_cache', {})
+
+    def _get_value(self):
+        i18n = get_request().i18n
+        locale = i18n.locale
+        version = i18n.catalogs.version
+        if version != self._version:
+            object.__setattr__(self, '_version', version)
+            object.__setattr__(self, '_cache', {})
+
+        try:
+            return self._cache[locale]
+        except KeyError:
+            value = self._cache[locale] = self._func(*self._args,
+                **self._kwargs)
+            return value
+
+    value = property(_get_value)
+
+
 class I18nStore(object):
+    """Translates and localizes strings and dates for a request. The locale
+    and timezone are only resolved when first used, so requests that don't
+    localize anything don't pay for it.
+    """
     #: Loaded translations.
     loaded_translations = None
-    #: Current locale.
-    locale = None
-    #: Current translations.
-    translations = None
-    #: Current timezone.
-    timezone = None
-    #: Current tzinfo.
-    tzinfo = None
 
     def __init__(self, request):
-        self.config = request.app.config[__name__]
-        self.loaded_translations = request.app.registry.setdefault(
-            'i18n.translations', {})
-        self.set_locale_for_request(request)
-        self.set_timezone_for_request(request)
+        self.request = request
+        self.config = request.app.config.cache[__name__]
+        self.catalogs = get_translation_catalogs(request.app)
+        self.loaded_translations = self.catalogs.catalogs
+        self._locale = self._translations = self._babel_locale = None
+        self._timezone = self._tzinfo = None
+
+    def _get_locale(self):
+        if self._locale is None:
+            self.set_locale_for_request(self.request)
+
+        return self._locale
+
+    def _set_locale(self, locale):
+        self.set_locale(locale)
+
+    #: Current locale code.
+    locale = property(_get_locale, _set_locale)
+
+    @property
+    def translations(self):
+        """Current translations."""
+        if self._translations is None:
+            self._translations = self.catalogs.get(self.locale,
+                self.load_translations)
+
+        return self._translations
+
+    @property
+    def babel_locale(self):
+        """Current ``babel.Locale`` object."""
+        if self._babel_locale is None:
+            self._babel_locale = get_babel_locale(self.locale)
+
+        return self._babel_locale
+
+    def _get_timezone(self):
+        if self._timezone is None:
+            self.set_timezone_for_request(self.request)
+
+        return self._timezone
+
+    def _set_timezone(self, timezone):
+        self.set_timezone(timezone)
+
+    #: Current timezone.
+    timezone = property(_get_timezone, _set_timezone)
+
+    @property
+    def tzinfo(self):
+        """Current tzinfo."""
+        if self._tzinfo is None:
+            self._tzinfo = get_tzinfo(self.timezone)
+
+        return self._tzinfo
 
     def set_locale_for_request(self, request):
         locale = _get_request_value(request,
@@ -165,15 +455,8 @@ class I18nStore(object):
         :param locale:
             A locale code, e.g., ``pt_BR``.
         """
-        self.locale = locale
-        if locale not in self.loaded_translations:
-            locales = [locale]
-            if locale != self.config['locale']:
-                locales.append(self.config['locale'])
-
-            self.loaded_translations[locale] = self.load_translations(locales)
-
-        self.translations = self.loaded_translations[locale]
+        self._locale = locale
+        self._translations = self._babel_locale = None
 
     def set_timezone(self, timezone):
         """Sets the current timezone and tzinfo.
@@ -182,11 +465,24 @@ class I18nStore(object):
             The timezone name from the Olson database, e.g.:
             ``America/Chicago``.
         """
-        self.timezone = timezone
-        self.tzinfo = pytz.timezone(timezone)
-
-    def load_translations(self, locales, dirname='locale', domain='messages'):
-        return support.Translations.load(dirname, locales, domain)
+        self._timezone = timezone
+        self._tzinfo = None
+
+    def load_translations(self, locales, dirname=None, domain=None):
+        """Loads the translations for a locale that was not loaded yet in
+        this process. Override it to load translations from other places.
+
+        :param locales:
+            A list of locale codes, in order of precedence.
+        :param dirname:
+            Path to the translations directory.
+        :param domain:
+            The message domain.
+        :returns:
+            A ``babel.support.Translations`` object, or a
+            ``gettext.NullTranslations`` object if no translations exist.
+        """
+        return self.catalogs.load(locales, dirname, domain)
 
     def gettext(self, string, **variables):
         """Translates a given string according to the current locale.
@@ -250,6 +546,22 @@ class I18nStore(object):
 
         return datetime.astimezone(pytz.UTC).replace(tzinfo=None)
 
+    def get_pattern(self, kind, format):
+        """Returns a compiled babel pattern for a format, to be passed to
+        babel format functions instead of the format. Patterns are compiled
+        once per process; see :func:`get_format_pattern`.
+
+        :param kind:
+            The kind of value being formatted: "date", "datetime", "time",
+            "decimal", "currency", "percent" or "scientific".
+        :param format:
+            A format name or a custom pattern.
+        :returns:
+            A compiled pattern, or the format if babel doesn't need to parse
+            it.
+        """
+        return get_format_pattern(self.babel_locale, kind, format)
+
     def _get_format(self, key, format):
         """A helper for the datetime formatting functions. Returns a format
         name or pattern to be used by Babel date format functions.
@@ -294,12 +606,12 @@ class I18nStore(object):
         :returns:
             A formatted date in unicode.
         """
-        format = self._get_format('date', format)
+        format = self.get_pattern('date', self._get_format('date', format))
 
         if rebase and isinstance(date, datetime):
             date = self.to_local_timezone(date)
 
-        return dates.format_date(date, format, locale=self.locale)
+        return dates.format_date(date, format, locale=self.babel_locale)
 
     def format_datetime(self, datetime=None, format=None, rebase=True):
         """Returns a date and time formatted according to the given pattern
@@ -322,14 +634,15 @@ class I18nStore(object):
         :returns:
             A formatted date and time in unicode.
         """
-        format = self._get_format('datetime', format)
+        format = self.get_pattern('datetime',
+            self._get_format('datetime', format))
 
         kwargs = {}
         if rebase:
             kwargs['tzinfo'] = self.tzinfo
 
-        return dates.format_datetime(datetime, format, locale=self.locale,
-            **kwargs)
+        return dates.format_datetime(datetime, format,
+            locale=self.babel_locale, **kwargs)
 
     def format_time(self, time=None, format=None, rebase=True):
         """Returns a time formatted according to the given pattern and
@@ -352,13 +665,14 @@ class I18nStore(object):
         :returns:
             A formatted time in unicode.
         """
-        format = self._get_format('time', format)
+        format = self.get_pattern('time', self._get_format('time', format))
 
         kwargs = {}
         if rebase:
             kwargs['tzinfo'] = self.tzinfo
 
-        return dates.format_time(time, format, locale=self.locale, **kwargs)
+        return dates.format_time(time, format, locale=self.babel_locale,
+            **kwargs)
 
     def format_timedelta(self, datetime_or_timedelta, granularity='second',
         threshold=.85):
@@ -383,7 +697,7 @@ class I18nStore(object):
             datetime_or_timedelta = datetime.utcnow() - datetime_or_timedelta
 
         return dates.format_timedelta(datetime_or_timedelta, granularity,
-            threshold=threshold, locale=self.locale)
+            threshold=threshold, locale=self.babel_locale)
 
     def format_number(self, number):
         """Returns the given number formatted for the current locale. Example::
@@ -396,7 +710,7 @@ class I18nStore(object):
         :returns:
             The formatted number.
         """
-        return numbers.format_number(number, locale=self.locale)
+        return numbers.format_number(number, locale=self.babel_locale)
 
     def format_decimal(self, number, format=None):
         """Returns the given decimal number formatted for the current locale.
@@ -426,8 +740,9 @@ class I18nStore(object):
         :returns:
             The formatted decimal number.
         """
+        format = self.get_pattern('decimal', format)
         return numbers.format_decimal(number, format=format,
-            locale=self.locale)
+            locale=self.babel_locale)
 
     def format_currency(self, number, currency, format=None):
         """Returns a formatted currency value. Example::
@@ -453,8 +768,9 @@ class I18nStore(object):
         :returns:
             The formatted currency value.
         """
+        format = self.get_pattern('currency', format)
         return numbers.format_currency(number, currency, format=format,
-            locale=self.locale)
+            locale=self.babel_locale)
 
     def format_percent(self, number, format=None):
         """Returns formatted percent value for the current locale. Example::
@@ -478,8 +794,9 @@ class I18nStore(object):
         :returns:
             The formatted percent number.
         """
+        format = self.get_pattern('percent', format)
         return numbers.format_percent(number, format=format,
-            locale=self.locale)
+            locale=self.babel_locale)
 
     def format_scientific(self, number, format=None):
         """Returns value formatted in scientific notation for the current
@@ -500,8 +817,180 @@ class I18nStore(object):
         :returns:
             Value formatted in scientific notation.
         """
+        format = self.get_pattern('scientific', format)
         return numbers.format_scientific(number, format=format,
-            locale=self.locale)
+            locale=self.babel_locale)
+
+    def to_local_timezone_many(self, values):
+        """Returns a list of datetime objects converted to the local timezone.
+        This is faster than calling :meth:`to_local_timezone` for each value:
+        the timezone offset is only computed again when a value falls outside
+        the period in which the previous offset is valid.
+
+        :param values:
+            An iterable of ``datetime`` objects. Naive values are considered
+            to be in UTC. None values are kept.
+        :returns:
+            A list of ``datetime`` objects normalized to a timezone.
+        """
+        tzinfo = self.tzinfo
+        rv = []
+        start = end = None
+        for value in values:
+            if value is None:
+                rv.append(None)
+                continue
+
+            if value.tzinfo is not None:
+                value = value.astimezone(pytz.UTC).replace(tzinfo=None)
+
+            if start is None or not (start <= value < end):
+                local = tzinfo.normalize(
+                    value.replace(tzinfo=pytz.UTC).astimezone(tzinfo))
+                offset = local.utcoffset()
+                local_tzinfo = local.tzinfo
+                start, end = _get_utc_period(tzinfo, value)
+                rv.append(local)
+            else:
+                rv.append((value + offset).replace(tzinfo=local_tzinfo))
+
+        return rv
+
+    def format_dates(self, values, format=None, rebase=True):
+        """Returns a list of dates formatted according to the given pattern
+        and following the current locale. This is faster than calling
+        :meth:`format_date` for each value, as the locale, pattern and
+        timezone are resolved once.
+
+        :param values:
+            An iterable of ``date`` or ``datetime`` objects. None values are
+            formatted as empty strings.
+        :param format:
+            The format to be returned. See :meth:`format_date`.
+        :param rebase:
+            If True, converts the dates to the current :attr:`timezone`.
+        :returns:
+            A list of formatted dates in unicode.
+        """
+        return self._format_many(values, 'date', format, rebase)
+
+    def format_datetimes(self, values, format=None, rebase=True):
+        """Returns a list of dates and times formatted according to the given
+        pattern and following the current locale and timezone. This is faster
+        than calling :meth:`format_datetime` for each value, as the locale,
+        pattern and timezone are resolved once.
+
+        :param values:
+            An iterable of ``datetime`` objects. None values are formatted as
+            empty strings.
+        :param format:
+            The format to be returned. See :meth:`format_datetime`.
+        :param rebase:
+            If True, converts the datetimes to the current :attr:`timezone`.
+        :returns:
+            A list of formatted dates and times in unicode.
+        """
+        return self._format_many(values, 'datetime', format, rebase)
+
+    def format_times(self, values, format=None, rebase=True):
+        """Returns a list of times formatted according to the given pattern
+        and following the current locale and timezone. This is faster than
+        calling :meth:`format_time` for each value, as the locale, pattern
+        and timezone are resolved once.
+
+        :param values:
+            An iterable of ``time`` or ``datetime`` objects. None values are
+            formatted as empty strings.
+        :param format:
+            The format to be returned. See :meth:`format_time`.
+        :param rebase:
+            If True, converts the times to the current :attr:`timezone`.
+        :returns:
+            A list of formatted times in unicode.
+        """
+        return self._format_many(values, 'time', format, rebase)
+
+    def format_numbers(self, values):
+        """Returns a list of numbers formatted for the current locale.
+
+        :param values:
+            An iterable of numbers. None values are formatted as empty
+            strings.
+        :returns:
+            A list of formatted numbers.
+        """
+        return self.format_decimals(values)
+
+    def format_decimals(self, values, format=None):
+        """Returns a list of decimal numbers formatted for the current locale.
+        This is faster than calling :meth:`format_decimal` for each value,
+        as the locale and pattern are resolved once.
+
+        :param values:
+            An iterable of numbers. None values are formatted as empty
+            strings.
+        :param format:
+            Notation format.
+        :returns:
+            A list of formatted decimal numbers.
+        """
+        locale = self.babel_locale
+        pattern = self.get_pattern('decimal', format)
+        if pattern is None:
+            pattern = locale.decimal_formats.get(None)
+
+        rv = []
+        for value in values:
+            if value is None:
+                rv.append(u'')
+            else:
+                rv.append(pattern.apply(value, locale))
+
+        return rv
+
+    def _format_many(self, values, kind, format, rebase):
+        """A helper for the batch datetime formatting functions.
+
+        :param values:
+            An iterable of values to format.
+        :param kind:
+            The kind of values: "date", "datetime" or "time".
+        :param format:
+            A format name or pattern.
+        :param rebase:
+            If True, converts datetimes to the current :attr:`timezone`.
+            Other values are formatted using the current timezone, like
+            :meth:`format_datetime` and :meth:`format_time` do.
+        :returns:
+            A list of formatted values in unicode.
+        """
+        func = getattr(dates, 'format_' + kind)
+        locale = self.babel_locale
+        pattern = self.get_pattern(kind, self._get_format(kind, format))
+        values = list(values)
+        rebased = ()
+        if rebase:
+            rebased = set(i for i, v in enumerate(values)
+                if isinstance(v, datetime))
+            local = self.to_local_timezone_many(values[i] for i in rebased)
+            for i, value in zip(sorted(rebased), local):
+                values[i] = value
+
+        kwargs = {}
+        if rebase and kind != 'date':
+            kwargs['tzinfo'] = self.tzinfo
+
+        rv = []
+        for i, value in enumerate(values):
+            if value is None:
+                rv.append(u'')
+            elif i in rebased:
+                # Already converted to the local timezone.
+                rv.append(func(value, pattern, locale=locale))
+            else:
+                rv.append(func(value, pattern, locale=locale, **kwargs))
+
+        return rv
 
     def parse_date(self, string):
         """Parses a date from a string.
@@ -520,7 +1009,7 @@ class I18nStore(object):
         :returns:
             The parsed date object.
         """
-        return dates.parse_date(string, locale=self.locale)
+        return dates.parse_date(string, locale=self.babel_locale)
 
     def parse_datetime(self, string):
         """Parses a date and time from a string.
@@ -533,7 +1022,7 @@ class I18nStore(object):
         :returns:
             The parsed datetime object.
         """
-        return dates.parse_datetime(string, locale=self.locale)
+        return dates.parse_datetime(string, locale=self.babel_locale)
 
     def parse_time(self, string):
         """Parses a time from a string.
@@ -550,7 +1039,7 @@ class I18nStore(object):
         :returns:
             The parsed time object.
         """
-        return dates.parse_time(string, locale=self.locale)
+        return dates.parse_time(string, locale=self.babel_locale)
 
     def parse_number(self, string):
         """Parses localized number string into a long integer. Example::
@@ -575,7 +1064,7 @@ class I18nStore(object):
             ``NumberFormatError`` if the string can not be converted to a
             number.
         """
-        return numbers.parse_number(string, locale=self.locale)
+        return numbers.parse_number(string, locale=self.babel_locale)
 
     def parse_decimal(self, string):
         """Parses localized decimal string into a float. Example::
@@ -600,7 +1089,7 @@ class I18nStore(object):
             ``NumberFormatError`` if the string can not be converted to a
             decimal number.
         """
-        return numbers.parse_decimal(string, locale=self.locale)
+        return numbers.parse_decimal(string, locale=self.babel_locale)
 
     def get_timezone_location(self, dt_or_tzinfo):
         """Returns a representation of the given timezone using "location
@@ -630,7 +1119,7 @@ class I18nStore(object):
         :returns:
             The localized timezone name using location format.
         """
-        return dates.get_timezone_name(dt_or_tzinfo, locale=self.locale)
+        return dates.get_timezone_name(dt_or_tzinfo, locale=self.babel_locale)
 
 
 def set_locale(locale):
@@ -710,6 +1199,36 @@ def format_scientific(number, format=None):
     return get_request().i18n.format_scientific(number, format)
 
 
+def to_local_timezone_many(values):
+    """See :meth:`I18nStore.to_local_timezone_many`."""
+    return get_request().i18n.to_local_timezone_many(values)
+
+
+def format_dates(values, format=None, rebase=True):
+    """See :meth:`I18nStore.format_dates`."""
+    return get_request().i18n.format_dates(values, format, rebase)
+
+
+def format_datetimes(values, format=None, rebase=True):
+    """See :meth:`I18nStore.format_datetimes`."""
+    return get_request().i18n.format_datetimes(values, format, rebase)
+
+
+def format_times(values, format=None, rebase=True):
+    """See :meth:`I18nStore.format_times`."""
+    return get_request().i18n.format_times(values, format, rebase)
+
+
+def format_numbers(values):
+    """See :meth:`I18nStore.format_numbers`."""
+    return get_request().i18n.format_numbers(values)
+
+
+def format_decimals(values, format=None):
+    """See :meth:`I18nStore.format_decimals`."""
+    return get_request().i18n.format_decimals(values, format)
+
+
 def parse_date(string):
     """See :meth:`I18nStore.parse_date`"""
     return get_request().i18n.parse_date(string)
@@ -760,6 +1279,105 @@ def list_translations(dirname='locale'):
     return result
 
 
+def get_babel_locale(locale):
+    """Returns a ``babel.Locale`` object for a locale code. Objects are
+    created once per process.
+
+    :param locale:
+        A locale code, e.g., ``pt_BR``.
+    :returns:
+        A ``babel.Locale`` object.
+    """
+    try:
+        return _babel_locales[locale]
+    except KeyError:
+        return _babel_locales.setdefault(locale, Locale.parse(locale))
+
+
+def get_tzinfo(timezone):
+    """Returns a ``tzinfo`` object for a timezone name. Objects are created
+    once per process.
+
+    :param timezone:
+        The timezone name from the Olson database, e.g.:
+        ``America/Chicago``.
+    :returns:
+        A ``tzinfo`` object.
+    """
+    try:
+        return _tzinfos[timezone]
+    except KeyError:
+        return _tzinfos.setdefault(timezone, pytz.timezone(timezone))
+
+
+def get_format_pattern(locale, kind, format):
+    """Returns a compiled babel pattern for a format. Patterns are compiled
+    once per process and kept in a cache keyed by locale, kind and format.
+
+    Named date and time formats ("short", "medium", "long" or "full") are
+    resolved to the locale pattern. Custom patterns are parsed. Named
+    datetime formats and default number formats (None) are returned
+    unchanged, as babel uses the locale patterns for them without parsing.
+
+    :param locale:
+        A ``babel.Locale`` object.
+    :param kind:
+        The kind of value being formatted: "date", "datetime", "time",
+        "decimal", "currency", "percent" or "scientific".
+    :param format:
+        A format name or a custom pattern.
+    :returns:
+        A compiled pattern, or the format if babel doesn't need to parse it.
+    """
+    if not format or (kind == 'datetime' and format in _named_formats):
+        return format
+
+    key = (str(locale), kind, format)
+    pattern = _patterns.get(key)
+    if pattern is None:
+        if kind in ('date', 'time', 'datetime'):
+            if format in _named_formats:
+                if kind == 'date':
+                    pattern = dates.get_date_format(format, locale=locale)
+                else:
+                    pattern = dates.get_time_format(format, locale=locale)
+            else:
+                pattern = dates.parse_pattern(format)
+        else:
+            pattern = numbers.parse_pattern(format)
+
+        _patterns[key] = pattern
+
+    return pattern
+
+
+def get_translation_catalogs(app):
+    """Returns the translation catalogs shared by all requests of an app.
+
+    :param app:
+        A :class:`tipfy.app.App` instance.
+    :returns:
+        A :class:`TranslationCatalogs` instance.
+    """
+    registry = app.registry
+    key = 'i18n.catalogs'
+    if key not in registry:
+        registry[key] = TranslationCatalogs(app.config[__name__]['locale'])
+
+    return registry[key]
+
+
+def warmup(app):
+    """Loads the translations for all existing locales. Used by
+    :class:`tipfy.server.PreforkServer` to load translations once before
+    workers are forked.
+
+    :param app:
+        A :class:`tipfy.app.App` instance.
+    """
+    get_translation_catalogs(app).preload()
+
+
 def lazy_gettext(string, **variables):
     """A lazy version of :func:`gettext`.
 
@@ -768,10 +1386,10 @@ def lazy_gettext(string, **variables):
     :param variables:
         Variables to format the returned string.
     :returns:
-        A ``babel.support.LazyProxy`` object that when accessed translates
-        the string.
+        A :class:`LazyString` object that when accessed translates the
+        string.
     """
-    return support.LazyProxy(gettext, string, **variables)
+    return LazyString(gettext, string, **variables)
 
 
 def lazy_ngettext(singular, plural, n, **variables):
@@ -787,10 +1405,37 @@ def lazy_ngettext(singular, plural, n, **variables):
     :param variables:
         Variables to format the returned string.
     :returns:
-        A ``babel.support.LazyProxy`` object that when accessed translates
-        the string.
+        A :class:`LazyString` object that when accessed translates the
+        string.
+    """
+    return LazyString(ngettext, singular, plural, n, **variables)
+
+
+def _get_utc_period(tzinfo, value):
+    """Returns the period around a naive UTC datetime in which a timezone
+    has the same UTC offset.
+
+    :param tzinfo:
+        A ``tzinfo`` object.
+    :param value:
+        A naive ``datetime`` object in UTC.
+    :returns:
+        A tuple ``(start, end)`` of naive UTC datetimes.
     """
-    return support.LazyProxy(ngettext, singular, plural, n, **variables)
+    transitions = getattr(tzinfo, '_utc_transition_times', None)
+    if not transitions:
+        # Fixed offset.
+        return datetime.min, datetime.max
+
+    i = bisect.bisect_right(transitions, value)
+    start, end = datetime.min, datetime.max
+    if i:
+        start = transitions[i - 1]
+
+    if i < len(transitions):
+        end = transitions[i]
+
+    return start, end
 
 
 def _get_request_value(request, lookup_list, default=None):
@@ -798,8 +1443,9 @@ def _get_request_value(request, lookup_list, default=None):
 
     It will use the configuration for ``locale_request_lookup`` or
     ``timezone_request_lookup`` to search for a key in ``GET``, ``POST``,
-    session, cookie or keywords in the current URL rule. If no value is
-    found, returns the default value.
+    session, cookie or keywords in the current URL rule, or to negotiate
+    the locale from the ``Accept-Language`` header. If no value is found,
+    returns the default value.
 
     :param request:
         A :class:`tipfy.app.Request` instance.
@@ -814,14 +1460,18 @@ def _get_request_value(request, lookup_list, default=None):
     value = None
     attrs = ('args', 'form', 'cookies', 'session', 'rule_args')
     for method, key in lookup_list:
-        if method in attrs:
-            # Get from GET, POST, cookies or rule_args.
-            obj = getattr(request, method)
+        if method == 'accept_language':
+            value = get_translation_catalogs(request.app).negotiate(
+                request.headers.get('Accept-Language'))
         else:
-            obj = None
-
-        if obj:
-            value = obj.get(key, None)
+            if method in attrs:
+                # Get from GET, POST, cookies or rule_args.
+                obj = getattr(request, method)
+            else:
+                obj = None
+
+            if obj:
+                value = obj.get(key, None)
 
         if value:
             break
@@ -14,6 +14,8 @@ from werkzeug import ETagResponseMixin
 class ETagMiddleware(object):
     """Adds an etag to all responses if they haven't already set one, and
     returns '304 Not Modified' if the request contains a matching etag.
+    Streamed responses are skipped, as the etag would require buffering the
+    whole body.
     """
     def after_dispatch(self, handler, response):
         """Called after the class:`tipfy.RequestHandler` method was executed.
@@ -25,7 +27,7 @@ class ETagMiddleware(object):
         :returns:
             A class:`tipfy.Response` instance.
         """
-        if not isinstance(response, ETagResponseMixin):
+        if not isinstance(response, ETagResponseMixin) or response.is_streamed:
             return response
 
         response.add_etag()
@@ -8,11 +8,16 @@
     :copyright: 2011 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
+import urlparse
+
+from werkzeug import datastructures
+from werkzeug import exceptions
 from werkzeug import routing
 from werkzeug import urls
 from werkzeug import utils
 from werkzeug import wrappers
 
+from .datastructures import LRUCache
 from .local import get_request, local
 
 # For export.
@@ -24,7 +29,408 @@ Subdomain = routing.Subdomain
 Submount = routing.Submount
 
 
+class RuleIndex(object):
+    """A compiled index of the rules from a URL map, used to avoid testing
+    every rule when matching a path.
+
+    Rules with a static path are stored in a hash table keyed by subdomain
+    and path, and rules with variables restricted to a single path segment
+    are stored in a segment trie keyed by subdomain. The remaining rules
+    (e.g., using the `path` or `regex` converters, or with a variable
+    subdomain) are tested for every path, as werkzeug does.
+
+    Only candidate rules are tested, in the same order used by the map, so
+    the result is the same as ``werkzeug.routing.MapAdapter.match()``.
+    Matches that result in a redirection are delegated to werkzeug.
+
+    The index also builds URLs using a format string precompiled for each
+    rule. The rules suitable to build a URL for a given name, method and set
+    of arguments are cached, so the result is the same as
+    ``werkzeug.routing.MapAdapter.build()``.
+    """
+    #: Converters that never match a slash.
+    segment_converters = (routing.UnicodeConverter, routing.IntegerConverter,
+        routing.FloatConverter)
+    #: Maximum number of cached lists of rules suitable to build a URL.
+    build_cache_size = 1000
+
+    def __init__(self, map):
+        """Compiles the index.
+
+        :param map:
+            A ``werkzeug.routing.Map`` instance.
+        """
+        map.update()
+        self.map = map
+        self.rules = list(map._rules)
+        self.size = len(self.rules)
+        # Static paths: {(subdomain, path): [position, ...]}
+        self.static = {}
+        # Segment tries: {subdomain: _TrieNode}
+        self.tries = {}
+        # Rules that can't be indexed.
+        self.fallback = []
+        # Rules that can result in a redirection when matched.
+        self.redirects = set()
+        # URL builders for each rule name, in the order used to build URLs.
+        self.builders = dict((endpoint, [_RuleBuilder(r) for r in rules])
+            for endpoint, rules in map._rules_by_endpoint.iteritems())
+        # Cached builders suitable for a name, method and arguments.
+        self.build_cache = LRUCache(self.build_cache_size)
+
+        for pos, rule in enumerate(self.rules):
+            if rule.build_only:
+                continue
+
+            if rule.redirect_to is not None or (map.redirect_defaults and
+                self._has_defaults_provider(rule)):
+                self.redirects.add(pos)
+
+            key = self._get_rule_key(rule)
+            if key is None:
+                self.fallback.append(pos)
+            elif None not in key[1]:
+                path = (key[0], u'/'.join(key[1]))
+                self.static.setdefault(path, []).append(pos)
+            else:
+                node = self.tries.get(key[0])
+                if node is None:
+                    node = self.tries[key[0]] = _TrieNode()
+
+                for segment in key[1]:
+                    node = node.add(segment)
+
+                node.rules.append(pos)
+
+    def match(self, adapter, path_info=None, method=None):
+        """Matches a path using the index. This accepts the same arguments
+        and raises the same exceptions as
+        ``werkzeug.routing.MapAdapter.match()``.
+
+        :param adapter:
+            A ``werkzeug.routing.MapAdapter`` bound to the current request.
+        :param path_info:
+            The path to be matched. If not set, uses the adapter path.
+        :param method:
+            The request method. If not set, uses the adapter method.
+        :returns:
+            A tuple ``(rule, rule_args)``.
+        """
+        if path_info is None:
+            path_info = adapter.path_info
+
+        if not isinstance(path_info, unicode):
+            path_info = path_info.decode(self.map.charset, 'ignore')
+
+        method = (method or adapter.default_method).upper()
+        subdomain = adapter.subdomain
+        path = u'/' + path_info.lstrip('/')
+        full_path = u'%s|%s' % (subdomain, path)
+        have_match_for = set()
+        for pos in self.get_candidates(subdomain, path):
+            rule = self.rules[pos]
+            try:
+                rv = rule.match(full_path)
+            except routing.RequestSlash:
+                # Let werkzeug build the redirection.
+                return adapter.match(path_info, method, return_rule=True)
+
+            if rv is None:
+                continue
+
+            if rule.methods is not None and method not in rule.methods:
+                have_match_for.update(rule.methods)
+                continue
+
+            if pos in self.redirects:
+                return adapter.match(path_info, method, return_rule=True)
+
+            return rule, rv
+
+        if have_match_for:
+            raise exceptions.MethodNotAllowed(
+                valid_methods=list(have_match_for))
+
+        raise exceptions.NotFound()
+
+    def build(self, adapter, endpoint, values=None, method=None,
+              force_external=False):
+        """Builds a URL for a named rule. This accepts the same arguments
+        and raises the same exceptions as
+        ``werkzeug.routing.MapAdapter.build()``.
+
+        :param adapter:
+            A ``werkzeug.routing.MapAdapter`` bound to the current request.
+        :param endpoint:
+            The rule name.
+        :param values:
+            A dictionary of values to build the URL. Values not used by the
+            rule are appended as query arguments.
+        :param method:
+            The request method of the rule, if rules are defined to handle
+            specific methods.
+        :param force_external:
+            If True, builds an absolute URL.
+        :returns:
+            The built URL.
+        """
+        if values:
+            values = dict((k, v) for k, v in values.iteritems()
+                if v is not None)
+        else:
+            values = {}
+
+        default_method = method is None and adapter.default_method or None
+        key = (endpoint, method, default_method, frozenset(values))
+        builders = self.build_cache.get(key)
+        if builders is None:
+            builders = self.build_cache[key] = self._get_builders(endpoint,
+                key[3], method, default_method)
+
+        for builder, defaults, append_query in builders:
+            if defaults and [k for k, v in defaults if values[k] != v]:
+                continue
+
+            rv = builder.build(values, append_query)
+            if rv is not None:
+                break
+        else:
+            raise routing.BuildError(endpoint, values, method)
+
+        subdomain, path = rv
+        if not force_external and subdomain == adapter.subdomain:
+            return str(_join_path(adapter.script_name, path.lstrip('/')))
+
+        return str('%s://%s%s%s/%s' % (
+            adapter.url_scheme,
+            subdomain and subdomain + '.' or '',
+            adapter.server_name,
+            adapter.script_name[:-1],
+            path.lstrip('/')
+        ))
+
+    def get_candidates(self, subdomain, path):
+        """Returns the positions of the rules that can match a path.
+
+        :param subdomain:
+            The current subdomain.
+        :param path:
+            The path to be matched, with a leading slash.
+        :returns:
+            A sorted list of rule positions.
+        """
+        paths = [path]
+        if path.endswith('/'):
+            # Branch rules and rules without strict slashes also match
+            # the path without the trailing slash.
+            paths.append(path[:-1])
+
+        rv = list(self.fallback)
+        trie = self.tries.get(subdomain)
+        for path in paths:
+            rv.extend(self.static.get((subdomain, path), ()))
+            if trie is not None:
+                trie.find(path.split('/'), rv)
+
+        rv.sort()
+        return rv
+
+    def _get_rule_key(self, rule):
+        """Returns a tuple ``(subdomain, segments)`` for a rule, where
+        segments is a tuple of path segments, using None for segments with
+        variables. Returns None if the rule can't be indexed.
+        """
+        trace = list(rule._trace)
+        if not rule.is_leaf:
+            # Remove the slash werkzeug adds to the trace of branch rules.
+            trace.pop()
+
+        subdomain = None
+        segments = [[]]
+        for is_dynamic, data in trace:
+            if is_dynamic:
+                if subdomain is None or not self._is_segment_converter(
+                    rule._converters[data]):
+                    return None
+
+                segments[-1].append(None)
+                continue
+
+            if subdomain is None:
+                if '|' not in data:
+                    return None
+
+                subdomain, data = data.split('|', 1)
+
+            parts = data.split('/')
+            segments[-1].append(parts[0])
+            segments.extend([part] for part in parts[1:])
+
+        if subdomain is None:
+            return None
+
+        return subdomain, tuple(None if None in segment else u''.join(segment)
+            for segment in segments)
+
+    def _get_builders(self, endpoint, keys, method, default_method):
+        """Returns the builders suitable for a rule name, method and set of
+        value keys, following ``werkzeug.routing.Rule.suitable_for()``.
+
+        Returns a list of tuples ``(builder, defaults, append_query)``, where
+        defaults is a list of rule defaults that must match the values, and
+        append_query is True if some values are not used by the rule.
+        """
+        if method is None:
+            # Like werkzeug, try the default method first, then any method.
+            methods = (default_method, None)
+        else:
+            methods = (method,)
+
+        rv = []
+        for method in methods:
+            for builder in self.builders.get(endpoint, ()):
+                rule = builder.rule
+                if method is not None and rule.methods is not None and \
+                    method not in rule.methods:
+                    continue
+
+                if not (rule.arguments - set(rule.defaults or ())) <= keys:
+                    continue
+
+                defaults = None
+                if rule.defaults is not None and rule.arguments <= keys:
+                    defaults = rule.defaults.items()
+
+                rv.append((builder, defaults, not keys <= rule.arguments))
+
+        return rv
+
+    def _has_defaults_provider(self, rule):
+        for r in self.map._rules_by_endpoint[rule.endpoint]:
+            if r.provides_defaults_for(rule):
+                return True
+
+        return False
+
+    def _is_segment_converter(self, converter):
+        if type(converter) in self.segment_converters:
+            return True
+
+        return type(converter) is routing.AnyConverter and \
+            '/' not in converter.regex
+
+
+class _RuleBuilder(object):
+    """Builds URLs for a rule using a precompiled format string. Used by
+    :class:`RuleIndex`.
+    """
+    __slots__ = ('rule', 'format', 'converters')
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.converters = []
+        parts = []
+        for is_dynamic, data in rule._trace:
+            if is_dynamic:
+                parts.append(u'%s')
+                self.converters.append((data, rule._converters[data].to_url))
+            else:
+                parts.append(data.replace(u'%', u'%%'))
+
+        self.format = u''.join(parts)
+
+    def build(self, values, append_query):
+        """Returns a tuple ``(subdomain, path)`` for the given values, or
+        None if a value fails to be converted. If append_query is True,
+        unused values are appended as query arguments.
+        """
+        try:
+            rv = self.format % tuple([to_url(values[name]) for name, to_url in
+                self.converters])
+        except routing.ValidationError:
+            return None
+
+        subdomain, path = rv.split(u'|', 1)
+        if append_query:
+            # Remove used values from a copy, like werkzeug does, to keep
+            # the same order of query arguments.
+            query = datastructures.MultiDict(values)
+            for key in self.rule.arguments:
+                query.pop(key, None)
+
+            map = self.rule.map
+            path += '?' + urls.url_encode(query, map.charset,
+                sort=map.sort_parameters, key=map.sort_key)
+
+        return subdomain, path
+
+
+class _TrieNode(object):
+    """A node in the path segment trie used by :class:`RuleIndex`."""
+    __slots__ = ('children', 'variable', 'rules')
+
+    def __init__(self):
+        self.children = {}
+        self.variable = None
+        self.rules = []
+
+    def add(self, segment):
+        if segment is None:
+            if self.variable is None:
+                self.variable = _TrieNode()
+
+            return self.variable
+
+        node = self.children.get(segment)
+        if node is None:
+            node = self.children[segment] = _TrieNode()
+
+        return node
+
+    def find(self, segments, rv, pos=0):
+        if pos == len(segments):
+            rv.extend(self.rules)
+            return
+
+        node = self.children.get(segments[pos])
+        if node is not None:
+            node.find(segments, rv, pos + 1)
+
+        if self.variable is not None:
+            self.variable.find(segments, rv, pos + 1)
+
+
+class DispatchPlan(object):
+    """Dispatch data resolved for a :class:`Rule` when the router is
+    prepared. See :meth:`Router.prepare`.
+    """
+    __slots__ = ('handler', 'method_names', 'valid_methods')
+
+    def __init__(self, handler, method_names=None, valid_methods=None):
+        """Initializes the dispatch plan.
+
+        :param handler:
+            The imported handler class or function.
+        :param method_names:
+            A dictionary mapping request methods to the names of the handler
+            methods that handle them, or None if the handler is not a
+            :class:`tipfy.RequestHandler`.
+        :param valid_methods:
+            A list of methods supported by the handler, or None to call
+            ``get_valid_methods()`` on the handler instance.
+        """
+        self.handler = handler
+        self.method_names = method_names
+        self.valid_methods = valid_methods
+
+
 class Router(object):
+    #: Class used to index the URL map for matching. If None, all rules are
+    #: matched using ``werkzeug.routing.MapAdapter.match()``.
+    rule_index_class = RuleIndex
+    #: Maximum number of URL adapters kept by :meth:`get_adapter`.
+    adapter_cache_size = 100
+
     def __init__(self, app, rules=None):
         """Initializes the router.
 
@@ -36,9 +442,15 @@ class Router(object):
         self.app = app
         self.handlers = {}
         self.map = self.create_map(rules)
+        self.rule_index = None
+        self.adapters = LRUCache(self.adapter_cache_size)
+        #: :class:`DispatchPlan` instances keyed by rule id, set by
+        #: :meth:`prepare`.
+        self.dispatch_plans = None
 
     def add(self, rule):
-        """Adds a rule to the URL map.
+        """Adds a rule to the URL map. If the router was prepared, the
+        new rules are prepared as well.
 
         :param rule:
             A :class:`Rule` or rule factory instance or a list of rules
@@ -50,6 +462,73 @@ class Router(object):
         else:
             self.map.add(rule)
 
+        if self.dispatch_plans is not None:
+            self.prepare()
+
+    def prepare(self):
+        """Imports the handlers of all rules and builds a
+        :class:`DispatchPlan` for each one, so that requests are dispatched
+        without any lookups. This also builds the rule index. It is called
+        when the app is initialized in eager mode, so that errors importing
+        handlers are raised when the app starts instead of in the first
+        request to each rule.
+        """
+        plans = self.dispatch_plans or {}
+        for rule in self.map.iter_rules():
+            if id(rule) not in plans:
+                plans[id(rule)] = self.get_dispatch_plan(rule)
+
+        self.dispatch_plans = plans
+        self.get_rule_index()
+
+    def get_dispatch_plan(self, rule):
+        """Returns a :class:`DispatchPlan` for a rule, importing its handler
+        if needed.
+
+        :param rule:
+            A :class:`Rule` instance.
+        :returns:
+            A :class:`DispatchPlan` instance.
+        """
+        from .handler import BaseRequestHandler
+
+        handler = self.get_handler(rule)
+        if not isinstance(handler, type) or \
+            not issubclass(handler, BaseRequestHandler):
+            return DispatchPlan(handler)
+
+        method_names = {}
+        for method in self.app.allowed_methods:
+            name = rule.handler_method or method.lower()
+            if getattr(handler, name, None):
+                method_names[method] = name
+
+        valid_methods = None
+        if handler.get_valid_methods.im_func is \
+            BaseRequestHandler.get_valid_methods.im_func:
+            valid_methods = [method for method in self.app.allowed_methods
+                if getattr(handler, method.lower().replace('-', '_'), None)]
+
+        return DispatchPlan(handler, method_names, valid_methods)
+
+    def get_handler(self, rule):
+        """Returns the handler for a rule, importing it if it is defined as
+        a string.
+
+        :param rule:
+            A :class:`Rule` instance.
+        :returns:
+            The handler class or function.
+        """
+        handler = rule.handler
+        if isinstance(handler, basestring):
+            if handler not in self.handlers:
+                self.handlers[handler] = utils.import_string(handler)
+
+            rule.handler = handler = self.handlers[handler]
+
+        return handler
+
     def match(self, request):
         """Matches registered :class:`Rule` definitions against the current
         request and returns the matched rule and rule arguments.
@@ -68,11 +547,15 @@ class Router(object):
             arguments.
         """
         # Bind the URL map to the current request
-        request.rule_adapter = self.map.bind_to_environ(request.environ,
-            server_name=self.get_server_name(request))
+        request.rule_adapter = adapter = self.get_adapter(request)
 
         # Match the path against registered rules.
-        match = request.rule_adapter.match(return_rule=True)
+        rule_index = self.get_rule_index()
+        if rule_index is None:
+            match = adapter.match(return_rule=True)
+        else:
+            match = rule_index.match(adapter)
+
         request.rule, request.rule_args = match
         return match
 
@@ -90,13 +573,23 @@ class Router(object):
         :returns:
             A :class:`tipfy.app.Response` instance.
         """
+        timer = request.timer
+        start = timer and timer.clock()
         rule, rule_args = self.match(request)
-        handler = rule.handler
-        if isinstance(handler, basestring):
-            if handler not in self.handlers:
-                self.handlers[handler] = utils.import_string(handler)
+        if timer:
+            timer.record('match', start)
+            start = timer.clock()
+
+        plan = self.dispatch_plans and self.dispatch_plans.get(id(rule))
+        if plan:
+            request.dispatch_plan = plan
+            handler = plan.handler
+        else:
+            handler = self.get_handler(rule)
 
-            rule.handler = handler = self.handlers[handler]
+        if timer:
+            timer.record('import', start)
+            start = timer.clock()
 
         rv = local.current_handler = handler(request)
         if not isinstance(rv, wrappers.BaseResponse) and \
@@ -104,6 +597,9 @@ class Router(object):
             # If it is a callable but not a response, we call it again.
             rv = rv()
 
+        if timer:
+            timer.record('handler', start)
+
         return rv
 
     def url_for(self, request, name, kwargs):
@@ -139,8 +635,13 @@ class Router(object):
         anchor = kwargs.pop('_anchor', None)
         full = kwargs.pop('_full', False) and not scheme and not netloc
 
-        url = request.rule_adapter.build(name, values=kwargs, method=method,
-                                        force_external=full)
+        rule_index = self.get_rule_index()
+        if rule_index is None:
+            url = request.rule_adapter.build(name, values=kwargs,
+                method=method, force_external=full)
+        else:
+            url = rule_index.build(request.rule_adapter, name, values=kwargs,
+                method=method, force_external=full)
 
         if scheme or netloc:
             url = '%s://%s%s' % (scheme or 'http', netloc or request.host, url)
@@ -150,6 +651,54 @@ class Router(object):
 
         return url
 
+    def get_adapter(self, request):
+        """Returns a ``werkzeug.routing.MapAdapter`` bound to a request.
+
+        Binding the URL map calculates the server name and subdomain from
+        the request environment, which is the same for most requests. The
+        bound adapters are cached by host, script name and URL scheme, and
+        copies only have the path and method set for the current request.
+
+        :param request:
+            A :class:`tipfy.app.Request` instance.
+        :returns:
+            A ``werkzeug.routing.MapAdapter`` instance.
+        """
+        environ = request.environ
+        server_name = self.get_server_name(request)
+        key = (server_name, environ.get('HTTP_HOST'),
+            environ.get('SERVER_NAME'), environ.get('SERVER_PORT'),
+            environ.get('SCRIPT_NAME'), environ.get('wsgi.url_scheme'))
+
+        cached = self.adapters.get(key)
+        if cached is None:
+            cached = self.map.bind_to_environ(environ,
+                server_name=server_name)
+            self.adapters[key] = cached
+
+        adapter = object.__new__(cached.__class__)
+        adapter.__dict__.update(cached.__dict__)
+        adapter.path_info = environ.get('PATH_INFO') or u''
+        adapter.default_method = environ['REQUEST_METHOD']
+        return adapter
+
+    def get_rule_index(self):
+        """Returns the index used to match rules, compiling it if rules were
+        added to the URL map since it was last built.
+
+        :returns:
+            A :attr:`rule_index_class` instance, or None if indexing is
+            disabled.
+        """
+        if self.rule_index_class is None:
+            return None
+
+        index = self.rule_index
+        if index is None or index.size != len(self.map._rules):
+            index = self.rule_index = self.rule_index_class(self.map)
+
+        return index
+
     def create_map(self, rules=None):
         """Returns a ``werkzeug.routing.Map`` instance with the given
         :class:`Rule` definitions.
@@ -168,7 +717,7 @@ class Router(object):
         :returns:
             The default subdomain to be used in the URL map.
         """
-        return self.app.config['tipfy']['default_subdomain']
+        return self.app.config.cache['tipfy']['default_subdomain']
 
     def get_server_name(self, request):
         """Returns the server name used to bind the URL map. By default it
@@ -181,7 +730,7 @@ class Router(object):
         :returns:
             The server name used to build the URL adapter.
         """
-        return self.app.config['tipfy']['server_name']
+        return self.app.config.cache['tipfy']['server_name']
 
     # Old name.
     build = url_for
@@ -410,6 +959,19 @@ class RegexConverter(BaseConverter):
         self.regex = items[0]
 
 
+def _join_path(script_name, path):
+    """Joins a relative path to the script name. This is the same as
+    ``urlparse.urljoin(script_name, path)``, but avoids parsing the URL when
+    the path has no scheme, parameters, fragment, empty query or dot
+    segments to be resolved.
+    """
+    if ':' in path or ';' in path or '#' in path or path.endswith('?') or \
+        path.startswith('.') or '/.' in path:
+        return urlparse.urljoin(script_name, path)
+
+    return script_name + path
+
+
 def url_for(_name, **kwargs):
     """A proxy to :meth:`Router.url_for`.
 
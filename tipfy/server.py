@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.server
+    ~~~~~~~~~~~~
+
+    A preforking WSGI server to run tipfy apps outside App Engine.
+
+    The master process imports the app and warms it up (importing handlers,
+    compiling the rule index and running the configured warmup functions),
+    then forks the workers. Workers share the warmed state with the master
+    using copy-on-write memory, and accept connections from the same
+    listening socket. Each worker is replaced after serving a number of
+    requests. Run it with::
+
+        $ python -m tipfy.server --workers=4 --port=8080 main.app
+
+    Or from code::
+
+        from tipfy.server import PreforkServer
+
+        PreforkServer(app, port=8080).run()
+
+    Signals sent to the master process:
+
+    - ``TERM`` or ``INT``: stops the workers gracefully, letting them finish
+      the current request, and exits.
+    - ``HUP``: replaces all workers gracefully.
+
+    :copyright: 2011 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import errno
+import logging
+import optparse
+import os
+import signal
+import socket
+import sys
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from werkzeug import import_string
+
+#: Default configuration values for this module. Keys are:
+#:
+#: host
+#:     The address to bind to. Default is `127.0.0.1`.
+#:
+#: port
+#:     The port to bind to. Default is `8080`.
+#:
+#: workers
+#:     Number of worker processes. If None, uses the number of CPUs.
+#:     Default is None.
+#:
+#: max_requests
+#:     Number of requests a worker serves before it is replaced. If None,
+#:     workers are never replaced. Default is `1000`.
+#:
+#: backlog
+#:     Maximum number of queued connections. Default is `128`.
+#:
+#: graceful_timeout
+#:     Seconds to wait for workers to finish the current request when
+#:     stopping, before killing them. Default is `30`.
+#:
+#: warmup
+#:     A list of functions called with the app as argument in the master
+#:     process, before workers are forked. Can also be defined as strings to
+#:     be imported dynamically. For example, use
+#:     ``['tipfy.i18n.warmup', 'tipfyext.jinja2.warmup']`` to load all
+#:     translations and compile all Jinja2 templates. Default is an empty
+#:     list.
+#:
+#: freeze_config
+#:     If True, freezes the app configuration after warmup, so that it is
+#:     read-only and faster to look up in workers. See
+#:     :meth:`tipfy.config.Config.freeze`. Default is `True`.
+default_config = {
+    'host':             '127.0.0.1',
+    'port':             8080,
+    'workers':          None,
+    'max_requests':     1000,
+    'backlog':          128,
+    'graceful_timeout': 30,
+    'warmup':           [],
+    'freeze_config':    True,
+}
+
+
+class RequestHandler(WSGIRequestHandler):
+    """Logs requests using the `logging` module."""
+    def log_message(self, format, *args):
+        logging.info('%s - %s' % (self.client_address[0], format % args))
+
+
+class WorkerServer(WSGIServer):
+    """WSGI server used by a worker, accepting connections from a socket
+    shared with the master process.
+    """
+    #: Seconds to wait for a connection before checking if the worker
+    #: must stop.
+    timeout = 1
+
+    def __init__(self, sock, app):
+        """Initializes the server.
+
+        :param sock:
+            The listening socket.
+        :param app:
+            A WSGI app.
+        """
+        WSGIServer.__init__(self, sock.getsockname()[:2], RequestHandler,
+            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        host, port = sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+        self.requests = 0
+
+    def finish_request(self, request, client_address):
+        WSGIServer.finish_request(self, request, client_address)
+        self.requests += 1
+
+    def handle_error(self, request, client_address):
+        logging.exception('Error handling request from %s.' %
+            (client_address,))
+
+
+class PreforkServer(object):
+    """Serves an app using a master process and a number of forked workers.
+    """
+    #: Class used by workers to serve requests.
+    server_class = WorkerServer
+
+    def __init__(self, app, **kwargs):
+        """Initializes the server.
+
+        :param app:
+            A :class:`tipfy.app.App` instance.
+        :param kwargs:
+            Options that override the ones configured for this module. See
+            :data:`default_config`.
+        """
+        self.app = app
+        self.config = dict(app.config[__name__])
+        self.config.update(kwargs)
+        if self.config['workers'] is None:
+            self.config['workers'] = get_cpu_count()
+
+        #: The listening socket.
+        self.socket = None
+        #: Ids of the running worker processes.
+        self.workers = set()
+        self.running = False
+        self.alive = False
+
+    def run(self):
+        """Warms up the app, binds the socket and runs the master process
+        until it is stopped.
+        """
+        self.warmup()
+        if self.socket is None:
+            self.bind()
+
+        logging.info('Master %d listening on %s:%d with %d workers.' % (
+            (os.getpid(),) + self.socket.getsockname()[:2] +
+            (self.config['workers'],)))
+
+        self.running = True
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        try:
+            while self.running:
+                while len(self.workers) < self.config['workers']:
+                    self.spawn_worker()
+
+                self.wait_worker()
+        finally:
+            self.stop_workers()
+            self.socket.close()
+
+        logging.info('Master %d stopped.' % os.getpid())
+
+    def warmup(self):
+        """Prepares the app before workers are forked, so that the work is
+        done once and shared by all workers. This imports all handlers and
+        builds the rule index, then calls the configured warmup functions
+        and freezes the configuration.
+        """
+        self.app.router.prepare()
+        for func in self.config['warmup']:
+            if isinstance(func, basestring):
+                func = import_string(func)
+
+            func(self.app)
+
+        if self.config['freeze_config']:
+            self.app.config.freeze()
+
+    def bind(self):
+        """Creates the listening socket shared by all workers."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.config['host'], self.config['port']))
+        sock.listen(self.config['backlog'])
+        # Workers wait for connections using select(), and all of them are
+        # woken up by a new connection. Only one gets it; the others must
+        # not block in accept().
+        sock.setblocking(0)
+        self.socket = sock
+
+    def spawn_worker(self):
+        """Forks a worker process."""
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return
+
+        status = 0
+        try:
+            try:
+                self.run_worker()
+            except Exception:
+                logging.exception('Worker %d failed.' % os.getpid())
+                status = 1
+        finally:
+            # Never return to the master loop.
+            os._exit(status)
+
+    def wait_worker(self):
+        """Waits for a worker to exit and removes it from the running
+        workers.
+        """
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.ECHILD):
+                return
+
+            raise
+
+        self.workers.discard(pid)
+        if status and self.running:
+            logging.error('Worker %d exited with status %d.' % (pid, status))
+            # Avoid forking workers too fast if they keep failing.
+            time.sleep(1)
+
+    def stop_workers(self):
+        """Stops all workers, waiting for them to finish the current request
+        for up to ``graceful_timeout`` seconds before killing them.
+        """
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.time() + self.config['graceful_timeout']
+        while self.workers and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+
+        if self.workers:
+            self.signal_workers(signal.SIGKILL)
+            while self.workers:
+                self.reap_workers()
+                time.sleep(0.1)
+
+    def reap_workers(self):
+        """Removes workers that exited from the running workers, without
+        blocking.
+        """
+        for pid in list(self.workers):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    self.workers.discard(pid)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+
+                self.workers.discard(pid)
+
+    def signal_workers(self, signum):
+        """Sends a signal to all workers.
+
+        :param signum:
+            The signal number.
+        """
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def handle_stop(self, signum, frame):
+        self.running = False
+
+    def handle_reload(self, signum, frame):
+        # Workers finish the current request and exit, then are replaced.
+        self.signal_workers(signal.SIGTERM)
+
+    def run_worker(self):
+        """Serves requests in a worker until it is stopped or served the
+        maximum number of requests.
+        """
+        self.alive = True
+        signal.signal(signal.SIGTERM, self.handle_worker_stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        server = self.server_class(self.socket, self.app)
+        max_requests = self.config['max_requests']
+        while self.alive:
+            server.handle_request()
+            if max_requests and server.requests >= max_requests:
+                break
+
+    def handle_worker_stop(self, signum, frame):
+        self.alive = False
+
+
+def get_cpu_count():
+    """Returns the number of CPUs, or 1 if it can't be determined.
+
+    :returns:
+        The number of CPUs.
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+
+    try:
+        return max(int(os.sysconf('SC_NPROCESSORS_ONLN')), 1)
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] module.app')
+    parser.add_option('--host', help='Address to bind to.')
+    parser.add_option('-p', '--port', type='int', help='Port to bind to.')
+    parser.add_option('-w', '--workers', type='int',
+        help='Number of worker processes.')
+    parser.add_option('--max-requests', type='int', dest='max_requests',
+        help='Requests served by a worker before it is replaced.')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('The app import path is required, e.g., main.app.')
+
+    logging.basicConfig(level=logging.INFO)
+    sys.path.insert(0, os.getcwd())
+    app = import_string(args[0].replace(':', '.'))
+    kwargs = dict((k, v) for k, v in options.__dict__.iteritems()
+        if v is not None)
+    PreforkServer(app, **kwargs).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,17 +10,41 @@
     :copyright: 2011 by tipfy.org.
     :license: Apache Sotware License, see LICENSE for details.
 """
+import base64
+import binascii
 import hashlib
 import hmac
 import logging
+import marshal
+import os
+import re
+import threading
 import time
+import uuid
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import sqlite3
+except ImportError:
+    # Not available on App Engine.
+    sqlite3 = None
 
 from tipfy import APPENGINE, DEFAULT_VALUE, REQUIRED_VALUE
-from tipfy.utils import json_b64encode, json_b64decode
+from tipfy.datastructures import LRUCache
+from tipfy.utils import (json_b64decode, json_b64encode, json_decode,
+    json_encode)
 
 from werkzeug import cached_property
 from werkzeug.contrib.sessions import ModificationTrackingDict
 
+# Validate local session ids.
+_SID_RE = re.compile(r'^[a-f0-9]{32}$')
+
 #: Default configuration values for this module. Keys are:
 #:
 #: secret_key
@@ -60,11 +84,42 @@ from werkzeug.contrib.sessions import ModificationTrackingDict
 #:     - secure: Make the cookie only available via HTTPS.
 #:
 #:     - httponly: Disallow JavaScript to access the cookie.
+#:
+#: serializer
+#:     Name of the serializer used to encode secure cookies: `json` or
+#:     `marshal`, a more compact binary encoding. Cookies encoded by any
+#:     serializer can always be decoded. Default is `json`.
+#:
+#: compress_threshold
+#:     Serialized values larger than this number of bytes are compressed
+#:     using zlib. If None, values are never compressed. Default is None.
+#:
+#: storage_max_age
+#:     Seconds a session is kept by the `memory` and `sqlite` backends after
+#:     it was last used. Default is `86400` (one day).
+#:
+#: memory_capacity
+#:     Maximum number of sessions kept by the `memory` backend. The least
+#:     recently used sessions are discarded. Default is `10000`.
+#:
+#: sqlite_filename
+#:     Path to the database file used by the `sqlite` backend. Default is
+#:     `sessions.sqlite`.
+#:
+#: sweep_interval
+#:     Seconds between removals of expired sessions by the `memory` and
+#:     `sqlite` backends. Default is `300`.
 default_config = {
-    'secret_key':      REQUIRED_VALUE,
-    'default_backend': 'securecookie',
-    'cookie_name':     'session',
-    'session_max_age': None,
+    'secret_key':         REQUIRED_VALUE,
+    'default_backend':    'securecookie',
+    'cookie_name':        'session',
+    'session_max_age':    None,
+    'serializer':         'json',
+    'compress_threshold': None,
+    'storage_max_age':    86400,
+    'memory_capacity':    10000,
+    'sqlite_filename':    'sessions.sqlite',
+    'sweep_interval':     300,
     'cookie_args': {
         'max_age':     None,
         'domain':      None,
@@ -130,19 +185,407 @@ class SecureCookieSession(BaseSession):
         store.set_secure_cookie(response, name, dict(self), **kwargs)
 
 
+class LocalSession(BaseSession):
+    """Base class for sessions stored in the server, outside App Engine.
+    Only the session id is saved in a secure cookie.
+    """
+    __slots__ = BaseSession.__slots__ + ('sid',)
+
+    def __init__(self, data=None, sid=None, new=False):
+        BaseSession.__init__(self, data, new)
+        if new:
+            self.sid = uuid.uuid4().hex
+        elif sid is None:
+            raise ValueError('A session id is required for existing sessions.')
+        else:
+            self.sid = sid
+
+    @classmethod
+    def get_storage(cls, app):
+        """Returns the storage used by this backend.
+
+        :param app:
+            A :class:`tipfy.app.App` instance.
+        :returns:
+            A storage object with ``get()``, ``get_many()``, ``set()`` and
+            ``delete()`` methods.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def get_session(cls, store, name=None, **kwargs):
+        if name:
+            cookie = store.get_secure_cookie(name)
+            if cookie is not None:
+                sid = cookie.get('_sid')
+                if sid and _SID_RE.match(sid):
+                    data = cls.get_storage(store.request.app).get(sid)
+                    if data is not None:
+                        return cls(data, sid)
+
+        return cls(new=True)
+
+    def save_session(self, response, store, name, **kwargs):
+        if not self.modified:
+            return
+
+        self.get_storage(store.request.app).set(self.sid, dict(self))
+        store.set_secure_cookie(response, name, {'_sid': self.sid}, **kwargs)
+
+
+class MemorySession(LocalSession):
+    """A session that stores data in memory. Sessions are not shared between
+    processes and are lost when the process ends. See
+    :class:`MemorySessionStorage`.
+    """
+    @classmethod
+    def get_storage(cls, app):
+        storage = app.registry.get('sessions.memory_storage')
+        if storage is None:
+            config = app.config[__name__]
+            storage = MemorySessionStorage(config['memory_capacity'],
+                config['storage_max_age'], config['sweep_interval'])
+            app.registry['sessions.memory_storage'] = storage
+
+        return storage
+
+
+class SQLiteSession(LocalSession):
+    """A session that stores data in a SQLite database, which can be shared
+    by multiple processes. See :class:`SQLiteSessionStorage`.
+    """
+    @classmethod
+    def get_storage(cls, app):
+        storage = app.registry.get('sessions.sqlite_storage')
+        if storage is None:
+            config = app.config[__name__]
+            storage = SQLiteSessionStorage(config['sqlite_filename'],
+                config['storage_max_age'], config['sweep_interval'])
+            app.registry['sessions.sqlite_storage'] = storage
+
+        return storage
+
+
+class MemorySessionStorage(object):
+    """Stores session data in memory, in a :class:`LRUCache`. Sessions
+    expire when they are not used for `max_age` seconds. Because each use
+    refreshes the expiration, the least recently used sessions are the first
+    to expire, so sweeping only visits expired sessions.
+    """
+    def __init__(self, capacity=10000, max_age=86400, sweep_interval=300):
+        """Initializes the storage.
+
+        :param capacity:
+            Maximum number of sessions to keep.
+        :param max_age:
+            Seconds a session is kept after it was last used.
+        :param sweep_interval:
+            Seconds between removals of expired sessions.
+        """
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
+        # Session ids mapped to tuples (serialized data, expiration).
+        self.cache = LRUCache(capacity)
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        """Returns the data for a session.
+
+        :param sid:
+            A session id.
+        :returns:
+            The session data, or None if the session doesn't exist or
+            expired.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            value = self.cache.get(sid)
+            if value is None:
+                return None
+
+            if value[1] <= now:
+                self.cache.pop(sid)
+                return None
+
+            self.cache.set(sid, (value[0], now + self.max_age))
+        finally:
+            self._lock.release()
+
+        return pickle.loads(value[0])
+
+    def get_many(self, sids):
+        """Returns the data for multiple sessions.
+
+        :param sids:
+            A list of session ids.
+        :returns:
+            A dictionary mapping session ids to data, for sessions that
+            exist.
+        """
+        rv = {}
+        for sid in sids:
+            data = self.get(sid)
+            if data is not None:
+                rv[sid] = data
+
+        return rv
+
+    def set(self, sid, data):
+        """Saves the data for a session.
+
+        :param sid:
+            A session id.
+        :param data:
+            A dictionary of session data.
+        """
+        value = (pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
+            time.time() + self.max_age)
+        self._lock.acquire()
+        try:
+            self.cache.set(sid, value)
+        finally:
+            self._lock.release()
+
+        if time.time() - self.last_sweep > self.sweep_interval:
+            self.sweep()
+
+    def delete(self, sid):
+        """Deletes a session.
+
+        :param sid:
+            A session id.
+        """
+        self.cache.pop(sid)
+
+    def sweep(self):
+        """Removes expired sessions.
+
+        :returns:
+            The number of removed sessions.
+        """
+        now = self.last_sweep = time.time()
+        count = 0
+        self._lock.acquire()
+        try:
+            while True:
+                item = self.cache.oldest()
+                if item is None or item[1][1] > now:
+                    break
+
+                self.cache.pop(item[0])
+                count += 1
+        finally:
+            self._lock.release()
+
+        return count
+
+
+class SQLiteSessionStorage(object):
+    """Stores session data in a SQLite database. Multiple processes can use
+    the same database file; each thread and process uses its own connection.
+
+    Sessions expire when they are not used for `max_age` seconds. To avoid
+    a write on every read, the expiration is refreshed at most once every
+    half `max_age`.
+    """
+    #: Maximum number of session ids queried at once by :meth:`get_many`.
+    batch_size = 500
+
+    def __init__(self, filename, max_age=86400, sweep_interval=300):
+        """Initializes the storage.
+
+        :param filename:
+            Path to the database file.
+        :param max_age:
+            Seconds a session is kept after it was last used.
+        :param sweep_interval:
+            Seconds between removals of expired sessions.
+        """
+        self.filename = filename
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        """Returns the database connection for the current thread and
+        process, creating the sessions table if needed.
+        """
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            # Connections can't be shared with forked processes.
+            connection = sqlite3.connect(self.filename, timeout=30,
+                isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                'sid TEXT PRIMARY KEY, data BLOB NOT NULL, '
+                'expires REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS sessions_expires '
+                'ON sessions (expires)')
+            local.connection = connection
+            local.pid = pid
+
+        return local.connection
+
+    def get(self, sid):
+        """Returns the data for a session.
+
+        :param sid:
+            A session id.
+        :returns:
+            The session data, or None if the session doesn't exist or
+            expired.
+        """
+        connection = self.connection
+        row = connection.execute('SELECT data, expires FROM sessions '
+            'WHERE sid = ?', (sid,)).fetchone()
+        if row is None:
+            return None
+
+        now = time.time()
+        if row[1] <= now:
+            return None
+
+        if row[1] - now < self.max_age / 2.0:
+            connection.execute('UPDATE sessions SET expires = ? '
+                'WHERE sid = ?', (now + self.max_age, sid))
+
+        return pickle.loads(str(row[0]))
+
+    def get_many(self, sids):
+        """Returns the data for multiple sessions, using one query for each
+        :attr:`batch_size` session ids. This doesn't refresh the expiration
+        of the sessions.
+
+        :param sids:
+            A list of session ids.
+        :returns:
+            A dictionary mapping session ids to data, for sessions that
+            exist.
+        """
+        rv = {}
+        sids = list(sids)
+        now = time.time()
+        for i in xrange(0, len(sids), self.batch_size):
+            batch = sids[i:i + self.batch_size]
+            rows = self.connection.execute('SELECT sid, data FROM sessions '
+                'WHERE sid IN (%s) AND expires > ?' % ', '.join(
+                '?' * len(batch)), batch + [now])
+            for sid, data in rows:
+                rv[sid] = pickle.loads(str(data))
+
+        return rv
+
+    def set(self, sid, data):
+        """Saves the data for a session.
+
+        :param sid:
+            A session id.
+        :param data:
+            A dictionary of session data.
+        """
+        self.connection.execute('INSERT OR REPLACE INTO sessions '
+            '(sid, data, expires) VALUES (?, ?, ?)', (sid,
+            sqlite3.Binary(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)),
+            time.time() + self.max_age))
+
+        if time.time() - self.last_sweep > self.sweep_interval:
+            self.sweep()
+
+    def delete(self, sid):
+        """Deletes a session.
+
+        :param sid:
+            A session id.
+        """
+        self.connection.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def sweep(self):
+        """Removes expired sessions.
+
+        :returns:
+            The number of removed sessions.
+        """
+        now = self.last_sweep = time.time()
+        return self.connection.execute('DELETE FROM sessions '
+            'WHERE expires <= ?', (now,)).rowcount
+
+
+class JSONSerializer(object):
+    """Serializes values to JSON."""
+    #: Tag to identify values encoded by this serializer.
+    tag = 'j'
+
+    def dumps(self, value):
+        return json_encode(value)
+
+    def loads(self, value):
+        return json_decode(value)
+
+
+class MarshalSerializer(object):
+    """Serializes values using the `marshal` module, which is more compact
+    and faster than JSON. Values are only decoded after their signature is
+    verified.
+    """
+    #: Tag to identify values encoded by this serializer.
+    tag = 'm'
+
+    def dumps(self, value):
+        return marshal.dumps(value, 2)
+
+    def loads(self, value):
+        return marshal.loads(value)
+
+
 class SecureCookieStore(object):
     """Encapsulates getting and setting secure cookies.
 
     Extracted from `Tornado`_ and modified.
+
+    Decoded cookies are cached by their raw value, so a cookie sent again
+    is not verified and decoded again. Because the store keeps this cache,
+    it is shared between requests; see
+    :attr:`SessionStore.secure_cookie_store`.
     """
-    def __init__(self, secret_key):
+    #: Maximum number of decoded cookies to cache.
+    cache_size = 256
+    #: Available serializers.
+    serializers = {
+        'json':    JSONSerializer(),
+        'marshal': MarshalSerializer(),
+    }
+    #: Cookies larger than this number of bytes log a warning, as browsers
+    #: limit cookies to about 4096 bytes.
+    size_warning = 3840
+
+    def __init__(self, secret_key, serializer='json', compress_threshold=None):
         """Initilizes this secure cookie store.
 
         :param secret_key:
             A long, random sequence of bytes to be used as the HMAC secret
             for the cookie signature.
+        :param serializer:
+            Name of the serializer used to encode values. See
+            :attr:`serializers`.
+        :param compress_threshold:
+            Serialized values larger than this number of bytes are
+            compressed. If None, values are never compressed.
         """
         self.secret_key = secret_key
+        self.serializer = serializer
+        self.compress_threshold = compress_threshold
+        self._serializer = self.serializers[serializer]
+        self._loaders = dict((s.tag, s) for s in self.serializers.values())
+        # Keyed HMAC state, copied to sign each value.
+        self._hmac = hmac.new(secret_key, digestmod=hashlib.sha1)
+        # Cached (timestamp, value) for raw cookie values.
+        self._cache = LRUCache(self.cache_size)
 
     def get_cookie(self, request, name, max_age=None):
         """Returns the given signed cookie if it validates, or None.
@@ -160,25 +603,22 @@ class SecureCookieStore(object):
         if not value:
             return
 
-        parts = value.split('|')
-        if len(parts) != 3:
-            return
-
-        signature = self._get_signature(name, parts[0], parts[1])
+        cache_key = (name, value)
+        cached = self._cache.get(cache_key)
+        if cached is None:
+            cached = self._decode(name, value)
+            if cached is None:
+                return
 
-        if not self._check_signature(parts[2], signature):
-            logging.warning('Invalid cookie signature %r', value)
-            return
+            self._cache[cache_key] = cached
 
-        if max_age is not None and (int(parts[1]) < time.time() - max_age):
+        timestamp, data = cached
+        if max_age is not None and (timestamp < time.time() - max_age):
             logging.warning('Expired cookie %r', value)
             return
 
-        try:
-            return json_b64decode(parts[0])
-        except:
-            logging.warning('Cookie value failed to be decoded: %r', parts[0])
-            return
+        # The cached value is shared, so never return it.
+        return _copy_value(data)
 
     def set_cookie(self, response, name, value, **kwargs):
         """Signs and timestamps a cookie so it cannot be forged.
@@ -194,7 +634,12 @@ class SecureCookieStore(object):
         :param kwargs:
             Options to save the cookie. See :meth:`SessionStore.get_session`.
         """
-        response.set_cookie(name, self.get_signed_value(name, value), **kwargs)
+        value = self.get_signed_value(name, value)
+        if len(name) + len(value) > self.size_warning:
+            logging.warning('Cookie %r is %d bytes long and may be rejected '
+                'by browsers.' % (name, len(name) + len(value)))
+
+        response.set_cookie(name, value, **kwargs)
 
     def get_signed_value(self, name, value):
         """Returns a signed value for a cookie.
@@ -207,26 +652,84 @@ class SecureCookieStore(object):
             An signed value using HMAC.
         """
         timestamp = str(int(time.time()))
-        value = json_b64encode(value)
+        value = self._dumps(value)
         signature = self._get_signature(name, value, timestamp)
         return '|'.join([value, timestamp, signature])
 
+    def _decode(self, name, value):
+        """Verifies and decodes a signed cookie value.
+
+        :returns:
+            A tuple ``(timestamp, value)``, or None if the value is invalid.
+        """
+        parts = value.split('|')
+        if len(parts) != 3:
+            return
+
+        try:
+            signature = binascii.unhexlify(parts[2])
+        except (TypeError, ValueError):
+            # Not hex, or not ASCII.
+            signature = None
+
+        if not signature or not self._check_signature(signature,
+            self._get_digest(name, parts[0], parts[1])):
+            logging.warning('Invalid cookie signature %r', value)
+            return
+
+        try:
+            return int(parts[1]), self._loads(parts[0])
+        except:
+            logging.warning('Cookie value failed to be decoded: %r', parts[0])
+            return
+
+    def _dumps(self, value):
+        """Serializes, optionally compresses and encodes a value to base64.
+        The result is prefixed by the serializer tag, a ``z`` if it is
+        compressed, and a dot. Uncompressed JSON is not prefixed, to keep
+        the format used by older versions.
+        """
+        serializer = self._serializer
+        data = serializer.dumps(value)
+        tag = serializer.tag
+        threshold = self.compress_threshold
+        if threshold is not None and len(data) > threshold:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                tag += 'z'
+
+        if tag == JSONSerializer.tag:
+            return base64.b64encode(data)
+
+        return '%s.%s' % (tag, base64.b64encode(data))
+
+    def _loads(self, value):
+        """Decodes a value encoded by :meth:`_dumps`."""
+        if '.' not in value:
+            return json_b64decode(value)
+
+        tag, data = value.split('.', 1)
+        data = base64.b64decode(data)
+        if tag.endswith('z'):
+            data = zlib.decompress(data)
+            tag = tag[:-1]
+
+        return self._loaders[tag].loads(data)
+
+    def _get_digest(self, *parts):
+        """Generates a raw HMAC digest."""
+        hash = self._hmac.copy()
+        hash.update('|'.join(parts))
+        return hash.digest()
+
     def _get_signature(self, *parts):
         """Generated an HMAC signatures."""
-        hash = hmac.new(self.secret_key, digestmod=hashlib.sha1)
-        hash.update('|'.join(parts))
-        return hash.hexdigest()
+        return binascii.hexlify(self._get_digest(*parts))
 
     def _check_signature(self, a, b):
-        """Checks if an HMAC signatures is valid."""
-        if len(a) != len(b):
-            return False
-
-        result = 0
-        for x, y in zip(a, b):
-            result |= ord(x) ^ ord(y)
-
-        return result == 0
+        """Checks if an HMAC signatures is valid, in constant time."""
+        return _compare_digest(a, b)
 
 
 class SessionStore(object):
@@ -238,7 +741,7 @@ class SessionStore(object):
     def __init__(self, request, backends=None):
         self.request = request
         # Base configuration.
-        self.config = request.app.config[__name__]
+        self.config = request.app.config.cache[__name__]
         # A dictionary of support backend classes.
         self.backends = backends or self.default_backends
         # The default backend to use when none is provided.
@@ -255,7 +758,21 @@ class SessionStore(object):
         :returns:
             A :class:`SecureCookieStore` instance.
         """
-        return SecureCookieStore(self.config['secret_key'])
+        secret_key = self.config['secret_key']
+        # Shared between requests to reuse the HMAC state and the cache of
+        # decoded cookies.
+        registry = self.request.app.registry
+        store = registry.get('sessions.secure_cookie_store')
+        serializer = self.config['serializer']
+        compress_threshold = self.config['compress_threshold']
+        if (store is None or store.secret_key != secret_key or
+            store.serializer != serializer or
+            store.compress_threshold != compress_threshold):
+            store = SecureCookieStore(secret_key, serializer=serializer,
+                compress_threshold=compress_threshold)
+            registry['sessions.secure_cookie_store'] = store
+
+        return store
 
     def get_session(self, key=None, backend=None, **kwargs):
         """Returns a session for a given key. If the session doesn't exist, a
@@ -403,6 +920,9 @@ class SessionStore(object):
         :param response:
             A ``tipfy.Response`` object.
         """
+        timer = self.request.timer
+        start = timer and timer.clock()
+
         if self._cookies:
             for key, (value, kwargs) in self._cookies.iteritems():
                 if value is None:
@@ -416,6 +936,9 @@ class SessionStore(object):
                 for key, (value, kwargs) in sessions.iteritems():
                     value.save_session(response, self, key, **kwargs)
 
+        if timer:
+            timer.record('session_save', start)
+
     def get_cookie_args(self, **kwargs):
         """Returns a copy of the default cookie configuration updated with the
         passed arguments.
@@ -446,9 +969,44 @@ class SessionMiddleware(object):
         return response
 
 
+def _copy_value(value):
+    """Returns a copy of a decoded JSON value, copying nested dicts and
+    lists.
+    """
+    if type(value) is dict:
+        return dict([(k, _copy_value(v)) for k, v in value.iteritems()])
+    elif type(value) is list:
+        return [_copy_value(v) for v in value]
+
+    return value
+
+
+def _compare_digest(a, b):
+    """Compares two strings in constant time."""
+    if len(a) != len(b):
+        return False
+
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+
+    return result == 0
+
+
+# Python 2.7.7+ compares in C.
+_compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+
 if APPENGINE:
-    from tipfy.appengine.sessions import DatastoreSession, MemcacheSession
+    from tipfy.appengine.sessions import (DatastoreSession, MemcacheSession,
+        TieredSession)
     SessionStore.default_backends.update({
         'datastore': DatastoreSession,
         'memcache':  MemcacheSession,
+        'tiered':    TieredSession,
+    })
+else:
+    SessionStore.default_backends.update({
+        'memory': MemorySession,
+        'sqlite': SQLiteSession,
     })
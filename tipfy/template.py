@@ -81,12 +81,14 @@ to all templates by default.
 
 from __future__ import with_statement
 
+import __builtin__
 import cStringIO
 import datetime
 import htmlentitydefs
 import logging
 import os.path
 import re
+import types
 import urllib
 import xml.sax.saxutils
 import zipfile
@@ -180,8 +182,20 @@ class Template(object):
     """A compiled template.
 
     We compile into Python from the given template_string. You can generate
-    the template from variables with generate().
+    the template from variables with generate(). The template is compiled
+    once into a function; rendering only binds it to the variables.
     """
+    #: Functions available to all templates.
+    namespace = {
+        "escape": xhtml_escape,
+        "url_escape": url_escape,
+        "json_encode": json_encode,
+        "squeeze": squeeze,
+        "datetime": datetime,
+        # Not added by the interpreter as with exec.
+        "__builtins__": __builtin__,
+    }
+
     def __init__(self, template_string, name="<string>", loader=None,
                  compress_whitespace=None):
         self.name = name
@@ -198,18 +212,17 @@ class Template(object):
             logging.error("%s code:\n%s", self.name, formatted_code)
             raise
 
+        # The compiled module only defines _execute(): run it once and keep
+        # the function code, to be bound to the variables of each render.
+        namespace = {}
+        exec self.compiled in namespace
+        self.execute_code = namespace["_execute"].func_code
+
     def generate(self, **kwargs):
         """Generate this template with the given arguments."""
-        namespace = {
-            "escape": xhtml_escape,
-            "url_escape": url_escape,
-            "json_encode": json_encode,
-            "squeeze": squeeze,
-            "datetime": datetime,
-        }
+        namespace = self.namespace.copy()
         namespace.update(kwargs)
-        exec self.compiled in namespace
-        execute = namespace["_execute"]
+        execute = types.FunctionType(self.execute_code, namespace, "_execute")
         try:
             return execute()
         except:
@@ -321,6 +334,7 @@ class _File(_Node):
         writer.write_line("def _execute():")
         with writer.indent():
             writer.write_line("_buffer = []")
+            writer.write_line("_append = _buffer.append")
             self.body.generate(writer)
             writer.write_line("return ''.join(_buffer)")
 
@@ -392,10 +406,10 @@ class _ApplyBlock(_Node):
         writer.write_line("def %s():" % method_name)
         with writer.indent():
             writer.write_line("_buffer = []")
+            writer.write_line("_append = _buffer.append")
             self.body.generate(writer)
             writer.write_line("return ''.join(_buffer)")
-        writer.write_line("_buffer.append(%s(%s()))" % (
-            self.method, method_name))
+        writer.write_line("_append(%s(%s()))" % (self.method, method_name))
 
 
 class _ControlBlock(_Node):
@@ -434,10 +448,10 @@ class _Expression(_Node):
 
     def generate(self, writer):
         writer.write_line("_tmp = %s" % self.expression)
-        writer.write_line("if isinstance(_tmp, str): _buffer.append(_tmp)")
+        writer.write_line("if isinstance(_tmp, str): _append(_tmp)")
         writer.write_line("elif isinstance(_tmp, unicode): "
-                          "_buffer.append(_tmp.encode('utf-8'))")
-        writer.write_line("else: _buffer.append(str(_tmp))")
+                          "_append(_tmp.encode('utf-8'))")
+        writer.write_line("else: _append(str(_tmp))")
 
 
 class _Text(_Node):
@@ -455,7 +469,7 @@ class _Text(_Node):
             value = re.sub(r"(\s*\n\s*)", "\n", value)
 
         if value:
-            writer.write_line('_buffer.append(%r)' % value)
+            writer.write_line('_append(%r)' % value)
 
 
 class ParseError(Exception):
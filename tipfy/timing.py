@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.timing
+    ~~~~~~~~~~~~
+
+    Per-request timing of the phases of a request: rule matching, handler
+    import, middleware, the handler method, template rendering and session
+    saving. Enable it setting ``enable_timing`` in the ``tipfy`` config::
+
+        config['tipfy'] = {
+            'enable_timing': True,
+            # Add a Server-Timing header to responses.
+            'timing_header': True,
+            # Log a line with the timings of each request.
+            'timing_log': True,
+        }
+
+    When a request is done, the :data:`request_timed` signal is sent with the
+    recorded timings::
+
+        from tipfy.timing import request_timed
+
+        def collect_timings(app, request, response, timings):
+            for name, duration in timings:
+                # ... send to a stats server ...
+
+        request_timed.connect(collect_timings)
+
+    When timing is disabled, :attr:`tipfy.app.Request.timer` is None and
+    nothing is recorded.
+
+    :copyright: 2011 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import logging
+import time
+import timeit
+
+import blinker
+
+#: Function returning timestamps used to measure phases. Uses a monotonic
+#: clock if available.
+clock = getattr(time, 'monotonic', timeit.default_timer)
+
+_signals = blinker.Namespace()
+#: Signal sent when a timed request is done. Receivers are called with the
+#: app as sender and the ``request``, ``response`` and ``timings`` keyword
+#: arguments. See :meth:`RequestTimer.get_timings`.
+request_timed = _signals.signal('request-timed')
+
+
+class RequestTimer(object):
+    """Records the time spent in each phase of a request. Phases are
+    recorded calling :meth:`record` after each phase, passing the timestamp
+    from when it started::
+
+        timer = request.timer
+        start = timer and timer.clock()
+        # ... do something ...
+        if timer:
+            timer.record('something', start)
+    """
+    clock = staticmethod(clock)
+
+    def __init__(self):
+        """Initializes the timer, starting the request."""
+        self.started = clock()
+        self.phases = []
+
+    def record(self, name, start):
+        """Records a phase that ends now.
+
+        :param name:
+            The phase name.
+        :param start:
+            The timestamp from :meth:`clock` when the phase started.
+        """
+        self.phases.append((name, start, clock()))
+
+    def get_timings(self):
+        """Returns the duration of each phase, in milliseconds. Durations
+        of phases with the same name are summed, and the last item is the
+        request ``total``.
+
+        :returns:
+            A list of tuples ``(name, duration)``, in the order phases were
+            first recorded.
+        """
+        names = []
+        durations = {}
+        for name, start, end in self.phases:
+            if name not in durations:
+                names.append(name)
+                durations[name] = 0.0
+
+            durations[name] += (end - start) * 1000
+
+        rv = [(name, durations[name]) for name in names]
+        rv.append(('total', (clock() - self.started) * 1000))
+        return rv
+
+    def finish(self, app, request, response):
+        """Finishes timing a request: sends the :data:`request_timed`
+        signal, and adds a ``Server-Timing`` header to the response and logs
+        the timings if configured.
+
+        :param app:
+            A :class:`tipfy.app.App` instance.
+        :param request:
+            A :class:`tipfy.app.Request` instance.
+        :param response:
+            A :class:`tipfy.app.Response` instance.
+        """
+        timings = self.get_timings()
+        request_timed.send(app, request=request, response=response,
+            timings=timings)
+
+        config = app.config.cache['tipfy']
+        if config['timing_header']:
+            response.headers['Server-Timing'] = ', '.join('%s;dur=%.3f' %
+                timing for timing in timings)
+
+        if config['timing_log']:
+            logging.getLogger(__name__).info('%s %s %d %s' % (request.method,
+                request.path, response.status_code, ' '.join('%s=%.3f' %
+                timing for timing in timings)))
@@ -10,13 +10,16 @@
     :copyright: 2011 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
+import logging
+
 import blinker
 
-from jinja2 import Environment, FileSystemLoader, ModuleLoader
+from jinja2 import (Environment, FileSystemLoader, ModuleLoader,
+    TemplateSyntaxError)
 
 from werkzeug import cached_property, import_string
 
-from tipfy.local import get_request
+from tipfy.local import get_request, local
 from tipfy.routing import url_for
 
 #: Default configuration values for this module. Keys are:
@@ -60,7 +63,7 @@ default_config = {
 class Jinja2(object):
     def __init__(self, app, _globals=None, filters=None):
         self.app = app
-        config = app.config[__name__]
+        config = app.config.cache[__name__]
         kwargs = config['environment_args'].copy()
         enable_i18n = 'jinja2.ext.i18n' in kwargs.get('extensions', [])
 
@@ -100,6 +103,13 @@ class Jinja2(object):
             }
             env.globals.update(format_functions)
             env.filters.update(format_functions)
+            env.filters.update({
+                'format_date_list':     i18n.format_dates,
+                'format_time_list':     i18n.format_times,
+                'format_datetime_list': i18n.format_datetimes,
+                'format_number_list':   i18n.format_numbers,
+                'format_decimal_list':  i18n.format_decimals,
+            })
 
         env.globals['url_for'] = url_for
 
@@ -124,9 +134,16 @@ class Jinja2(object):
        :returns:
             A rendered template.
         """
+        timer = getattr(getattr(local, 'request', None), 'timer', None)
+        start = timer and timer.clock()
+
         res = self.environment.get_template(_filename).render(**context)
         template_rendered.send(self, template=_filename, context=context,
           result=res)
+
+        if timer:
+            timer.record('render', start)
+
         return res
 
     def render_template(self, _handler, _filename, **context):
@@ -207,6 +224,29 @@ class Jinja2Mixin(object):
         return self.jinja2.render_response(self, _filename, **context)
 
 
+def warmup(app):
+    """Creates the Jinja2 environment and compiles all templates. Used by
+    :class:`tipfy.server.PreforkServer` to compile templates once before
+    workers are forked.
+
+    :param app:
+        A :class:`tipfy.app.App` instance.
+    """
+    env = Jinja2.factory(app, 'jinja2').environment
+    try:
+        names = env.list_templates()
+    except TypeError:
+        # The loader can't list templates.
+        return
+
+    for name in names:
+        try:
+            env.get_template(name)
+        except TemplateSyntaxError, e:
+            # Possibly a template for another engine in the same directory.
+            logging.warning('Template %r was not compiled: %s' % (name, e))
+
+
 """
 # Example of using signals.
 